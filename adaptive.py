@@ -0,0 +1,165 @@
+import datetime
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from config.config import make_cfg
+from init_log import init_log
+from sensor import MinMaxSettings, SunElevationSettings
+
+logger = logging.getLogger('adaptive')
+init_log(logger)
+
+NoMax = 2 ** 32 - 1     # the MinMaxSettings default
+SunCacheSeconds = 60
+
+
+class SunElevation:
+    """
+    The sun's current elevation, computed at most once a minute (shared by all the stations)
+    """
+    elevation: Optional[float] = None
+    computed = 0.0
+
+    @classmethod
+    def get(cls) -> float:
+        now = time.monotonic()
+        if cls.elevation is None or now - cls.computed > SunCacheSeconds:
+            from astropy.coordinates import get_sun, AltAz, EarthLocation
+            from astropy.time import Time
+            from astropy import units as u
+
+            location = make_cfg().location
+            t = Time.now()
+            where = EarthLocation(lat=location.latitude * u.deg, lon=location.longitude * u.deg,
+                                  height=location.elevation * u.m)
+            cls.elevation = get_sun(t).transform_to(AltAz(obstime=t, location=where)).alt.value
+            cls.computed = now
+        return cls.elevation
+
+
+class AdaptivePolling:
+    """
+    Decides the factor by which a **Station** scales its polling interval:
+
+    * fast - a *Sensor* using one of its datums is settling or a value is near one of its thresholds,
+       so the decisions converge sooner
+    * slow - all the values are far from their thresholds
+    * up to *max_interval* - the sun makes all the projects unsafe for (at least) twice that long,
+       the *Sensors*' decisions do not matter until then
+
+    All the projects' *Sensors* count, not only the ones the **Station** keeps readings for.
+    """
+
+    def __init__(self, station):
+        cfg = make_cfg()
+        self.conf = cfg.adaptive_polling
+        self.station = station
+        self.sensors = [sensor for project in cfg.projects for sensor in cfg.sensors[project]
+                        if sensor.settings.enabled and sensor.settings.station == station.name]
+        self.sun_sensors = {}
+        for project in cfg.projects:
+            for sensor in cfg.sensors[project]:
+                if sensor.settings.enabled and isinstance(sensor.settings, SunElevationSettings):
+                    self.sun_sensors[project] = sensor
+        self.factor = 1.0
+        self.reason = 'normal'
+        self.updated: Optional[float] = None
+
+    @staticmethod
+    def thresholds(settings: MinMaxSettings) -> List[float]:
+        ret = []
+        if getattr(settings, 'has_min', False) or settings.min != 0:
+            ret.append(settings.min)
+        if settings.max != NoMax:
+            ret.append(settings.max)
+        return ret
+
+    def latest_value(self, datum: str) -> Optional[float]:
+        with self.station.lock:
+            if not self.station.readings.data:
+                return None
+            value = self.station.readings.data[-1].datums.get(datum)
+        return value if isinstance(value, (int, float)) else None
+
+    @staticmethod
+    def safe_range(settings: MinMaxSettings) -> float:
+        """
+        The width of the sensor's safe range, the unit of the distances from its thresholds
+        """
+        if settings.max != NoMax and settings.max > settings.min:
+            return settings.max - settings.min
+        return max(abs(settings.min), 1.0)
+
+    def proximity(self) -> Tuple[Optional[float], Optional[str]]:
+        """
+        The smallest distance of a value from one of its thresholds (as a fraction of its sensor's
+         safe range) and the sensor it belongs to
+        """
+        closest, closest_sensor = None, None
+        for sensor in self.sensors:
+            if not isinstance(sensor.settings, MinMaxSettings):
+                continue
+            value = self.latest_value(sensor.settings.datum)
+            if value is None:
+                continue
+            width = self.safe_range(sensor.settings)
+            for threshold in self.thresholds(sensor.settings):
+                distance = abs(value - threshold) / width
+                if closest is None or distance < closest:
+                    closest, closest_sensor = distance, sensor.name
+        return closest, closest_sensor
+
+    def sun_unsafe_for(self) -> float:
+        """
+        Seconds during which the sun surely keeps all the projects unsafe (0 if it does not)
+        """
+        if not self.sun_sensors or len(self.sun_sensors) < len(make_cfg().projects):
+            return 0
+        # a project is unsafe while the sun is above its dawn (AM) or dusk (PM) elevation
+        highest = max([max(sensor.settings.dawn, sensor.settings.dusk) for sensor in self.sun_sensors.values()])
+        elevation = SunElevation.get()
+        if elevation <= highest:
+            return 0
+        return (elevation - highest) / self.conf.sun_rate * 3600
+
+    def update(self, interval: float) -> float:
+        """
+        Re-evaluates the factor, given the **Station**'s normal polling *interval*.  Stations polling faster
+         than *min_interval* (e.g. the Arduinos' high-rate queries) re-evaluate it only that often.
+        """
+        now = time.monotonic()
+        if self.updated is not None and now - self.updated < self.conf.min_interval:
+            return self.factor
+        self.updated = now
+
+        factor, reason = 1.0, 'normal'
+        try:
+            unsafe_for = self.sun_unsafe_for()
+            if unsafe_for > 0:
+                factor = max(1.0, min(unsafe_for / 2, self.conf.max_interval) / interval)
+                reason = f"sun makes all projects unsafe for {datetime.timedelta(seconds=int(unsafe_for))}"
+            else:
+                settling = [sensor.name for sensor in self.sensors if sensor.started_settling is not None]
+                closest, sensor = self.proximity()
+                if settling:
+                    factor, reason = self.conf.fast, f"settling: {settling}"
+                elif closest is not None and closest < self.conf.near:
+                    factor, reason = self.conf.fast, f"'{sensor}' is within {closest:.0%} of a threshold"
+                elif closest is not None and closest > self.conf.far:
+                    factor, reason = self.conf.slow, f"all values are beyond {self.conf.far:.0%} of their thresholds"
+                factor = min(max(factor, self.conf.min_interval / interval), max(1.0, self.conf.max_interval / interval))
+        except Exception as ex:
+            logger.error(f"station '{self.station.name}': could not adapt the polling", exc_info=ex)
+            factor, reason = 1.0, 'normal'
+
+        if factor != self.factor:
+            logger.info(f"station '{self.station.name}': polling every {interval * factor:.0f} seconds ({reason})")
+        self.factor, self.reason = factor, reason
+        return factor
+
+    def status(self) -> dict:
+        return {
+            'factor': round(self.factor, 3),
+            'reason': self.reason,
+        }
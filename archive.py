@@ -0,0 +1,301 @@
+"""
+A compact daily archive of the raw readings, one pair of files per station per (UTC) day:
+
+* <directory>/<station>/<YYYY-MM-DD>.dat - blocks of readings, each column of a block encoded separately:
+    - tstamp:  microseconds since the epoch, as the first value, the first delta and then delta-of-deltas
+    - datums:  a bitmap of the present (numeric) values, then the values quantized to *precision*, as deltas
+   all integers are zigzag varints.
+* <directory>/<station>/<YYYY-MM-DD>.idx - a header (the column names and precision) followed by a fixed-size
+   record per block: first/last tstamp, number of rows and the offset/length of each column in the .dat file.
+   The index is small and meant to be mmap-ed, it lets a reader pick the blocks of a time range and decode
+   only the tstamp column and the column of the datum it needs.
+"""
+import datetime
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+from typing import List, Optional, Tuple
+
+from config.config import make_cfg
+from init_log import init_log
+
+logger = logging.getLogger('archive')
+init_log(logger)
+
+Magic = b'WAOA'
+Version = 1
+HeaderStruct = struct.Struct('<4sHHI')     # magic, version, number of columns, length of the JSON metadata
+Epoch = datetime.datetime(1970, 1, 1)
+Microsecond = datetime.timedelta(microseconds=1)
+
+
+def record_struct(ncolumns: int) -> struct.Struct:
+    # first tstamp, last tstamp, rows, then (offset, length) for the tstamp column and each datum column
+    return struct.Struct('<qqI' + 'QI' * (ncolumns + 1))
+
+
+def to_micros(t: datetime.datetime) -> int:
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (t - Epoch) // Microsecond
+
+
+def _put_varint(out: bytearray, n: int):
+    n = (n << 1) ^ (n >> 63)    # zigzag
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varints(data, count: int, pos: int = 0) -> Tuple[List[int], int]:
+    values = []
+    for _ in range(count):
+        n = shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                break
+            shift += 7
+        values.append((n >> 1) ^ -(n & 1))
+    return values, pos
+
+
+def encode_tstamps(micros: List[int]) -> bytes:
+    out = bytearray()
+    previous, delta = 0, 0
+    for i, t in enumerate(micros):
+        if i == 0:
+            _put_varint(out, t)
+        elif i == 1:
+            delta = t - previous
+            _put_varint(out, delta)
+        else:
+            _put_varint(out, (t - previous) - delta)
+            delta = t - previous
+        previous = t
+    return bytes(out)
+
+
+def decode_tstamps(data, count: int) -> List[int]:
+    raw, _ = _get_varints(data, count)
+    micros = []
+    previous, delta = 0, 0
+    for i, v in enumerate(raw):
+        if i == 0:
+            t = v
+        elif i == 1:
+            delta = v
+            t = previous + delta
+        else:
+            delta += v
+            t = previous + delta
+        micros.append(t)
+        previous = t
+    return micros
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not (isinstance(value, float) and (math.isnan(value) or math.isinf(value)))
+
+
+def encode_values(values: list, precision: float) -> bytes:
+    out = bytearray((len(values) + 7) // 8)
+    previous = 0
+    for i, value in enumerate(values):
+        if not _is_number(value):
+            continue
+        out[i // 8] |= 1 << (i % 8)
+        q = round(value / precision)
+        _put_varint(out, q - previous)
+        previous = q
+    return bytes(out)
+
+
+def decode_values(data, count: int, precision: float) -> List[Optional[float]]:
+    bitmap_length = (count + 7) // 8
+    present = [bool(data[i // 8] & (1 << (i % 8))) for i in range(count)]
+    deltas, _ = _get_varints(data, sum(present), bitmap_length)
+    values = []
+    q, d = 0, 0
+    for is_present in present:
+        if is_present:
+            q += deltas[d]
+            d += 1
+            values.append(q * precision)
+        else:
+            values.append(None)
+    return values
+
+
+class ArchiveDay:
+    """
+    The archive files of one station for one day
+    """
+    def __init__(self, directory: str, station: str, day: datetime.date):
+        self.path = os.path.join(directory, station, day.isoformat())
+        self.dat = self.path + '.dat'
+        self.idx = self.path + '.idx'
+
+    def exists(self) -> bool:
+        return os.path.exists(self.idx) and os.path.exists(self.dat)
+
+    def read_header(self, data) -> Tuple[dict, int]:
+        magic, version, ncolumns, meta_length = HeaderStruct.unpack_from(data, 0)
+        if magic != Magic or version != Version:
+            raise Exception(f"'{self.idx}' is not a version {Version} archive index")
+        meta = json.loads(bytes(data[HeaderStruct.size:HeaderStruct.size + meta_length]))
+        return meta, HeaderStruct.size + meta_length
+
+    def write_header(self, columns: List[str], precision: float):
+        meta = json.dumps({'columns': columns, 'precision': precision}).encode()
+        with open(self.idx, 'wb') as f:
+            f.write(HeaderStruct.pack(Magic, Version, len(columns), len(meta)) + meta)
+        open(self.dat, 'wb').close()
+
+
+class ArchiveWriter:
+    """
+    Buffers a **Station**'s readings and appends them to the day's archive in blocks of *block_rows*
+    """
+
+    def __init__(self, station: str):
+        conf = make_cfg().archive
+        self.station = station
+        self.directory = conf.directory
+        self.block_rows = conf.block_rows
+        self.precision = conf.precision
+        self.day: Optional[datetime.date] = None
+        self.columns: Optional[List[str]] = None
+        self.rows: List[Tuple[int, list]] = []
+        self.lock = threading.Lock()
+
+    def append(self, reading):
+        with self.lock:
+            micros = to_micros(reading.tstamp)
+            day = (Epoch + micros * Microsecond).date()
+            if day != self.day:
+                self._flush()
+                self._open(day, reading)
+            self.rows.append((micros, [reading.datums.get(column) for column in self.columns]))
+            if len(self.rows) >= self.block_rows:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _open(self, day: datetime.date, reading):
+        archive_day = ArchiveDay(self.directory, self.station, day)
+        os.makedirs(os.path.dirname(archive_day.path), exist_ok=True)
+        if archive_day.exists():
+            with open(archive_day.idx, 'r+b') as f:
+                data = f.read()
+                meta, header_length = archive_day.read_header(data)
+                # drop a partially written record (e.g. after a crash)
+                f.truncate(len(data) - (len(data) - header_length) % record_struct(len(meta['columns'])).size)
+            self.columns = meta['columns']
+            self.precision = meta['precision']
+        else:
+            self.columns = [getattr(datum, 'value', datum) for datum in reading.datums.keys()]
+            self.precision = make_cfg().archive.precision
+            archive_day.write_header(self.columns, self.precision)
+        self.day = day
+        self.archive_day = archive_day
+
+    def _flush(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        try:
+            columns = [encode_tstamps([micros for micros, _ in rows])]
+            for i in range(len(self.columns)):
+                columns.append(encode_values([values[i] for _, values in rows], self.precision))
+
+            with open(self.archive_day.dat, 'ab') as f:
+                offset = f.tell()
+                locations = []
+                for column in columns:
+                    locations += [offset, len(column)]
+                    offset += len(column)
+                f.write(b''.join(columns))
+            with open(self.archive_day.idx, 'ab') as f:
+                f.write(record_struct(len(self.columns)).pack(rows[0][0], rows[-1][0], len(rows), *locations))
+        except Exception as ex:
+            logger.error(f"station '{self.station}': could not archive {len(rows)} readings", exc_info=ex)
+
+
+class ArchiveReader:
+    """
+    Scans a station's daily archives for one datum, decoding only the blocks in range and only
+     the tstamp and datum columns
+    """
+
+    def __init__(self, directory: str = None):
+        self.directory = directory if directory is not None else make_cfg().archive.directory
+
+    def read(self, station: str, datum: str, start: datetime.datetime, end: datetime.datetime):
+        """
+        :return: (tstamps, values) numpy arrays (datetime64[us] and float64, NaN for missing values)
+        """
+        import numpy as np
+
+        datum = getattr(datum, 'value', datum)
+        first, last = to_micros(start), to_micros(end)
+        tstamps, values = [], []
+
+        day = start.date()
+        while day <= end.date():
+            archive_day = ArchiveDay(self.directory, station, day)
+            day += datetime.timedelta(days=1)
+            if not archive_day.exists() or os.path.getsize(archive_day.dat) == 0:
+                continue
+
+            with open(archive_day.idx, 'rb') as idx_file, open(archive_day.dat, 'rb') as dat_file:
+                with mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ) as idx, \
+                        mmap.mmap(dat_file.fileno(), 0, access=mmap.ACCESS_READ) as dat:
+                    meta, header_length = archive_day.read_header(idx)
+                    if datum not in meta['columns']:
+                        continue
+                    column = meta['columns'].index(datum) + 1
+                    record = record_struct(len(meta['columns']))
+                    records = idx[header_length:]
+                    records = records[:len(records) - len(records) % record.size]
+
+                    for fields in record.iter_unpack(records):
+                        block_first, block_last, count = fields[0:3]
+                        if block_last < first or block_first >= last:
+                            continue
+                        t_offset, t_length = fields[3:5]
+                        v_offset, v_length = fields[3 + 2 * column:5 + 2 * column]
+                        block_tstamps = decode_tstamps(dat[t_offset:t_offset + t_length], count)
+                        block_values = decode_values(dat[v_offset:v_offset + v_length], count, meta['precision'])
+                        for t, v in zip(block_tstamps, block_values):
+                            if first <= t < last:
+                                tstamps.append(t)
+                                values.append(v)
+
+        return (np.array(tstamps, dtype=np.int64).astype('datetime64[us]'),
+                np.array(values, dtype=np.float64))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Reads a datum from the daily archives")
+    parser.add_argument('station')
+    parser.add_argument('datum')
+    parser.add_argument('--from', dest='start', type=datetime.datetime.fromisoformat, required=True, help="UTC")
+    parser.add_argument('--to', dest='end', type=datetime.datetime.fromisoformat, required=True, help="UTC")
+    parser.add_argument('--directory', help="default: as configured")
+    args = parser.parse_args()
+
+    t, v = ArchiveReader(args.directory).read(args.station, args.datum, args.start, args.end)
+    for tstamp, value in zip(t, v):
+        print(f"{tstamp} {value}")
@@ -1,8 +1,97 @@
+import datetime
+import logging
 import time
 from abc import ABC, abstractmethod
-from typing import Tuple, Union
+from collections import deque
+from typing import Tuple, Union, NamedTuple, List, Optional, Dict, Callable
 
 from arduino_parser import ArduinoParser
+from config.config import make_cfg
+from db_access import station_tables
+from init_log import init_log
+
+logger = logging.getLogger('arduino')
+init_log(logger)
+
+
+class ArduinoQuery(NamedTuple):
+    """
+    A device command, the format of its response and the datums its values go to (None to skip a value)
+    """
+    command: str
+    wait: float     # seconds between the request and reading the response (only when not pipelined)
+    format: str
+    datums: tuple
+
+
+class QueryPlanner:
+    """
+    Schedules a station's queries by demand.  A datum is wanted if a *Sensor* uses it, or if it is both
+     listed in the station's 'datums' and stored in the database.  A query is skipped if it provides no
+     wanted datum, otherwise it runs at the fastest 'rates' of its wanted datums (default: the *interval*).
+     A wanted datum that is derived (by the station) from another makes the other one wanted.
+     The *scale* (of the adaptive polling) multiplies the *interval*; it slows all the queries down,
+     but speeds up only the ones slower than the scaled *interval*.
+    """
+
+    def __init__(self, station: str, queries: List[ArduinoQuery], interval: float, sensors: list,
+                 derived: Optional[Dict[str, str]] = None):
+        settings = make_cfg().station_settings[station]
+        used = {sensor.settings.datum for sensor in sensors if sensor.settings.enabled}
+        stored = set(station_tables[station].columns.keys()) if station in station_tables else set()
+        wanted = used | (stored & set(settings.datums))
+        for datum, source in (derived or {}).items():
+            if getattr(datum, 'value', datum) in wanted:
+                wanted.add(getattr(source, 'value', source))
+
+        self.interval = interval
+        self.periods: Dict[str, float] = {}
+        self.datum_periods: Dict[str, float] = {}
+        self.queries: List[ArduinoQuery] = []
+        for query in queries:
+            datums = [getattr(datum, 'value', datum) for datum in query.datums if datum is not None]
+            needed = [datum for datum in datums if datum in wanted]
+            if not needed:
+                logger.info(f"station '{station}': query '{query.command}' skipped, none of {datums} is wanted")
+                continue
+            self.queries.append(query)
+            self.periods[query.command] = min([settings.rates.get(datum, interval) for datum in needed])
+            for datum in datums:
+                self.datum_periods[datum] = self.periods[query.command]
+
+        self.tick = min(list(self.periods.values()) + [interval])
+        self.scale = 1.0
+        self.next_due: Dict[str, float] = {query.command: 0.0 for query in self.queries}
+        self.next_push = 0.0
+        logger.info(f"station '{station}': query periods {self.periods}, polling every {self.tick} seconds")
+
+    def period(self, command: str) -> float:
+        period = self.periods[command]
+        return period * self.scale if self.scale >= 1 else min(period, self.interval * self.scale)
+
+    def scaled_tick(self) -> float:
+        return min([self.period(command) for command in self.periods] + [self.interval * self.scale])
+
+    def _is_due(self, now: float, at: float) -> bool:
+        return now >= at - 0.1 * self.scaled_tick()     # some slack for the polling jitter
+
+    def due(self, now: float) -> List[ArduinoQuery]:
+        ret = [query for query in self.queries if self._is_due(now, self.next_due[query.command])]
+        for query in ret:
+            self.next_due[query.command] = self._next(self.next_due[query.command], self.period(query.command), now)
+        return ret
+
+    def push_due(self, now: float) -> bool:
+        if not self._is_due(now, self.next_push):
+            return False
+        self.next_push = self._next(self.next_push, self.interval * self.scale, now)
+        return True
+
+    @staticmethod
+    def _next(at: float, period: float, now: float) -> float:
+        # keeps to the schedule, unless it fell behind (e.g. the first time)
+        at += period
+        return at if at > now else now + period
 
 
 class Arduino(ABC):
@@ -13,6 +102,8 @@ class Arduino(ABC):
     PC: <measurement name>?
     ARDUINO: <some text><value 1><some text><value 2><some text>
     """
+    Derived: dict = {}      # datum => the sampled datum it is computed from (see *sampled()* and *decimated()*)
+
     def __init__(self, ser):
         super().__init__(ser)
 
@@ -55,6 +146,117 @@ class Arduino(ABC):
 
         return ArduinoParser.parse(format_str, response)
 
+    def init_queries(self, cfg: dict):
+        """
+        To be called by the **Station**, once its *interval* and *sensors* are known
+
+        :param cfg: The station's configuration section
+        """
+        self.pipelined: bool = cfg['pipelined'] if 'pipelined' in cfg else False
+        self.pipeline_depth: int = cfg['pipeline-depth'] if 'pipeline-depth' in cfg else 3
+        self.planner = QueryPlanner(self.name, self.Queries, self.interval, self.sensors, self.Derived)
+        self.latest_values: dict = {}
+
+    def planned_fetch(self, new_reading: Callable):
+        """
+        Runs the queries that are due.  The freshly sampled values are observed (rollups, archive) right away,
+         once per *interval* a reading with the latest value of each datum goes to the *Sensors* and is saved.
+
+        :param new_reading: Makes an empty reading of the station's type
+        """
+        now = time.time()
+        self.planner.scale = self.poll_factor
+        due = self.planner.due(now)
+        sampled = new_reading()
+        if due:
+            with self.connection() as self.ser:
+                self.run_queries(due, sampled)
+        sampled.tstamp = datetime.datetime.utcnow()
+        self.sampled(sampled, now)
+
+        self.latest_values.update({datum: (value, now) for datum, value in sampled.datums.items() if value is not None})
+        self.observe(sampled)
+
+        if self.planner.push_due(now):
+            reading = new_reading()
+            for datum, (value, sampled_at) in self.latest_values.items():
+                # values that were not refreshed when due are stale
+                if now - sampled_at <= 2 * max(self.planner.datum_periods.get(getattr(datum, 'value', datum), 0),
+                                               self.interval) * max(self.planner.scale, 1):
+                    reading.datums[datum] = value
+            reading.tstamp = sampled.tstamp
+            self.decimated(reading, now)
+            self.push_reading(reading, observe=False)
+
+    def sampled(self, reading, now: float):
+        """
+        Called with each reading of freshly sampled values (the datums that were not due are None)
+        """
+        pass
+
+    def decimated(self, reading, now: float):
+        """
+        Called with the once per *interval* reading, before it goes to the *Sensors* and the database.
+         May replace the latest values by aggregates of the samples.
+        """
+        pass
+
+    def query_many(self, queries: List[ArduinoQuery]) -> List[Optional[tuple]]:
+        """
+        Pipelined queries: up to *pipeline_depth* requests are outstanding at any time, the response
+         lines are read as they arrive (no fixed sleeps) and matched to the outstanding requests, in order.
+         A request whose response was skipped (or garbled) is given up on when a later one is answered.
+
+        :return: The parsed values per query (None if not answered)
+        """
+        results: List[Optional[tuple]] = [None] * len(queries)
+        echoes = {f"{query.command}?" for query in queries}
+        pending = deque()
+        sent = 0
+
+        self.ser.reset_input_buffer()
+        while sent < len(queries) or pending:
+            while sent < len(queries) and len(pending) < self.pipeline_depth:
+                self.ser.write(f"{queries[sent].command}?\r\n".encode("utf-8"))
+                pending.append(sent)
+                sent += 1
+
+            line = self.ser.read_until(b"\n")
+            if not line.endswith(b"\n"):
+                logger.warning(f"timed-out after {self.ser.timeout} seconds, " +
+                               f"unanswered: {[queries[i].command for i in pending]}")
+                break
+            text = line.decode("utf-8", errors="replace")
+            if text.strip() in echoes:
+                continue
+
+            for k, i in enumerate(pending):
+                values = ArduinoParser.parse(queries[i].format, text)
+                if values is not None:
+                    results[i] = values
+                    for _ in range(k + 1):
+                        pending.popleft()
+                    break
+            else:
+                logger.debug(f"unexpected response: {text!r}")
+
+        return results
+
+    def run_queries(self, queries: List[ArduinoQuery], reading):
+        """
+        Runs the queries (pipelined or one by one, as configured) and sets the reading's datums
+        """
+        if self.pipelined:
+            results = self.query_many(queries)
+        else:
+            results = [self.query(query.command, query.wait, query.format) for query in queries]
+
+        for query, values in zip(queries, results):
+            if values:
+                for datum, value in zip(query.datums, values):
+                    if datum is not None:
+                        reading.datums[datum] = value
+
     @abstractmethod
     def get_correct_file(self) -> str:
         """
@@ -1,102 +1,92 @@
-from typing import List
-
-
-class ArduinoParser:
-    @staticmethod
-    def _parse_single(value: str, format_specifier: str):
-        try:
-            if format_specifier == "i":
-                return int(value)
-            elif format_specifier == "f":
-                return float(value)
-            elif format_specifier == "s":
-                return value
+from typing import List, Dict, Optional, Tuple, Callable
+
+
+class ArduinoFormat:
+    """
+    A compiled response format, e.g. 'P:{f}hPa T:{f}°C'.  Matching is a single left-to-right pass: each
+     delimiter must follow the previous value, each value ends where the next delimiter is first found.
+    """
+    converters: Dict[str, Callable] = {'i': int, 'f': float, 's': str}
+
+    def __init__(self, format_str: str):
+        self.format_str = format_str
+        self.delimiters: List[str] = []
+        self.specifiers: List[str] = []
+
+        # tokenize, '{{' and '}}' are literal braces
+        delimiter = []
+        i = 0
+        while i < len(format_str):
+            c = format_str[i]
+            if c in '{}' and format_str[i + 1:i + 2] == c:
+                delimiter.append(c)
+                i += 2
+            elif c == '{':
+                end = format_str.find('}', i + 1)
+                if end == -1:
+                    raise ValueError(f"unterminated '{{' at {i} in format {format_str!r}")
+                specifier = format_str[i + 1:end]
+                if specifier not in ArduinoFormat.converters:
+                    raise ValueError(f"bad specifier {{{specifier}}} in format {format_str!r}")
+                self.delimiters.append(''.join(delimiter))
+                self.specifiers.append(specifier)
+                delimiter = []
+                i = end + 1
+            elif c == '}':
+                raise ValueError(f"single '}}' at {i} in format {format_str!r}")
             else:
-                return None
-        except ValueError:
-            return None
-
-    @staticmethod
-    def parse(format_str: str, response: str):
-        # TODO: dangerous code. can enter infinite loop
+                delimiter.append(c)
+                i += 1
+        self.delimiters.append(''.join(delimiter))
+        self.fields: List[Tuple[str, Callable, str]] = [
+            (self.delimiters[n], ArduinoFormat.converters[self.specifiers[n]], self.delimiters[n + 1])
+            for n in range(len(self.specifiers))]
+
+    def parse(self, response: str) -> Optional[tuple]:
         """
-        Tries to extract values from a string created using formatting.
-        Limitations: Must be only one way to parse to string
-        :param format_str: format string with only. For example 'Int Value {i} Float Value {f}'.
-        :param response: text to parse
-        :return: values extracted from the response.
+        :return: The values, or None if the response does not match the format
         """
-        delimiters: List[str] = []
-        format_specifiers: List[str] = []
-
-        last_i = 0
-
-        while last_i < len(format_str) and (
-                format_str.find("{", last_i) != -1 or format_str.find("}", last_i) != -1):
-
-            format_start = format_str.find("{", last_i)
-            format_end = format_str.find("}", last_i)
-
-            start_escaped = False
-            end_escaped = False
-
-            if format_end != len(format_str) - 1:
-                end_escaped = format_str[format_end + 1] == "}"
-
-            if format_start != len(format_str) - 1:
-                start_escaped = format_str[format_start + 1] == "{"
-
-            # both escaped
-            if start_escaped and end_escaped:
-                last_i = max(format_start + 2, format_end + 2)
-            # both not escaped
-            elif not start_escaped and not end_escaped:
-                if format_end < format_start:
+        values = []
+        pos = 0
+        for before, convert, after in self.fields:
+            if not response.startswith(before, pos):
+                return None
+            start = pos + len(before)
+            if after:
+                pos = response.find(after, start)
+                if pos == -1:
                     return None
-
-                format_specifier = format_str[format_start + 1: format_end]
-                format_specifiers.append(format_specifier)
-
-                before = format_str[last_i: format_start]
-                delimiters.append(before)
-
-                last_i = format_end + 1
-            # one of them escaped. Error
             else:
+                pos = len(response)
+            try:
+                values.append(convert(response[start:pos]))
+            except ValueError:
                 return None
+        return tuple(values)
 
-        if last_i <= len(format_str):
-            delimiters.append(format_str[last_i:])
 
-        if len(format_specifiers) == 0:
-            return tuple([])
-
-        results = []
-
-        remaining_response = response
-
-        for i in range(len(format_specifiers)):
-            before = delimiters[i]
-            after = delimiters[i + 1]
-
-            before_index = remaining_response.find(before)
-            if after != "":
-                after_index = remaining_response.find(after, before_index + len(before))
-
-                if before_index != 0 or after_index == -1:
-                    return None
-
-                str_to_parse = remaining_response[before_index + len(before): after_index]
-                remaining_response = remaining_response[after_index:]
-            else:
-                str_to_parse = remaining_response[before_index + len(before):]
-                remaining_response = ""
-
-            value = ArduinoParser._parse_single(str_to_parse, format_specifiers[i])
+class ArduinoParser:
+    _compiled: Dict[str, ArduinoFormat] = {}
 
-            if value is None:
-                return None
+    @staticmethod
+    def compile(format_str: str) -> ArduinoFormat:
+        """
+        The compiled (and cached) format
 
-            results.append(value)
+        :raises ValueError: if the format is malformed
+        """
+        compiled = ArduinoParser._compiled.get(format_str)
+        if compiled is None:
+            compiled = ArduinoFormat(format_str)
+            ArduinoParser._compiled[format_str] = compiled
+        return compiled
 
-        return tuple(results)
+    @staticmethod
+    def parse(format_str: str, response: str):
+        """
+        Extracts the values from a response, see **ArduinoFormat**
+        :param format_str: format string. For example 'Int Value {i} Float Value {f}'.
+        :param response: text to parse
+        :return: values extracted from the response (None if it does not match the format)
+        """
+        return ArduinoParser.compile(format_str).parse(response)
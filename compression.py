@@ -0,0 +1,140 @@
+import datetime
+import math
+from typing import Dict, List, Optional
+
+from config.config import CompressionSettings
+
+
+def _number(value) -> Optional[float]:
+    if isinstance(value, (int, float)) and not (isinstance(value, float) and math.isnan(value)):
+        return float(value)
+    return None
+
+
+class Compressor:
+    """
+    Decides which of a **Station**'s readings need to be stored, so that every datum can be reconstructed
+     from the stored ones within its policy's *deviation*:
+
+    * deadband:      the value is held since the last stored reading, a reading is stored when a datum
+                      moves more than *deviation* away from it.
+    * swinging-door: values are linearly interpolated between stored readings.  The feasible slopes from
+                      the last stored reading (the *anchor*) narrow with each reading; when the latest
+                      reading can no longer be reached within *deviation* of all the readings in between,
+                      the previous one (the *pending* reading) is stored and becomes the new anchor.
+
+    A reading is stored at least every *max_gap* seconds, non-numeric datums are stored when they change.
+    """
+
+    def __init__(self, settings: CompressionSettings):
+        self.settings = settings
+        self.anchor = None      # the last stored reading
+        self.pending = None     # the last reading, if not stored
+        self.lower: Dict[str, float] = {}   # per swinging-door datum, the feasible slopes from the anchor
+        self.upper: Dict[str, float] = {}
+        self.received = 0
+        self.stored = 0
+
+    @staticmethod
+    def _elapsed(reading, since) -> float:
+        return (reading.tstamp - since.tstamp) / datetime.timedelta(seconds=1)
+
+    def _must_store(self, reading) -> bool:
+        """
+        Is *reading* needed regardless of the swinging doors (heartbeat, deadbands, changed non-numeric values,
+         a swinging-door datum gone missing, a timestamp not after the anchor's)?
+        """
+        elapsed = self._elapsed(reading, self.anchor)
+        if elapsed <= 0 or elapsed >= self.settings.max_gap:
+            return True
+
+        for datum in self.lower:
+            if _number(reading.datums.get(datum)) is None:
+                return True
+
+        for datum, value in reading.datums.items():
+            policy = self.settings.policy(getattr(datum, 'value', datum))
+            anchored = self.anchor.datums.get(datum)
+            v, a = _number(value), _number(anchored)
+            if v is None or a is None:
+                if value != anchored:
+                    return True
+            elif policy.method == 'deadband' and abs(v - a) > policy.deviation:
+                return True
+        return False
+
+    def _reachable(self, reading) -> bool:
+        """
+        Can the line from the anchor to *reading* stand in for all the readings in between?
+        """
+        dt = self._elapsed(reading, self.anchor)
+        if dt <= 0:
+            return False
+        for datum in self.lower:
+            value = _number(reading.datums.get(datum))
+            if value is None:
+                return False
+            slope = (value - _number(self.anchor.datums[datum])) / dt
+            if not (self.lower[datum] <= slope <= self.upper[datum]):
+                return False
+        return True
+
+    def _narrow(self, reading):
+        """
+        Narrows the swinging doors so that the readings after *reading* stay within its deviation
+        """
+        dt = self._elapsed(reading, self.anchor)
+        for datum in self.lower:
+            deviation = self.settings.policy(getattr(datum, 'value', datum)).deviation
+            delta = _number(reading.datums.get(datum)) - _number(self.anchor.datums[datum])
+            self.lower[datum] = max(self.lower[datum], (delta - deviation) / dt)
+            self.upper[datum] = min(self.upper[datum], (delta + deviation) / dt)
+
+    def _store(self, reading, stored: List):
+        stored.append(reading)
+        self.stored += 1
+        self.anchor = reading
+        self.pending = None
+        self.lower, self.upper = {}, {}
+        for datum, value in reading.datums.items():
+            if self.settings.policy(getattr(datum, 'value', datum)).method == 'swinging-door' \
+                    and _number(value) is not None:
+                self.lower[datum], self.upper[datum] = -math.inf, math.inf
+
+    def filter(self, reading) -> List:
+        """
+        Feeds a new reading
+
+        :return: The readings that should be stored (none, one or two)
+        """
+        self.received += 1
+        stored = []
+        if self.anchor is None:
+            self._store(reading, stored)
+            return stored
+
+        if self.pending is not None and not self._reachable(reading):
+            self._store(self.pending, stored)
+
+        if self._must_store(reading):
+            self._store(reading, stored)
+        else:
+            self._narrow(reading)
+            self.pending = reading
+        return stored
+
+    def flush(self) -> List:
+        """
+        :return: The pending reading (if any), so that the stored history reaches the latest reading
+        """
+        stored = []
+        if self.pending is not None:
+            self._store(self.pending, stored)
+        return stored
+
+    def status(self) -> dict:
+        return {
+            'received': self.received,
+            'stored': self.stored,
+            'ratio': (self.stored / self.received) if self.received else None,
+        }
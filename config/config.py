@@ -12,17 +12,53 @@ logger: logging.Logger = logging.getLogger('config')
 # init_log(logger)
 
 
+class CompressionPolicy:
+    method: str         # 'deadband' or 'swinging-door'
+    deviation: float    # the maximal reconstruction error
+
+    Methods = ['deadband', 'swinging-door']
+
+    def __init__(self, d: dict):
+        self.method = d['method'] if 'method' in d else 'deadband'
+        if self.method not in CompressionPolicy.Methods:
+            raise Exception(f"Bad compression method '{self.method}' (valid methods: {CompressionPolicy.Methods})")
+        self.deviation = float(d['deviation']) if 'deviation' in d else 0.0
+
+
+class CompressionSettings:
+    enabled: bool
+    max_gap: float      # seconds, a row is stored at least this often
+    default: CompressionPolicy
+    policies: Dict[str, CompressionPolicy]  # per datum
+
+    def __init__(self, d: dict):
+        self.enabled = d['enabled'] if 'enabled' in d else False
+        self.max_gap = float(d['max-gap']) if 'max-gap' in d else 900.0
+        self.default = CompressionPolicy(d['default'] if 'default' in d else {})
+        self.policies = dict()
+        if 'datums' in d:
+            for datum, policy in d['datums'].items():
+                self.policies[datum] = CompressionPolicy(policy)
+
+    def policy(self, datum: str) -> CompressionPolicy:
+        return self.policies[datum] if datum in self.policies else self.default
+
+
 class StationSettings:
     enabled: bool
     interval: int  # seconds
     nreadings: int
     datums: List[str]
+    compression: CompressionSettings
+    rates: Dict[str, float]     # datum => seconds between samples (default: interval)
 
     def __init__(self, d: dict):
         self.enabled = d['enabled'] if 'enabled' in d else False
         self.interval = d['interval'] if 'interval' in d else 60
         self.nreadings = d['nreadings'] if 'nreadings' in d else 1
         self.datums = d['datums']
+        self.compression = CompressionSettings(d['compression']) if 'compression' in d else None
+        self.rates = {datum: float(seconds) for datum, seconds in d['rates'].items()} if 'rates' in d else {}
 
 
 class SerialStationSettings(StationSettings):
@@ -31,6 +67,7 @@ class SerialStationSettings(StationSettings):
     baud: int
     timeout: float
     write_timeout: float
+    open_delay: float       # seconds to wait after opening the port (e.g. an Arduino resets)
 
     def __init__(self, d: dict):
         super().__init__(d)
@@ -39,6 +76,7 @@ class SerialStationSettings(StationSettings):
         if 'timeout' in d:
             self.timeout = float(d['timeout'])
         self.write_timeout = float(d['write-timeout']) if 'write-timeout' in d else 2.0
+        self.open_delay = float(d['open-delay']) if 'open-delay' in d else 0.0
 
 
 class HttpStationSettings(StationSettings):
@@ -77,12 +115,32 @@ class ServerConfig:
         self.port = d['port']
 
 
+class PartitionsConfig:
+    enabled: bool
+    months_ahead: int
+    retention_months: int   # 0 means keep forever
+    drop_detached: bool
+
+    def __init__(self, d: dict):
+        self.enabled = d['enabled'] if 'enabled' in d else False
+        self.months_ahead = int(d['months-ahead']) if 'months-ahead' in d else 2
+        self.retention_months = int(d['retention-months']) if 'retention-months' in d else 0
+        self.drop_detached = d['drop-detached'] if 'drop-detached' in d else False
+
+
 class DatabaseConfig:
     host: str
     name: str
     user: str
     password: str
     schema: str
+    connect_timeout: int        # seconds
+    statement_timeout: float    # seconds
+    pool_timeout: float         # seconds
+    keepalive_idle: int         # seconds
+    breaker_failures: int
+    breaker_probe_interval: float  # seconds
+    partitions: PartitionsConfig
 
     def __init__(self, d: dict):
         self.host = d['host']
@@ -90,6 +148,107 @@ class DatabaseConfig:
         self.user = d['user']
         self.password = d['password']
         self.schema = d['schema']
+        self.connect_timeout = int(d['connect-timeout']) if 'connect-timeout' in d else 5
+        self.statement_timeout = float(d['statement-timeout']) if 'statement-timeout' in d else 10.0
+        self.pool_timeout = float(d['pool-timeout']) if 'pool-timeout' in d else 5.0
+        self.keepalive_idle = int(d['keepalive-idle']) if 'keepalive-idle' in d else 10
+        self.breaker_failures = int(d['breaker-failures']) if 'breaker-failures' in d else 3
+        self.breaker_probe_interval = float(d['breaker-probe-interval']) if 'breaker-probe-interval' in d else 30.0
+        self.partitions = PartitionsConfig(d['partitions'] if 'partitions' in d else {})
+
+
+class RollupsConfig:
+    enabled: bool
+    max_pending: int    # rows kept for retry while the database is unavailable
+
+    def __init__(self, d: dict):
+        self.enabled = d['enabled'] if 'enabled' in d else False
+        self.max_pending = int(d['max-pending']) if 'max-pending' in d else 10000
+
+
+class HistoryConfig:
+    cache_size: int     # answers kept by the /history LRU cache
+    max_points: int
+
+    def __init__(self, d: dict):
+        self.cache_size = int(d['cache-size']) if 'cache-size' in d else 256
+        self.max_points = int(d['max-points']) if 'max-points' in d else 5000
+
+
+class ArchiveConfig:
+    enabled: bool
+    directory: str
+    block_rows: int     # readings per encoded block
+    precision: float    # values are quantized to this
+
+    def __init__(self, d: dict):
+        self.enabled = d['enabled'] if 'enabled' in d else False
+        self.directory = d['directory'] if 'directory' in d else 'archive'
+        self.block_rows = int(d['block-rows']) if 'block-rows' in d else 60
+        self.precision = float(d['precision']) if 'precision' in d else 0.001
+
+
+class WarmStartConfig:
+    enabled: bool
+    directory: str
+    max_age: float      # seconds, older readings are not restored
+
+    def __init__(self, d: dict):
+        self.enabled = d['enabled'] if 'enabled' in d else False
+        self.directory = d['directory'] if 'directory' in d else 'snapshots'
+        self.max_age = float(d['max-age']) if 'max-age' in d else 600.0
+
+
+class SerialManagerConfig:
+    stale_after: float      # seconds without a successful transaction before a port is re-opened
+    min_backoff: float      # seconds
+    max_backoff: float      # seconds
+
+    def __init__(self, d: dict):
+        self.stale_after = float(d['stale-after']) if 'stale-after' in d else 300.0
+        self.min_backoff = float(d['min-backoff']) if 'min-backoff' in d else 1.0
+        self.max_backoff = float(d['max-backoff']) if 'max-backoff' in d else 60.0
+
+
+class DetectionConfig:
+    cache_file: str     # the detected stations, by port identity
+    timeout: float      # seconds, per probe read
+
+    def __init__(self, d: dict):
+        self.cache_file = d['cache-file'] if 'cache-file' in d else None
+        self.timeout = float(d['timeout']) if 'timeout' in d else 2.0
+
+
+class HealthConfig:
+    max_backoff: float      # seconds, the longest a failing station waits between fetches
+    jitter: float           # fraction, the backoff is randomized by up to +/- this much
+    score_alpha: float      # weight of the latest outcome in the health score
+
+    def __init__(self, d: dict):
+        self.max_backoff = float(d['max-backoff']) if 'max-backoff' in d else 900.0
+        self.jitter = float(d['jitter']) if 'jitter' in d else 0.2
+        self.score_alpha = float(d['score-alpha']) if 'score-alpha' in d else 0.1
+
+
+class AdaptivePollingConfig:
+    enabled: bool
+    near: float             # a value within this fraction of its sensor's safe range from a threshold is near it
+    far: float              # all the values beyond this fraction of their safe ranges are far from them
+    fast: float             # the interval factor when near a threshold or settling
+    slow: float             # the interval factor when far from all thresholds
+    min_interval: float     # seconds, the shortest adapted interval
+    max_interval: float     # seconds, the longest adapted interval
+    sun_rate: float         # degrees per hour, an upper bound on the sun's elevation change
+
+    def __init__(self, d: dict):
+        self.enabled = d['enabled'] if 'enabled' in d else False
+        self.near = float(d['near']) if 'near' in d else 0.1
+        self.far = float(d['far']) if 'far' in d else 0.5
+        self.fast = float(d['fast']) if 'fast' in d else 0.25
+        self.slow = float(d['slow']) if 'slow' in d else 2.0
+        self.min_interval = float(d['min-interval']) if 'min-interval' in d else 10.0
+        self.max_interval = float(d['max-interval']) if 'max-interval' in d else 600.0
+        self.sun_rate = float(d['sun-rate']) if 'sun-rate' in d else 15.0
 
 
 class Config:
@@ -108,6 +267,14 @@ class Config:
     database: DatabaseConfig
     location: LocationConfig
     server: ServerConfig
+    rollups: RollupsConfig
+    history: HistoryConfig
+    archive: ArchiveConfig
+    warm_start: WarmStartConfig
+    serial_manager: SerialManagerConfig
+    detection: DetectionConfig
+    health: HealthConfig
+    adaptive_polling: AdaptivePollingConfig
 
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
@@ -132,6 +299,15 @@ class Config:
         self.database = DatabaseConfig(self.toml['database'])
         self.server = ServerConfig(self.toml['server'])
         self.location = LocationConfig(self.toml['location'])
+        self.rollups = RollupsConfig(self.toml['rollups'] if 'rollups' in self.toml else {})
+        self.history = HistoryConfig(self.toml['history'] if 'history' in self.toml else {})
+        self.archive = ArchiveConfig(self.toml['archive'] if 'archive' in self.toml else {})
+        self.warm_start = WarmStartConfig(self.toml['warm-start'] if 'warm-start' in self.toml else {})
+        self.serial_manager = SerialManagerConfig(self.toml['serial'] if 'serial' in self.toml else {})
+        self.detection = DetectionConfig(self.toml['detection'] if 'detection' in self.toml else {})
+        self.health = HealthConfig(self.toml['health'] if 'health' in self.toml else {})
+        self.adaptive_polling = AdaptivePollingConfig(self.toml['adaptive-polling']
+                                                      if 'adaptive-polling' in self.toml else {})
 
         for name in list(self.toml['stations'].keys()):
             if 'serial' in self.toml['stations'][name]:
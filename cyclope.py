@@ -1,100 +1,209 @@
-from station import IPStation, StationReading
-import httpx
-import xml2dict
-from enum import Enum
-from typing import List
-import socket
+"""
+The Cyclope seeing monitor, via its TCP protocol:
+
+    server:  200                    (on connect)
+    client:  SysRequest <GetData>
+    server:  201
+             <IS_Valid=True>
+             <UTC_DateMeasurement=%1.7f>
+             <UTC_DateMeasurement_Readable=%s>
+             <LCL_DateMeasurement=%1.7f>
+             <LCL_DateMeasurement_Readable=%s>
+             <Last_ZenithArcsec=%1.2f>
+             <Last_R0Arcsec=%1.2f>
+           or
+             <IS_Valid=False>
+    client:  SysRequest <SysStatus>
+    server:  201
+             <State=Idle|1>         (Unknown|0, Idle|1, Idle (Day Time)|2, Seeking for star|3, Measuring|4, Star Lost|5)
+
+The replies are not length-prefixed, so a reply is read until its last expected field has arrived.
+"""
 import datetime
-
 import logging
+import re
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+from station import IPStation
+from config.config import make_cfg
+from db_access import make_db_manager, station_tables
 from init_log import init_log
-from sensor import SensorReading
+from utils import CyclopeDatum, CyclopeReading
 
 logger = logging.getLogger('cyclope')
 init_log(logger)
 
-
-class CyclopeDatum(str, Enum):
-    ZenithSeeing = "seeing_zenith"
-    R0 = "R0"
+StatusPattern = re.compile(r"^\s*(\d{3})\b")
+FieldPattern = re.compile(r"<\s*(\w+)\s*=\s*([^<>]*?)\s*>")
+DelphiEpoch = datetime.datetime(1899, 12, 30)
+
+# the fields that end a reply
+GetDataLast = {'Last_R0Arcsec', 'Last_R0Arcsed'}
+SysStatusLast = {'State'}
+
+
+def parse_reply(text: str) -> Tuple[Optional[int], Dict[str, str]]:
+    """
+    The status code and the <Key=Value> fields of a reply
+    """
+    m = StatusPattern.match(text)
+    return (int(m.group(1)) if m else None), {key: value for key, value in FieldPattern.findall(text)}
+
+
+def measurement_time(value: str) -> Optional[datetime.datetime]:
+    """
+    The UTC_DateMeasurement, either in days since 1899-12-30 (a Delphi TDateTime) or in seconds since the epoch
+    """
+    try:
+        t = float(value)
+    except ValueError:
+        return None
+    if t < 1e6:
+        return DelphiEpoch + datetime.timedelta(days=t)
+    return datetime.datetime.utcfromtimestamp(t)
+
+
+class CyclopeClient:
+    """
+    A persistent connection to the Cyclope server, with a buffered reader that frames the replies
+    """
+
+    def __init__(self, host: str, port: int, timeout: float):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+        self.buffer = b''
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        status, _ = self._read_reply(lambda status, fields: status is not None)
+        if status != 200:
+            raise Exception(f"expected greeting 200, got {status}")
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None
+
+    def _read_reply(self, is_complete) -> Tuple[Optional[int], Dict[str, str]]:
+        """
+        Reads until *is_complete(status, fields)*, leaves what follows the reply in the buffer
+
+        :raises TimeoutError: if the reply is not complete within the timeout
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            text = self.buffer.decode('utf-8', errors='replace')
+            status, fields = parse_reply(text)
+            if is_complete(status, fields):
+                # the reply ends after its last field (or, if it has none, its status line)
+                end = text.rfind('>') + 1 if fields else text.find('\n') + 1 or len(text)
+                self.buffer = text[end:].encode()
+                return status, fields
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"incomplete reply after {self.timeout} seconds: {text!r}")
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("connection closed by the server")
+            self.buffer += chunk
+
+    def request(self, command: str, last_fields: set) -> Dict[str, str]:
+        self.buffer = b''
+        self.sock.sendall(f"SysRequest <{command}>".encode())
+        status, fields = self._read_reply(
+            lambda status, fields: status is not None and (fields.get('IS_Valid') == 'False' or
+                                                           any(field in fields for field in last_fields)))
+        if status != 201:
+            raise Exception(f"'{command}': expected status 201, got {status}")
+        return fields
+
+    def get_data(self) -> Dict[str, str]:
+        return self.request('GetData', GetDataLast)
+
+    def get_status(self) -> Dict[str, str]:
+        return self.request('SysStatus', SysStatusLast)
 
 
 class Cyclope(IPStation):
+    """
+    Keeps a connection to the Cyclope server.  A failed exchange closes it, it is re-opened by the next
+     fetch (the **Station**'s health backs the fetches off while they fail).  A reading is pushed only
+     when there is a new valid measurement.
+    """
 
-    zenith_seeing: float
-    r0: float
-
-    def __init(self, name: str):
+    def __init__(self, name: str):
         super().__init__(name)
-
-    def datums(self) -> List[str]:
-        return list(CyclopeDatum.__members__.keys())
-
-    def fetcher(self):
+        cfg = make_cfg()
+        self.cfg = cfg.toml['stations'][name]
+        self.interval = cfg.station_settings[self.name].interval
+        self.db_manager = make_db_manager()
+        self.client = CyclopeClient(self.host, self.port,
+                                    timeout=self.cfg['timeout'] if 'timeout' in self.cfg else 5)
+        self.last_measurement: Optional[datetime.datetime] = None
+        self.state: Optional[str] = None
+
+    @classmethod
+    def datums(cls) -> List[str]:
+        return [item.value for item in CyclopeDatum]
+
+    def fetcher(self) -> bool:
+        try:
+            if not self.client.connected:
+                self.client.connect()
+                logger.info(f"connected to {self.address}")
+            data = self.client.get_data()
+            self.state = self.client.get_status().get('State')
+        except Exception:
+            self.client.close()
+            raise
+
+        if data.get('IS_Valid') != 'True':
+            logger.debug(f"no valid measurement (state: {self.state})")
+            return True
+
+        tstamp = measurement_time(data['UTC_DateMeasurement']) if 'UTC_DateMeasurement' in data else None
+        if tstamp is not None and tstamp == self.last_measurement:
+            return True     # not measured again since the last fetch
+        self.last_measurement = tstamp
+
+        reading = CyclopeReading()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.connect((self.host, self.port))
-
-                response = sock.recv(1024).decode()
-                if int(response) != 200:
-                    logger.error(f"Expected response 200, got '{response}'")
-                    return
-
-                sock.sendall(f"SysRequest <GetData>".encode())
-                response = sock.recv(1024).decode()
-                logger.debug(f"sent 'SysRequest <GetData>', got '{response}'")
-                if not response.startswith("201\n"):
-                    logger.error(f"sent 'SysRequest <GetData>', expected response 201, got '{response[0:2]}'")
-                    return
-                response = response[4:]
-                #                   Returns a list string  ->
-                #
-                #                   <IS_Valid=True>
-                #                   <UTC_DateMeasurement=%1.7f>
-                #                   <UTC_DateMeasurement_Readable=%s>
-                #                   <LCL_DateMeasurement=%1.7f>
-                #                   <LCL_DateMeasurement_Readable=%s>
-                #                   <Last_ZenithArcsec=%1.2f>
-                #                   <Last_R0Arcsed=%1.2f>
-                #
-                #                   or
-                #
-                #                   <IS_Valid=False>
-
-                sock.sendall("SysRequest <SysStatus>".encode())
-                response = sock.recv(1024).decode()
-                logger.debug(f"sent 'SysRequest <SysStatus>', got '{response}'")
-                if not response.startswith("201\n"):
-                    logger.error(f"sent 'SysRequest <SysStatus>', expected response 201, got '{response[0:2]}'")
-                    return
-                #           (*
-                #            <State=Unknown|0>'
-                #            <State=Idle|1>'
-                #            <State=Idle (Day Time)|2>'
-                #            <State=Seeking for star|3>'
-                #            <State=Measuring|4>'
-                #            <State=Star Lost|5>'
-                #           *)
-
-        except Exception as ex:
-            logger.error(f"['{self.host}':{self.port}], Exception: {ex}")
-        # reading = response
-        # self.zenith_seeing = float(reading['Last_ZenithArcsec'])
-        # self.r0 = float(reading['Last_R0Arcsec'])
-
-    def latest_readings(self, datum: str, n: int = 1) -> list:
-
-        sensor_reading = SensorReading()
-        sensor_reading.time =  datetime.utcnow()
-        if datum == CyclopeDatum.ZenithSeeing:
-            sensor_reading.value = self.zenith_seeing
-            return [sensor_reading]
-        elif datum == CyclopeDatum.R0:
-            sensor_reading.value = self.r0
-            return [sensor_reading]
-
-    def saver(self, reading: StationReading) -> None:
-        pass
-
-    def calculate_sensors(self):
-        pass
\ No newline at end of file
+            reading.datums[CyclopeDatum.ZenithSeeing] = float(data['Last_ZenithArcsec'])
+            r0 = data['Last_R0Arcsec'] if 'Last_R0Arcsec' in data else data['Last_R0Arcsed']
+            reading.datums[CyclopeDatum.R0] = float(r0)
+        except (KeyError, ValueError) as ex:
+            raise Exception(f"bad measurement {data} ({ex})")
+        reading.tstamp = tstamp if tstamp is not None else datetime.datetime.utcnow()
+        self.push_reading(reading)
+        return True
+
+    def saver(self, reading: CyclopeReading) -> None:
+        if self.name in station_tables:
+            self.db_manager.insert_reading(self.name, reading)
+
+    def stop(self):
+        super().stop()
+        self.client.close()
+
+    def streaming_status(self) -> dict:
+        return {
+            'connected': self.client.connected,
+            'state': self.state,
+            'last_measurement': self.last_measurement.isoformat() if self.last_measurement else None,
+        }
@@ -1,11 +1,18 @@
-from typing import Optional
+import datetime
+import logging
+import re
+import threading
+import time
+from typing import Optional, Callable, Any, List, Tuple, Dict, NamedTuple, Iterator
 
-from sqlalchemy import create_engine, MetaData, Engine
+from sqlalchemy import create_engine, MetaData, Engine, text, insert
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.automap import automap_base
-# from sqlalchemy.orm import Session
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 from config.config import make_cfg
+from init_log import init_log
 from utils import VantageProReading, VantageProDatum
 from utils import InsideArduinoReading, InsideArduinoDatum
 from utils import OutsideArduinoReading, OutsideArduinoDatum
@@ -17,11 +24,161 @@ ArduinoInDbClass = None
 ArduinoOutDbClass = None
 TessWDbClass = None
 
+logger = logging.getLogger('db')
+init_log(logger)
+
+
+class StationTable(NamedTuple):
+    table: str
+    columns: Dict[str, str]     # datum name -> column name
+
+
+# The tables in which the stations' readings are stored, and which datum goes into which column
+station_tables: Dict[str, StationTable] = {
+    'davis': StationTable('davis', {
+        VantageProDatum.InsideTemperature.value: 'temp_in',
+        VantageProDatum.InsideHumidity.value: 'humidity_in',
+        VantageProDatum.Barometer.value: 'pressure_out',
+        VantageProDatum.OutsideTemperature.value: 'temp_out',
+        VantageProDatum.OutSideHumidity.value: 'humidity_out',
+        VantageProDatum.WindSpeed.value: 'wind_speed',
+        VantageProDatum.WindDirection.value: 'wind_direction',
+        VantageProDatum.RainRate.value: 'rain',
+        VantageProDatum.SolarRadiation.value: 'solar_radiation',
+    }),
+    'inside-arduino': StationTable('arduino_in', {
+        InsideArduinoDatum.Presence.value: 'presence',
+        InsideArduinoDatum.TemperatureIn.value: 'temp_in',
+        InsideArduinoDatum.PressureIn.value: 'pressure_in',
+        InsideArduinoDatum.VisibleLuxIn.value: 'visible_lux_in',
+        InsideArduinoDatum.Flame.value: 'flame',
+        InsideArduinoDatum.CO2.value: 'co2',
+        InsideArduinoDatum.VOC.value: 'voc',
+        InsideArduinoDatum.RawH2.value: 'raw_h2',
+        InsideArduinoDatum.RawEthanol.value: 'raw_ethanol',
+    }),
+    'outside-arduino': StationTable('arduino_out', {
+        OutsideArduinoDatum.TemperatureOut.value: 'temp_out',
+        OutsideArduinoDatum.HumidityOut.value: 'humidity_out',
+        OutsideArduinoDatum.PressureOut.value: 'pressure_out',
+        OutsideArduinoDatum.DewPoint.value: 'dew_point',
+        OutsideArduinoDatum.VisibleLuxOut.value: 'visible_lux_out',
+        OutsideArduinoDatum.IrLuminosity.value: 'ir_luminosity',
+        OutsideArduinoDatum.WindSpeed.value: 'wind_speed',
+        OutsideArduinoDatum.WindDirection.value: 'wind_direction',
+    }),
+    'tessw': StationTable('tessw', {
+        TessWDatum.CloudCover.value: 'cover',
+    }),
+}
+
+
+class DatabaseUnavailable(Exception):
+    """
+    Raised instead of touching the database while the circuit breaker is open
+    """
+    pass
+
+
+class CircuitBreaker:
+    """
+    Keeps the **Stations** from hanging on (or hammering) a database that is not responding.
+
+    * closed:    calls go through, consecutive connectivity failures are counted
+    * open:      after *max_failures* consecutive failures, calls are refused for *probe_interval* seconds
+    * half-open: a single probe call is let through, its outcome either closes or re-opens the breaker
+    """
+    Closed = "closed"
+    Open = "open"
+    HalfOpen = "half-open"
+
+    def __init__(self, max_failures: int, probe_interval: float):
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+        self.state: str = CircuitBreaker.Closed
+        self.consecutive_failures: int = 0
+        self.total_failures: int = 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.last_failure: Optional[datetime.datetime] = None
+        self.last_success: Optional[datetime.datetime] = None
+        self.recoveries: int = 0    # times the breaker closed again
+
+    def allow(self) -> bool:
+        """
+        Should a database call be attempted now?
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.Closed:
+                return True
+            if self.state == CircuitBreaker.Open and time.monotonic() - self.opened_at >= self.probe_interval:
+                self.state = CircuitBreaker.HalfOpen
+                logger.info("database circuit breaker is half-open, probing")
+                return True
+            return False    # open, or half-open with a probe already in flight
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CircuitBreaker.Closed:
+                logger.info(f"database circuit breaker closed (after {self.consecutive_failures} failures)")
+                self.recoveries += 1
+            self.state = CircuitBreaker.Closed
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.last_success = datetime.datetime.utcnow()
+
+    def abandon(self):
+        """
+        A call that was let through ended without an outcome (e.g. a closed generator), if it was
+         the half-open probe, the next call probes again
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.HalfOpen:
+                self.state = CircuitBreaker.Open
+
+    def record_failure(self, ex: Exception):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self.last_error = f"{type(ex).__name__}: {ex}".splitlines()[0]
+            self.last_failure = datetime.datetime.utcnow()
+            if self.state == CircuitBreaker.HalfOpen or self.consecutive_failures >= self.max_failures:
+                if self.state == CircuitBreaker.Closed:
+                    logger.warning(f"database circuit breaker opened after {self.consecutive_failures} " +
+                                   f"consecutive failures (last: {self.last_error}), " +
+                                   f"probing every {self.probe_interval} seconds")
+                self.state = CircuitBreaker.Open
+                self.opened_at = time.monotonic()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'total_failures': self.total_failures,
+                'last_error': self.last_error,
+                'last_failure': self.last_failure,
+                'last_success': self.last_success,
+                'recoveries': self.recoveries,
+            }
+
+
+def month_start(d: datetime.date, offset: int = 0) -> datetime.date:
+    """
+    The first day of the month *offset* months away from the one containing *d*
+    """
+    months = d.year * 12 + d.month - 1 + offset
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
 
 class DbManager:
     _instance = None
     _initialized = False
 
+    # the station tables, partitioned by month on 'tstamp'
+    PartitionedTables = ['davis', 'arduino_in', 'arduino_out', 'tessw']
+
     def __new__(cls, *args, **kwargs):
         if cls._instance is None:
             cls._instance = super(DbManager, cls).__new__(cls)
@@ -33,8 +190,12 @@ class DbManager:
 
         cfg = make_cfg()
         conf = cfg.database
+        self.conf = conf
         self.schema = conf.schema
         self.url = f"postgresql://{conf.user}:{conf.password}@{conf.host}/{conf.name}"
+        self.breaker = CircuitBreaker(max_failures=conf.breaker_failures,
+                                      probe_interval=conf.breaker_probe_interval)
+        self.reflected = False
 
         # self.session: Optional[Session] = None
         self.session_factory = None
@@ -48,11 +209,39 @@ class DbManager:
         self._initialized = True
 
     def connect(self):
-        global Base, DavisDbClass, ArduinoInDbClass, ArduinoOutDbClass, TessWDbClass
+        """
+        Creates the engine and tries to reflect the schema.
 
-        self.engine = create_engine(self.url, echo=False)
+        Every connection is bounded (connect, statement and pool timeouts, TCP keepalives) and checked
+         before use, so a hung server costs a **Station** seconds, not forever.  If the database is not
+         reachable the daemon still starts, the reflection is retried by the circuit breaker's probes.
+        """
+        conf = self.conf
+        self.engine = create_engine(
+            self.url,
+            echo=False,
+            pool_pre_ping=True,
+            pool_timeout=conf.pool_timeout,
+            pool_recycle=1800,
+            connect_args={
+                'connect_timeout': conf.connect_timeout,
+                'options': f"-c statement_timeout={int(conf.statement_timeout * 1000)}",
+                'keepalives': 1,
+                'keepalives_idle': conf.keepalive_idle,
+                'keepalives_interval': max(1, conf.keepalive_idle // 2),
+                'keepalives_count': 3,
+            },
+        )
         self.session_factory = sessionmaker(bind=self.engine)
 
+        try:
+            self.run(lambda session: None)
+        except Exception as ex:
+            logger.error(f"could not connect to the database at startup ({ex}), will keep probing")
+
+    def reflect(self):
+        global Base, DavisDbClass, ArduinoInDbClass, ArduinoOutDbClass, TessWDbClass
+
         Base = automap_base()
         Base.prepare(autoload_with=self.engine, schema=self.schema)
 
@@ -60,6 +249,280 @@ class DbManager:
         ArduinoInDbClass = Base.classes.arduino_in
         ArduinoOutDbClass = Base.classes.arduino_out
         TessWDbClass = Base.classes.tessw
+        self.Base = Base
+        self.reflected = True
+
+    def run(self, work: Callable[[Session], Any]) -> Any:
+        """
+        Runs *work* in a session of its own and commits it, through the circuit breaker.
+
+        :param work: gets the session, its return value is returned
+        :raises DatabaseUnavailable: if the circuit breaker is open
+        """
+        if self.engine is None or not self.breaker.allow():
+            raise DatabaseUnavailable(f"database circuit breaker is {self.breaker.state}")
+
+        try:
+            if not self.reflected:
+                self.reflect()
+
+            Session = scoped_session(self.session_factory)
+            session = Session()
+            try:
+                result = work(session)
+                session.commit()
+            except:
+                session.rollback()
+                raise
+            finally:
+                Session.remove()
+        except (OperationalError, InterfaceError, PoolTimeoutError) as ex:
+            self.breaker.record_failure(ex)
+            raise
+        except Exception:
+            # the database answered, it's the request that failed
+            self.breaker.record_success()
+            raise
+
+        self.breaker.record_success()
+        return result
+
+    def stream(self, statement, params: dict, chunk_rows: int) -> Iterator[list]:
+        """
+        Runs a query on a server-side cursor, through the circuit breaker, yielding its rows in chunks
+         of *chunk_rows*, so that huge results are read in constant memory.
+
+        :raises DatabaseUnavailable: if the circuit breaker is open
+        """
+        if self.engine is None or not self.breaker.allow():
+            raise DatabaseUnavailable(f"database circuit breaker is {self.breaker.state}")
+
+        recorded = False
+        try:
+            with self.engine.connect() as connection:
+                result = connection.execution_options(stream_results=True, yield_per=chunk_rows).execute(
+                    statement, params)
+                self.breaker.record_success()
+                recorded = True
+                for chunk in result.partitions(chunk_rows):
+                    yield chunk
+        except (OperationalError, InterfaceError, PoolTimeoutError) as ex:
+            self.breaker.record_failure(ex)
+            recorded = True
+            raise
+        except Exception:
+            # the database answered, it's the request that failed
+            if not recorded:
+                self.breaker.record_success()
+                recorded = True
+            raise
+        finally:
+            if not recorded:
+                # e.g. closed (GeneratorExit) before the query completed
+                self.breaker.abandon()
+
+    def insert(self, table: str, **columns) -> bool:
+        """
+        Inserts one row into *table*.
+
+        :return: False if the row was dropped because the database is unavailable
+        """
+        try:
+            self.run(lambda session: session.add(getattr(Base.classes, table)(**columns)))
+        except DatabaseUnavailable as ex:
+            logger.debug(f"dropped a '{table}' row: {ex}")
+            return False
+        except (OperationalError, InterfaceError, PoolTimeoutError) as ex:
+            logger.warning(f"dropped a '{table}' row: {type(ex).__name__}: {str(ex).splitlines()[0]}")
+            return False
+        return True
+
+    def insert_many(self, table: str, rows: List[dict]) -> bool:
+        """
+        Inserts many rows into *table*, in a single executemany
+
+        :return: False if the rows were dropped because the database is unavailable
+        """
+        if not rows:
+            return True
+        try:
+            self.run(lambda session: session.execute(insert(getattr(Base.classes, table).__table__), rows))
+        except DatabaseUnavailable as ex:
+            logger.debug(f"dropped {len(rows)} '{table}' rows: {ex}")
+            return False
+        except (OperationalError, InterfaceError, PoolTimeoutError) as ex:
+            logger.warning(f"dropped {len(rows)} '{table}' rows: {type(ex).__name__}: {str(ex).splitlines()[0]}")
+            return False
+        return True
+
+    def insert_reading(self, station: str, reading) -> bool:
+        """
+        Inserts a **Station**'s reading into its table (as per *station_tables*)
+        """
+        table = station_tables[station]
+        columns = {column: reading.datums.get(datum) for datum, column in table.columns.items()}
+        return self.insert(table.table, tstamp=reading.tstamp, **columns)
+
+    def status(self) -> dict:
+        return {
+            'host': self.conf.host,
+            'name': self.conf.name,
+            'schema': self.schema,
+            'reflected': self.reflected,
+            'breaker': self.breaker.status(),
+        }
+
+    def qualified(self, name: str) -> str:
+        return f'"{self.schema}"."{name}"'
+
+    @staticmethod
+    def partition_name(table: str, month: datetime.date) -> str:
+        return f"{table}_y{month.year:04d}m{month.month:02d}"
+
+    def is_partitioned(self, session: Session, table: str) -> bool:
+        return session.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p" +
+            " JOIN pg_class c ON c.oid = p.partrelid JOIN pg_namespace n ON n.oid = c.relnamespace" +
+            " WHERE n.nspname = :schema AND c.relname = :table)"),
+            {'schema': self.schema, 'table': table}).scalar()
+
+    def list_partitions(self, session: Session, table: str) -> List[Tuple[str, Optional[datetime.date]]]:
+        """
+        The partitions of *table*, with their (exclusive) upper bounds.  The bound is None for
+         partitions that are not bounded above (DEFAULT or TO (MAXVALUE)).
+        """
+        rows = session.execute(text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i" +
+            " JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent" +
+            " JOIN pg_namespace n ON n.oid = p.relnamespace" +
+            " WHERE n.nspname = :schema AND p.relname = :table ORDER BY c.relname"),
+            {'schema': self.schema, 'table': table}).all()
+
+        ret = []
+        for name, bound in rows:
+            upper = None
+            m = re.search(r"TO \('(\d{4}-\d{2}-\d{2})", bound or "")
+            if m:
+                upper = datetime.date.fromisoformat(m.group(1))
+            ret.append((name, upper))
+        return ret
+
+    def convert_to_partitioned(self, session: Session, table: str):
+        """
+        Turns *table* into a table partitioned by month on 'tstamp'.
+
+        The existing table becomes a single partition (renamed *table*_unpartitioned) covering everything
+         up to the end of the current month, so no rows are moved.  The primary key is extended with
+         'tstamp' (as required for partitioned tables) and an index on 'tstamp' is created.
+        """
+        legacy = f"{table}_unpartitioned"
+        qualified, qualified_legacy = self.qualified(table), self.qualified(legacy)
+        session.execute(text("SET LOCAL statement_timeout = 0"))
+
+        pk = session.execute(text(
+            "SELECT con.conname, array_agg(a.attname::text ORDER BY a.attnum) FROM pg_constraint con" +
+            " JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = ANY(con.conkey)" +
+            " WHERE con.conrelid = CAST(:table AS regclass) AND con.contype = 'p' GROUP BY con.conname"),
+            {'table': qualified}).first()
+        sequences = session.execute(text(
+            "SELECT column_name, pg_get_serial_sequence(:table, column_name) FROM information_schema.columns" +
+            " WHERE table_schema = :schema AND table_name = :name"),
+            {'table': qualified, 'schema': self.schema, 'name': table}).all()
+        latest = session.execute(text(f"SELECT max(tstamp) FROM {qualified}")).scalar()
+        upper = month_start(max(latest.date() if latest else datetime.date.min, datetime.date.today()), 1)
+
+        pk_columns = [c for c in (pk[1] if pk else []) if c != 'tstamp'] + ['tstamp']
+
+        session.execute(text(f"ALTER TABLE {qualified} RENAME TO \"{legacy}\""))
+        if pk:
+            session.execute(text(f"ALTER TABLE {qualified_legacy} RENAME CONSTRAINT \"{pk[0]}\" TO \"{legacy}_pkey\""))
+        session.execute(text(f"ALTER TABLE {qualified_legacy} ALTER COLUMN tstamp SET NOT NULL"))
+        session.execute(text(f"CREATE TABLE {qualified} (LIKE {qualified_legacy} INCLUDING DEFAULTS)" +
+                             " PARTITION BY RANGE (tstamp)"))
+        session.execute(text(f"ALTER TABLE {qualified} ADD PRIMARY KEY ({', '.join(pk_columns)})"))
+        session.execute(text(f"CREATE INDEX \"{table}_tstamp_idx\" ON {qualified} (tstamp)"))
+        for column, sequence in sequences:
+            if sequence is not None:
+                # otherwise dropping the legacy partition would drop the sequence too
+                session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {qualified}.\"{column}\""))
+        session.execute(text(f"ALTER TABLE {qualified} ATTACH PARTITION {qualified_legacy}" +
+                             f" FOR VALUES FROM (MINVALUE) TO ('{upper.isoformat()}')"))
+        logger.info(f"converted '{table}' to a partitioned table ('{legacy}' holds rows before {upper})")
+
+    def ensure_partitions(self, session: Session, table: str, months_ahead: int) -> List[str]:
+        """
+        Creates the monthly partitions of *table* from the current month to *months_ahead* months ahead.
+        A table that is not partitioned is left alone, but a missing 'tstamp' index is reported: building it
+         on a large table does not fit the statement timeout (nor a startup), it is left to a migration.
+
+        :return: the names of the created partitions
+        """
+        if not self.is_partitioned(session, table):
+            indexed = session.execute(text(
+                "SELECT EXISTS (SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indrelid" +
+                " JOIN pg_namespace n ON n.oid = c.relnamespace JOIN pg_attribute a" +
+                " ON a.attrelid = c.oid AND a.attnum = i.indkey[0]" +
+                " WHERE n.nspname = :schema AND c.relname = :table AND a.attname = 'tstamp')"),
+                {'schema': self.schema, 'table': table}).scalar()
+            if not indexed:
+                logger.warning(f"table '{table}' has no index on 'tstamp', consider running: CREATE INDEX " +
+                               f"CONCURRENTLY \"{table}_tstamp_idx\" ON {self.qualified(table)} (tstamp)")
+            return []
+
+        existing = self.list_partitions(session, table)
+        covered = max([upper for _, upper in existing if upper is not None], default=None)
+        this_month = month_start(datetime.date.today())
+
+        created = []
+        for offset in range(months_ahead + 1):
+            start = month_start(this_month, offset)
+            if covered is not None and start < covered:
+                continue
+            name = DbManager.partition_name(table, start)
+            session.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {self.qualified(name)} PARTITION OF {self.qualified(table)}" +
+                f" FOR VALUES FROM ('{start.isoformat()}') TO ('{month_start(start, 1).isoformat()}')"))
+            created.append(name)
+        return created
+
+    def expire_partitions(self, session: Session, table: str, retention_months: int, drop: bool) -> List[str]:
+        """
+        Detaches (and optionally drops) the partitions of *table* that end before the retention horizon.
+
+        :return: the names of the expired partitions
+        """
+        if retention_months <= 0 or not self.is_partitioned(session, table):
+            return []
+
+        horizon = month_start(datetime.date.today(), -retention_months)
+        expired = []
+        for name, upper in self.list_partitions(session, table):
+            if upper is None or upper > horizon:
+                continue
+            session.execute(text(f"ALTER TABLE {self.qualified(table)} DETACH PARTITION {self.qualified(name)}"))
+            if drop:
+                session.execute(text(f"DROP TABLE {self.qualified(name)}"))
+            expired.append(name)
+        return expired
+
+    def maintain_partitions(self):
+        """
+        Creates upcoming partitions and expires old ones, as per the [database.partitions] configuration.
+        Called daily by the daemon.
+        """
+        conf = self.conf.partitions
+        for table in DbManager.PartitionedTables:
+            try:
+                created = self.run(lambda session: self.ensure_partitions(session, table, conf.months_ahead))
+                expired = self.run(lambda session: self.expire_partitions(session, table, conf.retention_months,
+                                                                          conf.drop_detached))
+            except Exception as ex:
+                logger.error(f"could not maintain the partitions of '{table}': {ex}")
+                continue
+            if created:
+                logger.info(f"'{table}': created partitions {created}")
+            if expired:
+                logger.info(f"'{table}': {'dropped' if conf.drop_detached else 'detached'} partitions {expired}")
 
     def disconnect(self):
         if self.engine is not None:
@@ -135,3 +598,38 @@ class DbManager:
 
 def make_db_manager():
     return DbManager()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Database schema management")
+    parser.add_argument('--url', help="overrides the configured database (e.g. a local test database)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    partitions_parser = subparsers.add_parser('partitions', help="maintain the monthly partitions")
+    partitions_parser.add_argument('--convert', action='store_true',
+                                   help="convert the unpartitioned station tables first")
+    partitions_parser.add_argument('--months-ahead', type=int)
+    partitions_parser.add_argument('--retention-months', type=int)
+    partitions_parser.add_argument('--drop', action='store_true', help="drop, rather than detach, expired partitions")
+    args = parser.parse_args()
+
+    manager = make_db_manager()
+    if args.url:
+        manager.url = args.url
+    manager.connect()
+
+    if args.command == 'partitions':
+        if args.months_ahead is not None:
+            manager.conf.partitions.months_ahead = args.months_ahead
+        if args.retention_months is not None:
+            manager.conf.partitions.retention_months = args.retention_months
+        if args.drop:
+            manager.conf.partitions.drop_detached = True
+        if args.convert:
+            for name in DbManager.PartitionedTables:
+                if not manager.run(lambda session: manager.is_partitioned(session, name)):
+                    manager.run(lambda session: manager.convert_to_partitioned(session, name))
+        manager.maintain_partitions()
+        for name in DbManager.PartitionedTables:
+            print(f"{name}: {manager.run(lambda session: manager.list_partitions(session, name))}")
@@ -0,0 +1,144 @@
+"""
+Detection of the serial stations' ports.
+
+All the ports are probed concurrently, each with the probes of all the stations still to be found (grouped
+ by baud rate, so a port is opened once per baud rate).  The results are cached, keyed by the ports'
+ /dev/serial/by-id identities (stable across reboots and re-plugging), and the next startup first just
+ validates the cached mapping, again concurrently.
+"""
+import glob
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import serial
+
+from config.config import make_cfg
+from init_log import init_log
+
+logger = logging.getLogger('detection')
+init_log(logger)
+
+ById = '/dev/serial/by-id'
+
+
+def port_identities() -> Dict[str, str]:
+    """
+    device => identity: the port's /dev/serial/by-id name, if it has one, otherwise its device path
+    """
+    identities = {}
+    for link in glob.glob(os.path.join(ById, '*')):
+        identities[os.path.realpath(link)] = os.path.basename(link)
+    return identities
+
+
+def identity_to_device(identity: str) -> str:
+    path = os.path.join(ById, identity)
+    return os.path.realpath(path) if os.path.exists(path) else identity
+
+
+def load_cache(filename: str) -> Dict[str, str]:
+    if not filename or not os.path.exists(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except Exception as ex:
+        logger.warning(f"ignoring the detection cache '{filename}' ({ex})")
+        return {}
+
+
+def save_cache(filename: str, mapping: Dict[str, str]):
+    if not filename:
+        return
+    try:
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(mapping, f, indent=2)
+        os.replace(filename + '.tmp', filename)
+    except Exception as ex:
+        logger.warning(f"could not save the detection cache '{filename}' ({ex})")
+
+
+def probe_port(device: str, stations: list, timeout: float) -> Optional[str]:
+    """
+    Probes one port for the given stations, opening it once per baud rate
+
+    :return: The name of the station found on the port, if any
+    """
+    bauds = sorted({station.baud for station in stations})
+    for baud in bauds:
+        candidates = [station for station in stations if station.baud == baud]
+        try:
+            with serial.Serial(port=device, baudrate=baud, timeout=timeout, write_timeout=timeout) as ser:
+                delay = max([station.open_delay for station in candidates])
+                if delay:
+                    time.sleep(delay)   # e.g. an Arduino resets when the port is opened
+                for station in candidates:
+                    try:
+                        ser.reset_input_buffer()
+                        if station.probe(ser):
+                            logger.info(f"Detected station '{station.name}' on '{device}' at {baud} baud")
+                            return station.name
+                    except Exception as ex:
+                        logger.debug(f"'{device}' at {baud} baud: probe for '{station.name}' failed ({ex})")
+        except Exception as ex:
+            logger.debug(f"could not open '{device}' at {baud} baud ({ex})")
+    return None
+
+
+def detect_stations(stations: list, devices: List[str]):
+    """
+    Sets the *port* of each of the *stations* (which have a *probe(ser)* method) found on one of the *devices*.
+     The stations that are not found keep their configured port.
+    """
+    conf = make_cfg().detection
+    if not stations:
+        return
+
+    identities = port_identities()
+    cache = load_cache(conf.cache_file)
+    by_name = {station.name: station for station in stations}
+    found: Dict[str, str] = {}  # station => device
+
+    def probe_all(assignments: Dict[str, list]) -> Dict[str, Optional[str]]:
+        with ThreadPoolExecutor(max_workers=max(1, len(assignments))) as pool:
+            futures = {device: pool.submit(probe_port, device, candidates, conf.timeout)
+                       for device, candidates in assignments.items()}
+            return {device: future.result() for device, future in futures.items()}
+
+    # validate the cached mapping
+    start = time.monotonic()
+    assignments = {}
+    for identity, name in cache.items():
+        device = identity_to_device(identity)
+        if name in by_name and device in devices:
+            assignments[device] = [by_name[name]]
+    for device, name in probe_all(assignments).items():
+        if name is not None:
+            found[name] = device
+
+    # probe the remaining ports for the remaining stations
+    missing = [station for station in stations if station.name not in found]
+    remaining = [device for device in devices if device not in found.values()]
+    if missing and remaining:
+        for device, name in probe_all({device: missing for device in remaining}).items():
+            if name is None:
+                continue
+            if name in found:
+                logger.warning(f"station '{name}' was detected on both '{found[name]}' and '{device}', " +
+                               f"using '{found[name]}'")
+                continue
+            found[name] = device
+
+    for name, device in found.items():
+        by_name[name].port = device
+    for station in stations:
+        if station.name not in found:
+            logger.warning(f"station '{station.name}' was not detected, using the configured '{station.port}'")
+    logger.info(f"detection took {time.monotonic() - start:.1f} seconds: {found}")
+
+    save_cache(conf.cache_file, {identities.get(device, device): name for name, device in found.items()})
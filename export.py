@@ -0,0 +1,123 @@
+import csv
+import datetime
+import io
+from typing import Iterator, List, Optional
+
+from sqlalchemy import text
+
+from db_access import make_db_manager, station_tables
+from utils import isoformat_zulu
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ChunkRows = 10000   # rows fetched (and sent) at a time
+
+
+class ExportFormat:
+    Csv = 'csv'
+    Parquet = 'parquet'
+
+    media_types = {
+        Csv: 'text/csv',
+        Parquet: 'application/vnd.apache.parquet',
+    }
+
+
+def parquet_supported() -> bool:
+    return pyarrow is not None
+
+
+def export_columns(station: str, datums: Optional[List[str]] = None) -> List[str]:
+    """
+    The exported columns: 'tstamp' and the station's stored *datums* (default: all of them)
+    """
+    return ['tstamp'] + (datums if datums else list(station_tables[station].columns.keys()))
+
+
+def missing_columns(station: str, datums: Optional[List[str]] = None) -> List[str]:
+    """
+    The columns of the station's *datums* that its table lacks (all of them if there is no such table)
+    """
+    db_manager = make_db_manager()
+    table = station_tables[station]
+    existing = db_manager.run(lambda session: set(session.execute(
+        text("SELECT column_name FROM information_schema.columns WHERE table_schema = :schema AND table_name = :table"),
+        {'schema': db_manager.schema, 'table': table.table}).scalars()))
+    return [table.columns[datum] for datum in export_columns(station, datums)[1:] if table.columns[datum] not in existing]
+
+
+def export_rows(station: str, start: datetime.datetime, end: datetime.datetime,
+                datums: Optional[List[str]] = None) -> Iterator[list]:
+    """
+    The station's rows between *start* and *end*, in chunks of *ChunkRows*, read with a server-side cursor
+    """
+    db_manager = make_db_manager()
+    table = station_tables[station]
+    columns = ", ".join([f'"{table.columns[datum]}"' for datum in export_columns(station, datums)[1:]])
+    statement = text(f'SELECT tstamp, {columns} FROM "{db_manager.schema}"."{table.table}"' +
+                     " WHERE tstamp >= :start AND tstamp < :end ORDER BY tstamp")
+    return db_manager.stream(statement, {'start': start, 'end': end}, ChunkRows)
+
+
+def csv_chunks(station: str, chunks: Iterator[list], datums: Optional[List[str]] = None) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export_columns(station, datums))
+    for chunk in chunks:
+        writer.writerows([(isoformat_zulu(row[0]),) + tuple(row[1:]) for row in chunk])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+class _Drain(io.RawIOBase):
+    """
+    A write-only file that hands out what was written to it since the last take().
+    Parquet needs the real file offsets, hence the position is kept separately.
+    """
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_chunks(station: str, chunks: Iterator[list], datums: Optional[List[str]] = None) -> Iterator[bytes]:
+    """
+    One parquet row-group per chunk
+    """
+    columns = export_columns(station, datums)
+    schema = pyarrow.schema([pyarrow.field('tstamp', pyarrow.timestamp('us'))] +
+                            [pyarrow.field(column, pyarrow.float64()) for column in columns[1:]])
+    sink = _Drain()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for chunk in chunks:
+        tstamps, *values = zip(*chunk)
+        arrays = [pyarrow.array(tstamps, type=schema.field(0).type)]
+        arrays += [pyarrow.array([None if v is None else float(v) for v in column], type=pyarrow.float64())
+                   for column in values]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
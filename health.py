@@ -0,0 +1,93 @@
+import datetime
+import logging
+import random
+from typing import Optional
+
+from config.config import make_cfg
+from init_log import init_log
+
+logger = logging.getLogger('health')
+init_log(logger)
+
+
+class StationHealth:
+    """
+    Tracks a **Station**'s fetch outcomes.
+
+    * After consecutive failures the fetches are spaced out exponentially (with jitter, so stations
+       sharing a failed resource do not retry in lockstep), up to *max_backoff*.  The first success
+       resumes the normal cadence.  Failures of a resource that backs off by itself (a serial port, see
+       **SerialPort**) are counted but do not space the fetches out, that resource's backoff is in charge.
+    * Only the first failure of a streak is logged with its traceback, the following ones in one line.
+    * The *score* is an exponentially weighted moving average of the outcomes (1 - success, 0 - failure).
+    """
+
+    def __init__(self, station: str):
+        conf = make_cfg().health
+        self.station = station
+        self.max_backoff = conf.max_backoff
+        self.jitter = conf.jitter
+        self.alpha = conf.score_alpha
+
+        self.score = 1.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.backoff_failures = 0       # the consecutive failures that space the fetches out
+        self.last_success: Optional[datetime.datetime] = None
+        self.last_failure: Optional[datetime.datetime] = None
+        self.last_error: Optional[str] = None
+        self.backoff: float = 0.0
+
+    def succeeded(self):
+        if self.consecutive_failures:
+            logger.info(f"station '{self.station}': recovered after {self.consecutive_failures} failures")
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.backoff_failures = 0
+        self.backoff = 0.0
+        self.score = (1 - self.alpha) * self.score + self.alpha
+        self.last_success = datetime.datetime.utcnow()
+
+    def failed(self, error: Optional[Exception] = None, back_off: bool = True):
+        """
+        :param back_off: False if the failed resource backs off by itself
+        """
+        self.failures += 1
+        self.consecutive_failures += 1
+        if back_off:
+            self.backoff_failures += 1
+        self.score = (1 - self.alpha) * self.score
+        self.last_failure = datetime.datetime.utcnow()
+        if error is not None:
+            self.last_error = f"{type(error).__name__}: {error}"
+
+        if self.consecutive_failures == 1:
+            logger.error(f"station '{self.station}': fetch failed", exc_info=error)
+        else:
+            logger.warning(f"station '{self.station}': fetch failed {self.consecutive_failures} times in a row" +
+                           (f" ({self.last_error})" if self.last_error else ""))
+
+    def delay(self, interval: float) -> float:
+        """
+        Seconds until the next fetch, given the normal *interval*
+        """
+        if self.backoff_failures == 0:
+            self.backoff = 0.0
+            return interval
+        longest = max(self.max_backoff, interval)
+        backoff = min(interval * 2 ** (self.backoff_failures - 1), longest)
+        self.backoff = min(backoff * random.uniform(1 - self.jitter, 1 + self.jitter), longest)
+        return self.backoff
+
+    def status(self) -> dict:
+        return {
+            'score': round(self.score, 3),
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'backoff': round(self.backoff, 1),
+            'last_success': self.last_success.isoformat() if self.last_success else None,
+            'last_failure': self.last_failure.isoformat() if self.last_failure else None,
+            'last_error': self.last_error,
+        }
@@ -0,0 +1,167 @@
+import datetime
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, List
+
+from sqlalchemy import text
+
+from config.config import make_cfg
+from db_access import make_db_manager, station_tables
+from rollup import Minute, Hour, Epoch
+from utils import isoformat_zulu
+
+# bucket sizes [seconds] the answers are aligned to, so that similar requests share cache entries
+BucketSizes = [1, 2, 5, 10, 15, 30,
+               60, 2 * 60, 5 * 60, 10 * 60, 15 * 60, 30 * 60,
+               3600, 2 * 3600, 3 * 3600, 6 * 3600, 12 * 3600,
+               86400, 2 * 86400, 7 * 86400, 14 * 86400, 30 * 86400]
+
+
+def _seconds(t: datetime.datetime) -> int:
+    return int((t - Epoch).total_seconds())
+
+
+def choose_bucket(start: datetime.datetime, end: datetime.datetime, points: int) -> int:
+    """
+    The smallest bucket size for which [start, end), aligned to buckets, has at most *points* buckets
+    """
+    s, e = _seconds(start), _seconds(end)
+    for size in BucketSizes:
+        if -(-e // size) - (s // size) <= points:
+            return size
+
+    largest = BucketSizes[-1]
+    size = largest * math.ceil((e - s) / (largest * points))
+    while -(-e // size) - (s // size) > points:
+        size += largest
+    return size
+
+
+class DatumNotStored(Exception):
+    pass
+
+
+def choose_source(station: str, datum: str, bucket: int) -> str:
+    """
+    The coarsest table the buckets can be aggregated from: the hourly or per-minute rollups, or the raw rows
+
+    :raises DatumNotStored: if the datum has no raw column and the rollups are not maintained
+    """
+    rollups = make_cfg().rollups.enabled
+    if rollups:
+        if bucket % Hour.seconds == 0:
+            return Hour.table
+        if bucket % Minute.seconds == 0:
+            return Minute.table
+    if station in station_tables and datum in station_tables[station].columns:
+        return 'raw'
+    if rollups:
+        return Minute.table
+    raise DatumNotStored(f"datum '{datum}' of station '{station}' is not stored (no column, rollups disabled)")
+
+
+class HistoryCache:
+    """
+    A small LRU cache of /history answers.  Answers that include the current bucket expire quickly,
+     the others are kept for an hour (e.g. in case of a rollup backfill).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: tuple, value: dict, ttl: float):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+cache = HistoryCache(make_cfg().history.cache_size)
+
+
+def naive_utc(t: datetime.datetime) -> datetime.datetime:
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return t
+
+
+def _query(station: str, datum: str, source: str, start: datetime.datetime, end: datetime.datetime,
+           bucket: int) -> List[Tuple]:
+    db_manager = make_db_manager()
+    schema = db_manager.schema
+    bucket_expr = "to_timestamp(floor(extract(epoch FROM {0}) / :bucket) * :bucket) AT TIME ZONE 'UTC'"
+    params = {'station': station, 'datum': datum, 'start': start, 'end': end, 'bucket': bucket}
+
+    if source == 'raw':
+        table = station_tables[station]
+        column = f'"{table.columns[datum]}"'
+        sql = (f"SELECT {bucket_expr.format('tstamp')}, min({column}), avg({column}), max({column}), count({column})" +
+               f' FROM "{schema}"."{table.table}"' +
+               f" WHERE tstamp >= :start AND tstamp < :end AND {column} IS NOT NULL" +
+               " GROUP BY 1 ORDER BY 1")
+    else:
+        sql = (f"SELECT {bucket_expr.format('bucket')}, min(min), sum(mean * count) / sum(count), max(max), sum(count)" +
+               f' FROM "{schema}"."{source}"' +
+               " WHERE station = :station AND datum = :datum AND bucket >= :start AND bucket < :end" +
+               " GROUP BY 1 ORDER BY 1")
+
+    return db_manager.run(lambda session: session.execute(text(sql), params).all())
+
+
+def get_history(station: str, datum: str, start: datetime.datetime, end: datetime.datetime, points: int) -> dict:
+    """
+    The values of *datum* between *start* and *end*, aggregated (in the database) into at most *points*
+     buckets of min/mean/max/count.
+
+    :raises DatabaseUnavailable: if the database circuit breaker is open
+    :raises DatumNotStored: if there is no table to query
+    """
+    start, end = naive_utc(start), naive_utc(end)
+    bucket = choose_bucket(start, end, points)
+    # align the range to the buckets, it is also the cache key
+    start = Epoch + datetime.timedelta(seconds=_seconds(start) // bucket * bucket)
+    end = Epoch + datetime.timedelta(seconds=-(-_seconds(end) // bucket) * bucket)
+    source = choose_source(station, datum, bucket)
+
+    key = (station, datum, start, end, bucket)
+    answer = cache.get(key)
+    if answer is not None:
+        return answer
+
+    rows = _query(station, datum, source, start, end, bucket)
+    answer = {
+        'station': station,
+        'datum': datum,
+        'from': isoformat_zulu(start),
+        'to': isoformat_zulu(end),
+        'bucket': bucket,
+        'source': source,
+        'points': [{
+            'time': isoformat_zulu(t),
+            'min': v_min,
+            'mean': v_mean,
+            'max': v_max,
+            'count': count,
+        } for t, v_min, v_mean, v_max, count in rows],
+    }
+
+    live = end > datetime.datetime.utcnow() - datetime.timedelta(seconds=bucket)
+    cache.put(key, answer, ttl=min(bucket, 60) if live else 3600)
+    return answer
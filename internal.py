@@ -21,6 +21,7 @@ class InternalDatum(str, Enum):
 
 class Internal(Station):
 
+    adaptive_polling = False    # e.g. the human intervention must be noticed promptly
     latitude: float
     longitude: float
     elevation: float
@@ -0,0 +1,88 @@
+"""
+Bulk loading of stored readings into NumPy arrays, for offline analysis, e.g.:
+
+    from loader import load_history
+    from utils import VantageProDatum
+
+    data = load_history('davis', [VantageProDatum.WindSpeed, VantageProDatum.OutsideTemperature],
+                        datetime.datetime(2025, 1, 1), datetime.datetime(2026, 1, 1))
+    data['tstamp']      # datetime64[us] (UTC)
+    data['wind_speed']  # float64, NaN where the value was not stored
+"""
+import datetime
+from typing import Dict, List, Union
+from enum import Enum
+
+import numpy as np
+from sqlalchemy import text
+
+from db_access import make_db_manager, station_tables
+
+ChunkRows = 50000   # rows fetched at a time from the server-side cursor
+
+
+def load_history(station: str, datums: List[Union[str, Enum]], start: datetime.datetime,
+                 end: datetime.datetime) -> Dict[str, np.ndarray]:
+    """
+    Loads the stored values of some of a station's datums, between *start* and *end* (UTC).
+
+    The rows are counted first, the arrays are allocated once and filled in chunks from a server-side
+     cursor, all within a single repeatable-read transaction.
+
+    :param station: A station name, as in the configuration (e.g. 'davis', 'inside-arduino')
+    :param datums: Datum names or enum members (e.g. VantageProDatum.WindSpeed)
+    :param start: Inclusive
+    :param end: Exclusive
+    :return: A dictionary with a 'tstamp' array and a float64 array per datum
+    """
+    if station not in station_tables:
+        raise Exception(f"Bad station name '{station}'  Stored stations: {list(station_tables.keys())}")
+    table = station_tables[station]
+    names = [getattr(datum, 'value', datum) for datum in datums]
+    for name in names:
+        if name not in table.columns:
+            raise Exception(f"Datum '{name}' is not stored for station '{station}' " +
+                            f"(stored datums: {list(table.columns.keys())})")
+
+    db_manager = make_db_manager()
+    if db_manager.engine is None:
+        db_manager.connect()
+
+    qualified = f'"{db_manager.schema}"."{table.table}"'
+    columns = ", ".join([f'"{table.columns[name]}"' for name in names])
+    where = "WHERE tstamp >= %(start)s AND tstamp < %(end)s"
+    params = {'start': start, 'end': end}
+
+    def work(session) -> Dict[str, np.ndarray]:
+        session.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+        cursor = session.connection().connection.cursor()
+        cursor.execute(f"SELECT count(*) FROM {qualified} {where}", params)
+        n = cursor.fetchone()[0]
+        cursor.close()
+
+        epochs = np.empty(n, dtype=np.float64)
+        values = [np.empty(n, dtype=np.float64) for _ in names]
+
+        cursor = session.connection().connection.cursor(name='load_history')  # server-side
+        cursor.itersize = ChunkRows
+        cursor.execute(f"SELECT extract(epoch FROM tstamp), {columns} FROM {qualified} {where} ORDER BY tstamp",
+                       params)
+        i = 0
+        while True:
+            rows = cursor.fetchmany(ChunkRows)
+            if not rows:
+                break
+            block = np.array(rows, dtype=np.float64)    # None becomes NaN
+            m = min(len(block), n - i)
+            epochs[i:i + m] = block[:m, 0]
+            for j, array in enumerate(values):
+                array[i:i + m] = block[:m, j + 1]
+            i += m
+        cursor.close()
+
+        ret = {'tstamp': (epochs[:i] * 1e6).round().astype(np.int64).astype('datetime64[us]')}
+        for name, array in zip(names, values):
+            ret[name] = array[:i]
+        return ret
+
+    return db_manager.run(work)
@@ -1,6 +1,6 @@
 import logging
 from serial.tools.list_ports_linux import comports
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, StreamingResponse
 
 from init_log import config_logging
 # config_logging(logging.DEBUG if os.getenv('DEBUG') else logging.WARNING)
@@ -8,11 +8,15 @@ from init_log import config_logging
 logging.basicConfig(level=logging.WARNING)
 
 import argparse
-from typing import Dict, Any
+import datetime
+import itertools
+from typing import Dict, Any, Optional, Iterator, AsyncIterator
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from sqlalchemy.exc import OperationalError, InterfaceError, DataError, TimeoutError as PoolTimeoutError
 
 from vantage_pro2 import VantagePro2
 from internal import Internal
@@ -20,11 +24,16 @@ from inside_arduino import InsideArduino
 from outside_arduino import OutsideArduino
 from cyclope import Cyclope
 from tessw import TessW
+from station import SerialStation
+from serial_manager import make_serial_manager
+from detection import detect_stations
 
 from config.config import make_cfg, Config
-from utils import ExtendedJSONResponse, SafetyResponse
+from utils import ExtendedJSONResponse, SafetyResponse, RepeatTimer
 from init_log import config_logging
-from db_access import make_db_manager
+from db_access import make_db_manager, DatabaseUnavailable, station_tables
+from history import get_history, naive_utc, DatumNotStored
+from export import ExportFormat, export_rows, missing_columns, csv_chunks, parquet_chunks, parquet_supported
 from enum import Enum
 from canonical import CanonicalResponse, CanonicalResponse_Ok
 
@@ -67,8 +76,10 @@ def make_stations():
 
         # logger.debug(f"adding station '{name}'")
         stations[name] = station
-        if hasattr(station, 'detect'):
-            serial_ports = station.detect(serial_ports)  # returns a list without the used port
+
+    detect_stations([station for station in stations.values()
+                     if hasattr(station, 'probe') and getattr(station, 'baud', None) is not None], serial_ports)
+    for name in stations:
         stations[name].start()
 
 
@@ -76,12 +87,21 @@ def make_stations():
 async def lifespan(_):
     db_manager.connect()
     # db_manager.open_session()
+    partitions_timer = None
+    if cfg.database.partitions.enabled:
+        db_manager.maintain_partitions()
+        partitions_timer = RepeatTimer(name='partitions-timer', interval=24 * 60 * 60,
+                                       function=db_manager.maintain_partitions)
+        partitions_timer.start()
     make_stations()
     yield
     # db_manager.close_session()
+    if partitions_timer is not None:
+        partitions_timer.stop()
     db_manager.disconnect()
     for station in stations:
         stations[station].stop()
+    make_serial_manager().close_all()
 
 app = FastAPI(lifespan=lifespan, title="Safety at WAO (the Weizmann Astrophysical Observatory)")
 
@@ -128,10 +148,118 @@ async def get_station_details(station: StationName) -> CanonicalResponse:
     return CanonicalResponse(value={
         'name': s.name,
         'settings': cfg.station_settings[name],
-        'readings': s.readings
+        'readings': s.readings,
+        'compression': s.compressor.status() if getattr(s, 'compressor', None) is not None else None,
+        'serial': s.serial_port().status() if isinstance(s, SerialStation) else None,
+        'streaming': s.streaming_status() if hasattr(s, 'streaming_status') else None,
+        'link': s.link.status() if getattr(s, 'link', None) is not None else None,
+        'health': s.health.status() if getattr(s, 'health', None) is not None else None,
+        'polling': {
+            'interval': s.poll_interval(),
+            'adaptive': s.adaptive.status() if getattr(s, 'adaptive', None) is not None else None,
+        },
     })
 
 
+@app.get("/database", tags=["info"], response_class=ExtendedJSONResponse)
+async def get_database_status() -> CanonicalResponse:
+    return CanonicalResponse(value=db_manager.status())
+
+
+def error_response(status_code: int, error: str) -> JSONResponse:
+    return JSONResponse(status_code=status_code, content=CanonicalResponse(errors=[error]).dict())
+
+
+@app.get("/history/{station}/{datum}", tags=["history"], response_class=ExtendedJSONResponse)
+async def get_datum_history(station: str, datum: str,
+                            start: Optional[datetime.datetime] = Query(None, alias='from'),
+                            end: Optional[datetime.datetime] = Query(None, alias='to'),
+                            points: int = 500) -> CanonicalResponse:
+    if station not in cfg.station_settings:
+        return error_response(404, f"Bad station name '{station}'  Known stations: {list(cfg.station_settings.keys())}")
+    if datum not in cfg.station_settings[station].datums:
+        return error_response(404, f"Bad datum '{datum}' for station '{station}' " +
+                                   f"(valid datums: {cfg.station_settings[station].datums})")
+    if points < 1 or points > cfg.history.max_points:
+        return error_response(400, f"'points' must be between 1 and {cfg.history.max_points}")
+
+    # the database keeps naive UTC timestamps
+    end = naive_utc(end) if end is not None else datetime.datetime.utcnow()
+    start = naive_utc(start) if start is not None else end - datetime.timedelta(days=1)
+    if start >= end:
+        return error_response(400, f"'from' ({start}) must be earlier than 'to' ({end})")
+
+    try:
+        value = await run_in_threadpool(get_history, station, datum, start, end, points)
+    except DatumNotStored as ex:
+        return error_response(404, f"{ex}")
+    except (DatabaseUnavailable, OperationalError, InterfaceError, PoolTimeoutError) as ex:
+        return error_response(503, f"{type(ex).__name__}: {str(ex).splitlines()[0]}")
+    return CanonicalResponse(value=value)
+
+
+async def closing_stream(content: Iterator[bytes], rows: Iterator[list]) -> AsyncIterator[bytes]:
+    """
+    Streams *content* (produced in a worker thread) and closes the database cursor behind it however
+     the response ends: completed, failed or abandoned by the client
+    """
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, content, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        content.close()
+        rows.close()
+
+
+@app.get("/export/{station}", tags=["history"])
+async def export_station_readings(station: str,
+                                  start: datetime.datetime = Query(..., alias='from'),
+                                  end: Optional[datetime.datetime] = Query(None, alias='to'),
+                                  datums: Optional[str] = Query(None, description="comma separated, default: all"),
+                                  format: str = ExportFormat.Csv):
+    if station not in station_tables:
+        return error_response(404, f"Bad station name '{station}'  Stored stations: {list(station_tables.keys())}")
+    if format not in ExportFormat.media_types:
+        return error_response(400, f"Bad format '{format}' (valid formats: {list(ExportFormat.media_types)})")
+    if format == ExportFormat.Parquet and not parquet_supported():
+        return error_response(501, "The 'parquet' format needs the 'pyarrow' package")
+    selected = [datum.strip() for datum in datums.split(',') if datum.strip()] if datums else None
+    if selected:
+        bad = [datum for datum in selected if datum not in station_tables[station].columns]
+        if bad:
+            return error_response(400, f"Bad datums {bad} for station '{station}' " +
+                                     f"(stored datums: {list(station_tables[station].columns.keys())})")
+    # the database keeps naive UTC timestamps
+    start = naive_utc(start)
+    end = naive_utc(end) if end is not None else datetime.datetime.utcnow()
+    if start >= end:
+        return error_response(400, f"'from' ({start}) must be earlier than 'to' ({end})")
+
+    # the columns and the first chunk are checked here, so that database errors are reported rather than streamed
+    rows = export_rows(station, start, end, selected)
+    try:
+        missing = await run_in_threadpool(missing_columns, station, selected)
+        if missing:
+            return error_response(409, f"The '{station}' table lacks the columns {missing}")
+        first = await run_in_threadpool(next, rows, None)
+    except (DatabaseUnavailable, OperationalError, InterfaceError, PoolTimeoutError) as ex:
+        rows.close()
+        return error_response(503, f"{type(ex).__name__}: {str(ex).splitlines()[0]}")
+    except DataError as ex:
+        rows.close()
+        return error_response(400, f"{type(ex).__name__}: {str(ex).splitlines()[0]}")
+    chunks = itertools.chain([first] if first is not None else [], rows)
+
+    content = csv_chunks(station, chunks, selected) if format == ExportFormat.Csv \
+        else parquet_chunks(station, chunks, selected)
+    filename = f"{station}-{start:%Y%m%dT%H%M%S}-{end:%Y%m%dT%H%M%S}.{format}"
+    return StreamingResponse(closing_stream(content, rows), media_type=ExportFormat.media_types[format],
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
 @app.get("/{project}/sensors", tags=["info"], response_class=ExtendedJSONResponse)
 async def get_sensors_for_specific_project(project: ProjectName) -> CanonicalResponse:
     from copy import deepcopy
@@ -250,6 +378,9 @@ async def help():
                 <tr><td><code>/stations</code></td><td>Lists the defined stations</td></tr>
                 <tr><td><code>/projects</code></td><td>Lists the defined projects</td></tr>
                 <tr><td><code>/stations/{<b>station</b>}</code></td><td>Dumps state of specified <code><b>station</b></code></td></tr>
+                <tr><td><code>/database</code></td><td>Dumps the database connection and circuit breaker state</td></tr>
+                <tr><td><code>/export/{<b>station</b>}?from=&to=&datums=&format=csv|parquet</code></td><td>Downloads the <code><b>station</b></code>'s stored readings</td></tr>
+                <tr><td><code>/history/{<b>station</b>}/{<b>datum</b>}?from=&to=&points=</code></td><td>Gets the <code><b>datum</b></code>'s history, aggregated into at most <code>points</code> min/mean/max/count buckets</td></tr>
                 <tr><td><code>/{<b>project</b>}/sensors</code></td><td>Dumps state of the sensors for specified <code><b>project</b></code></td></tr>
                 <tr><td><code>/{<b>project</b>}/sensor/{<b>sensor</b>}</code></td><td>Dumps state of the specified <b>sensor</b> for specified <code><b>project</b></code></td></tr>
                 <tr><td>/<code>{<b>project</b>}/is_safe</code></td><td>Gets the specified <code><b>project</b></code>'s is_safe value</td></tr>
@@ -0,0 +1,268 @@
+import datetime
+import logging
+import math
+import threading
+from typing import Dict, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, InterfaceError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+
+from config.config import make_cfg
+from db_access import make_db_manager, station_tables, month_start, DatabaseUnavailable
+from init_log import init_log
+
+logger = logging.getLogger('rollup')
+init_log(logger)
+
+Epoch = datetime.datetime(1970, 1, 1)
+
+
+class Resolution:
+    """
+    A rollup resolution: the bucket size and the table holding its rows
+    """
+    def __init__(self, name: str, seconds: int, unit: str):
+        self.name = name
+        self.seconds = seconds
+        self.unit = unit        # as per Postgres' date_trunc()
+        self.table = f"rollup_{name}"
+
+    def bucket(self, tstamp: datetime.datetime) -> datetime.datetime:
+        """
+        The start of the bucket containing *tstamp*
+        """
+        if tstamp.tzinfo is not None:
+            tstamp = tstamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        seconds = int((tstamp - Epoch).total_seconds()) // self.seconds * self.seconds
+        return Epoch + datetime.timedelta(seconds=seconds)
+
+
+Minute = Resolution('1m', 60, 'minute')
+Hour = Resolution('1h', 60 * 60, 'hour')
+resolutions = [Minute, Hour]
+
+
+class Aggregate:
+    """
+    The min/sum/max/count of the values of a datum within one bucket
+    """
+    def __init__(self):
+        self.min: float = math.inf
+        self.max: float = -math.inf
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def add(self, value: float):
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.sum += value
+        self.count += 1
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not (isinstance(value, float) and math.isnan(value))
+
+
+class RollupAccumulator:
+    """
+    Accumulates a **Station**'s readings into the current bucket of one resolution.
+    The bucket is handed out (as rollup rows) when a reading falls into a later one.
+    """
+
+    def __init__(self, station: str, resolution: Resolution):
+        self.station = station
+        self.resolution = resolution
+        self.bucket: Optional[datetime.datetime] = None
+        self.aggregates: Dict[str, Aggregate] = {}
+
+    def add(self, tstamp: datetime.datetime, datums: dict) -> List[dict]:
+        """
+        Adds the numeric datums of a reading
+
+        :return: The rows of the previous bucket, if this reading closed it
+        """
+        bucket = self.resolution.bucket(tstamp)
+        rows = []
+        if self.bucket is not None and bucket != self.bucket:
+            rows = self.take()
+        self.bucket = bucket
+
+        for datum, value in datums.items():
+            if not is_number(value):
+                continue
+            datum = getattr(datum, 'value', datum)
+            if datum not in self.aggregates:
+                self.aggregates[datum] = Aggregate()
+            self.aggregates[datum].add(float(value))
+        return rows
+
+    def take(self) -> List[dict]:
+        """
+        Hands out the rows of the current bucket (even if not complete) and starts it afresh.
+        Partial buckets are merged with the existing rows when written.
+        """
+        rows = [{
+            'station': self.station,
+            'datum': datum,
+            'bucket': self.bucket,
+            'min': agg.min,
+            'mean': agg.sum / agg.count,
+            'max': agg.max,
+            'count': agg.count,
+        } for datum, agg in self.aggregates.items()]
+        self.aggregates = {}
+        return rows
+
+
+_tables_created = False
+
+
+def create_tables(session: Session):
+    schema = make_db_manager().schema
+    for resolution in resolutions:
+        session.execute(text(
+            f'CREATE TABLE IF NOT EXISTS "{schema}"."{resolution.table}" (' +
+            ' station text NOT NULL, datum text NOT NULL, bucket timestamp NOT NULL,' +
+            ' min double precision, mean double precision, max double precision, count integer NOT NULL,' +
+            ' PRIMARY KEY (station, datum, bucket))'))
+
+
+def upsert(session: Session, resolution: Resolution, rows: List[dict]):
+    """
+    Writes rollup rows, merging them with the existing rows of the same buckets
+    """
+    global _tables_created
+
+    if not _tables_created:
+        create_tables(session)
+        _tables_created = True
+
+    table = f'"{make_db_manager().schema}"."{resolution.table}"'
+    session.execute(text(
+        f"INSERT INTO {table} AS r (station, datum, bucket, min, mean, max, count)" +
+        " VALUES (:station, :datum, :bucket, :min, :mean, :max, :count)" +
+        " ON CONFLICT (station, datum, bucket) DO UPDATE SET" +
+        " min = LEAST(r.min, EXCLUDED.min)," +
+        " max = GREATEST(r.max, EXCLUDED.max)," +
+        " mean = (r.mean * r.count + EXCLUDED.mean * EXCLUDED.count) / (r.count + EXCLUDED.count)," +
+        " count = r.count + EXCLUDED.count"), rows)
+
+
+class Rollups:
+    """
+    Maintains a **Station**'s per-minute and per-hour rollups, from the readings it acquires.
+
+    Closed buckets are written right away.  While the database is unavailable they are kept (up to
+     the configured *max-pending* rows) and written with the next ones.
+    """
+
+    def __init__(self, station: str):
+        self.station = station
+        self.accumulators = [RollupAccumulator(station, resolution) for resolution in resolutions]
+        self.pending: Dict[str, List[dict]] = {resolution.name: [] for resolution in resolutions}
+        self.max_pending = make_cfg().rollups.max_pending
+        self.lock = threading.Lock()
+
+    def add(self, reading):
+        with self.lock:
+            for accumulator in self.accumulators:
+                self.pending[accumulator.resolution.name] += accumulator.add(reading.tstamp, reading.datums)
+        self.write()
+
+    def flush(self):
+        """
+        Writes the current (partial) buckets too, e.g. when the **Station** stops
+        """
+        with self.lock:
+            for accumulator in self.accumulators:
+                if accumulator.aggregates:
+                    self.pending[accumulator.resolution.name] += accumulator.take()
+        self.write()
+
+    def write(self):
+        with self.lock:
+            for resolution in resolutions:
+                rows = self.pending[resolution.name]
+                if not rows:
+                    continue
+                try:
+                    make_db_manager().run(lambda session: upsert(session, resolution, rows))
+                    self.pending[resolution.name] = []
+                except (DatabaseUnavailable, OperationalError, InterfaceError, PoolTimeoutError):
+                    # the rows are fine, keep them for the next write
+                    if len(rows) > self.max_pending:
+                        logger.warning(f"station '{self.station}': dropped {len(rows) - self.max_pending} " +
+                                       f"'{resolution.table}' rows (database unavailable)")
+                        self.pending[resolution.name] = rows[-self.max_pending:]
+                except Exception as ex:
+                    # the rows themselves were rejected, retrying them would fail again
+                    logger.error(f"station '{self.station}': could not write {len(rows)} '{resolution.table}' rows",
+                                 exc_info=ex)
+                    self.pending[resolution.name] = []
+
+
+def backfill(session: Session, station: str, start: datetime.datetime, end: datetime.datetime):
+    """
+    Builds the rollups of *station* for [*start*, *end*) from its table, in bulk.
+
+    The per-minute rows are computed from the raw rows (one scan for all the datums), the per-hour
+     rows from the per-minute ones.  Existing rollup rows in the range are replaced.
+    """
+    global _tables_created
+
+    if not _tables_created:
+        create_tables(session)
+        _tables_created = True
+
+    schema = make_db_manager().schema
+    station_table = station_tables[station]
+    values = ", ".join([f"('{datum}', t.\"{column}\"::double precision)"
+                        for datum, column in station_table.columns.items()])
+    replace = (" ON CONFLICT (station, datum, bucket) DO UPDATE SET" +
+               " min = EXCLUDED.min, mean = EXCLUDED.mean, max = EXCLUDED.max, count = EXCLUDED.count")
+    params = {'station': station, 'start': start, 'end': end}
+
+    session.execute(text("SET LOCAL statement_timeout = 0"))
+    session.execute(text(
+        f'INSERT INTO "{schema}"."{Minute.table}" (station, datum, bucket, min, mean, max, count)' +
+        f" SELECT :station, v.datum, date_trunc('{Minute.unit}', t.tstamp), min(v.value), avg(v.value)," +
+        " max(v.value), count(v.value)" +
+        f' FROM "{schema}"."{station_table.table}" t CROSS JOIN LATERAL (VALUES {values}) AS v(datum, value)' +
+        " WHERE t.tstamp >= :start AND t.tstamp < :end AND v.value IS NOT NULL" +
+        " GROUP BY v.datum, 3" + replace), params)
+    session.execute(text(
+        f'INSERT INTO "{schema}"."{Hour.table}" (station, datum, bucket, min, mean, max, count)' +
+        f" SELECT station, datum, date_trunc('{Hour.unit}', bucket), min(min), sum(mean * count) / sum(count)," +
+        " max(max), sum(count)" +
+        f' FROM "{schema}"."{Minute.table}"' +
+        " WHERE station = :station AND bucket >= :start AND bucket < :end" +
+        " GROUP BY station, datum, 3" + replace), params)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Rollup tables maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    backfill_parser = subparsers.add_parser('backfill', help="build the rollups of existing history")
+    backfill_parser.add_argument('--station', action='append', choices=list(station_tables.keys()),
+                                 help="station(s) to backfill (default: all)")
+    backfill_parser.add_argument('--from', dest='start', type=datetime.datetime.fromisoformat, required=True,
+                                 help="UTC, ISO-8601")
+    backfill_parser.add_argument('--to', dest='end', type=datetime.datetime.fromisoformat,
+                                 help="UTC, ISO-8601 (default: the start of the current hour)")
+    args = parser.parse_args()
+
+    db_manager = make_db_manager()
+    db_manager.connect()
+
+    end = args.end or Hour.bucket(datetime.datetime.utcnow())
+    for name in args.station or list(station_tables.keys()):
+        # one month at a time, hour-aligned, so each transaction stays reasonably sized
+        chunk_start = Hour.bucket(args.start)
+        while chunk_start < end:
+            chunk_end = min(datetime.datetime.combine(month_start(chunk_start.date(), 1), datetime.time()), end)
+            db_manager.run(lambda session: backfill(session, name, chunk_start, chunk_end))
+            print(f"{name}: rolled up [{chunk_start}, {chunk_end})")
+            chunk_start = chunk_end
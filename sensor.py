@@ -44,6 +44,7 @@ class MinMaxSettings(SensorSettings):
     def __init__(self, d: dict):
         SensorSettings.__init__(self, d)
         self.min: float = d['min'] if 'min' in d else 0
+        self.has_min: bool = 'min' in d
         self.max: float = d['max'] if 'max' in d else (2 ** 32 - 1)
         self.settling: float = d['settling'] if 'settling' in d else None
         self.nreadings: int = d['nreadings'] if 'nreadings' in d else 1
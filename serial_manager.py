@@ -0,0 +1,210 @@
+import datetime
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import serial
+
+from config.config import make_cfg
+from init_log import init_log
+
+logger = logging.getLogger('serial-manager')
+init_log(logger)
+
+
+class SerialPortUnavailable(Exception):
+    """
+    The port is (still) backing off after a failed open or transaction
+    """
+    pass
+
+
+class SerialPort:
+    """
+    A serial port that is kept open between transactions.
+
+    * Access is serialized by a (re-entrant) lock, one transaction at a time.
+    * A handle is considered stale (and is re-opened) if the device node disappeared (e.g. unplugged)
+       or if it was not used successfully for *stale_after* seconds.
+    * A failed open or transaction closes the handle, further attempts are refused for an
+       exponentially growing backoff period.
+    """
+
+    def __init__(self, port: str, baud: int, timeout: Optional[float] = None, write_timeout: Optional[float] = None,
+                 open_delay: float = 0):
+        conf = make_cfg().serial_manager
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        self.write_timeout = write_timeout
+        self.open_delay = open_delay
+        self.stale_after = conf.stale_after
+        self.min_backoff = conf.min_backoff
+        self.max_backoff = conf.max_backoff
+
+        self.lock = threading.RLock()
+        self.ser: Optional[serial.Serial] = None
+        self.backoff = 0.0
+        self.retry_at = 0.0
+        self.last_success: Optional[float] = None
+
+        # metrics
+        self.opens = 0
+        self.transactions = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_latency: Optional[float] = None
+        self.mean_latency: Optional[float] = None   # exponentially weighted
+        self.max_latency: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    def _is_stale(self) -> bool:
+        if self.ser is None or not self.ser.is_open:
+            return True
+        if not os.path.exists(self.port):
+            logger.warning(f"port '{self.port}': device is gone")
+            return True
+        if self.last_success is not None and time.monotonic() - self.last_success > self.stale_after:
+            logger.info(f"port '{self.port}': not used for more than {self.stale_after} seconds, re-opening")
+            return True
+        return False
+
+    def _open(self):
+        now = time.monotonic()
+        if now < self.retry_at:
+            raise SerialPortUnavailable(f"port '{self.port}': backing off for {self.retry_at - now:.1f} more seconds " +
+                                        f"(last error: {self.last_error})")
+        self.close()
+        self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=self.timeout,
+                                 write_timeout=self.write_timeout)
+        self.opens += 1
+        if self.open_delay:
+            # e.g. an Arduino resets when DTR is asserted by the open
+            time.sleep(self.open_delay)
+        self.ser.reset_input_buffer()
+        self.last_success = time.monotonic()
+        logger.info(f"port '{self.port}': opened at {self.baud} baud")
+
+    def close(self):
+        with self.lock:
+            if self.ser is not None:
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+                self.ser = None
+
+    def _failed(self, ex: Exception):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = f"{type(ex).__name__}: {ex}"
+        self.backoff = self.min_backoff if self.backoff == 0 else min(self.backoff * 2, self.max_backoff)
+        self.retry_at = time.monotonic() + self.backoff
+        self.close()
+        logger.error(f"port '{self.port}': {self.last_error}, retrying in {self.backoff} seconds")
+
+    def _succeeded(self, latency: float):
+        self.transactions += 1
+        self.consecutive_failures = 0
+        self.backoff = 0.0
+        self.last_success = time.monotonic()
+        self.last_latency = latency
+        self.mean_latency = latency if self.mean_latency is None else 0.8 * self.mean_latency + 0.2 * latency
+        self.max_latency = latency if self.max_latency is None else max(self.max_latency, latency)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields the open serial.Serial, for the exclusive use of the caller.
+        Serial and OS errors close the port (it will be re-opened, after the backoff, by the next transaction),
+         other exceptions (e.g. a bad reply) are just passed on.
+
+        :raises SerialPortUnavailable: while backing off
+        """
+        with self.lock:
+            if self._is_stale():
+                try:
+                    self._open()
+                except SerialPortUnavailable:
+                    raise
+                except (serial.SerialException, OSError) as ex:
+                    self._failed(ex)
+                    raise
+
+            start = time.monotonic()
+            try:
+                yield self.ser
+            except (serial.SerialException, OSError) as ex:
+                self._failed(ex)
+                raise
+            self._succeeded(time.monotonic() - start)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'port': self.port,
+                'baud': self.baud,
+                'open': self.ser is not None and self.ser.is_open,
+                'opens': self.opens,
+                'transactions': self.transactions,
+                'failures': self.failures,
+                'consecutive_failures': self.consecutive_failures,
+                'last_error': self.last_error,
+                'backoff': self.backoff,
+                'last_success': None if self.last_success is None else
+                    (datetime.datetime.utcnow() -
+                     datetime.timedelta(seconds=time.monotonic() - self.last_success)).isoformat(),
+                'latency': {
+                    'last': self.last_latency,
+                    'mean': self.mean_latency,
+                    'max': self.max_latency,
+                },
+            }
+
+
+class SerialManager:
+    """
+    Keeps one **SerialPort** per device, for all the stations
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super(SerialManager, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self.ports: Dict[str, SerialPort] = {}
+        self.lock = threading.Lock()
+        self._initialized = True
+
+    def get(self, port: str, baud: int, timeout: Optional[float] = None, write_timeout: Optional[float] = None,
+            open_delay: float = 0) -> SerialPort:
+        with self.lock:
+            serial_port = self.ports.get(port)
+            if serial_port is None or serial_port.baud != baud:
+                if serial_port is not None:
+                    serial_port.close()
+                serial_port = SerialPort(port, baud, timeout=timeout, write_timeout=write_timeout,
+                                         open_delay=open_delay)
+                self.ports[port] = serial_port
+            return serial_port
+
+    def close_all(self):
+        with self.lock:
+            for serial_port in self.ports.values():
+                serial_port.close()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {port: serial_port.status() for port, serial_port in self.ports.items()}
+
+
+def make_serial_manager():
+    return SerialManager()
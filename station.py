@@ -6,7 +6,7 @@ import threading
 import time
 from abc import ABC, abstractmethod
 from datetime import timedelta as td
-from typing import List
+from typing import List, Optional
 from copy import copy
 
 import serial
@@ -16,6 +16,13 @@ from utils import FixedSizeFifo, Never, formatted_float_list, SafetyResponse
 from config.config import make_cfg
 from init_log import init_log
 from sensor import SensorReading
+from rollup import Rollups
+from compression import Compressor
+from archive import ArchiveWriter
+import warm_start
+from health import StationHealth
+from adaptive import AdaptivePolling
+from serial_manager import make_serial_manager, SerialPort, SerialPortUnavailable
 
 cfg = make_cfg()
 
@@ -44,6 +51,8 @@ class Station(ABC):
     decisions.
     """
 
+    adaptive_polling: bool = True   # whether the polling interval may be adapted (see **AdaptivePolling**)
+
     @classmethod
     def datums(cls) -> List[str]:
         """
@@ -53,9 +62,11 @@ class Station(ABC):
         pass
 
     @abstractmethod
-    def fetcher(self) -> None:
+    def fetcher(self) -> Optional[bool]:
         """
         Fetches a reading from the **Station**
+
+        :return: False if it failed (raising also counts as failing)
         """
         pass
 
@@ -110,7 +121,20 @@ class Station(ABC):
         cfg.station_settings[self.name].nreadings = self.nreadings
         self.readings = FixedSizeFifo(self.nreadings)
 
+        self.rollups = Rollups(self.name) if cfg.rollups.enabled else None
+        self.archive = ArchiveWriter(self.name) if cfg.archive.enabled else None
+        compression = cfg.station_settings[self.name].compression
+        self.compressor = Compressor(compression) if compression is not None and compression.enabled else None
+        self.health = StationHealth(self.name)
+        self.adaptive = AdaptivePolling(self) if cfg.adaptive_polling.enabled and self.adaptive_polling else None
+
     def start(self):
+        if cfg.warm_start.enabled:
+            try:
+                warm_start.rehydrate(self)
+            except Exception as ex:
+                # just an optimization, the station starts cold
+                logger.error(f"station '{self.name}': warm start failed", exc_info=ex)
         if hasattr(self, 'fetcher'):
             self.thread.start()
 
@@ -119,28 +143,102 @@ class Station(ABC):
 
     def stop(self):
         self.stop_event.set()
+        if getattr(self, 'rollups', None) is not None:
+            self.rollups.flush()
+        if getattr(self, 'archive', None) is not None:
+            self.archive.flush()
+        if getattr(self, 'compressor', None) is not None and hasattr(self, 'saver'):
+            for reading in self.compressor.flush():
+                self.saver(reading)
+
+    def push_reading(self, reading: StationReading, save: bool = True, observe: bool = True):
+        """
+        Handles a newly acquired reading: makes it available to the *Sensors*, feeds it to the
+         derived stores and saves it.
+
+        :param reading: The new reading
+        :param save: Whether to also call the **Station**'s *saver* (only for the readings that
+         survive the compression, if configured)
+        :param observe: Whether to also feed it to the derived stores (False if it was already
+         observed, e.g. by a streaming station)
+        """
+        with self.lock:
+            self.readings.push(reading)
+        if observe:
+            self.observe(reading)
+        if save and hasattr(self, 'saver'):
+            for r in (self.compressor.filter(reading) if self.compressor is not None else [reading]):
+                self.saver(r)
+
+    def observe(self, reading: StationReading):
+        """
+        Feeds a reading to the derived stores (the rollups and the daily archive)
+        """
+        if self.rollups is not None:
+            self.rollups.add(reading)
+        if self.archive is not None:
+            self.archive.append(reading)
 
     def fetcher_loop(self):
         """
         A forever loop, to be started in a Thread.
 
-        * Fetches the **Station**'s values
+        * Fetches the **Station**'s values (the *fetcher* fails by raising or returning False)
         * Calculates the sensors' safety
-        * Sleeps as per the **Station**'s interval setting
+        * Sleeps as per the **Station**'s interval setting, longer while the fetches keep failing
         """
         while not self.stop_event.is_set():
             start_time = time.time()
             try:
-                self.fetcher()
+                if self.fetcher() is False:
+                    self.health.failed()
+                else:
+                    self.health.succeeded()
+            except Exception as ex:
+                self.health.failed(ex, back_off=not self.backs_off_by_itself(ex))
+
+            try:
                 self.calculate_sensors()
             except Exception as ex:
-                logger.error(f"Could not fetch and calculate sensors", exc_info=ex)
+                logger.error(f"station '{self.name}': could not calculate sensors", exc_info=ex)
+
+            self.save_snapshot()
+            if self.adaptive is not None:
+                self.adaptive.update(self.interval)
 
             end_time = time.time()
             # sleep until end of interval
-            remaining_time = self.interval - (end_time - start_time)
+            remaining_time = self.health.delay(self.poll_interval()) - (end_time - start_time)
             if remaining_time > 0:
-                time.sleep(remaining_time)
+                self.stop_event.wait(remaining_time)
+
+    def backs_off_by_itself(self, ex: Exception) -> bool:
+        """
+        Did the fetch fail because of a resource that backs off by itself (the station's health then
+         does not space the fetches out on top of it)?
+        """
+        return False
+
+    @property
+    def poll_factor(self) -> float:
+        """
+        The adaptive polling's current factor for the *interval*
+        """
+        return self.adaptive.factor if getattr(self, 'adaptive', None) is not None else 1.0
+
+    def poll_interval(self) -> float:
+        """
+        Seconds between fetches, the **Station**'s (adapted) *interval* unless it polls some datums more often
+        """
+        return self.interval * self.poll_factor
+
+    def save_snapshot(self):
+        if not cfg.warm_start.enabled:
+            return
+        try:
+            warm_start.save_snapshot(self)
+        except Exception as ex:
+            logger.error(f"station '{self.name}': could not save a snapshot", exc_info=ex)
 
     def latest_readings(self, datum: str, n: int = 1) -> list:
         """
@@ -300,17 +398,31 @@ class SerialStation(Station):
 
         self.port = settings.serial
         self.baud = settings.baud
+        self.open_delay = settings.open_delay
         self.address = f"port={self.port}, baud={self.baud}"
 
         #
-        # NOTE: The serial port will be open/closed by the fetcher method
+        # NOTE: The serial port is kept open by the serial manager, the fetcher method
+        #  uses it within a transaction, see connection()
         #
 
-        # try:
-        #     self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=self.timeout)
-        # except Exception as ex:
-        #     logger.error(f"Cannot open serial at {self.address}", exc_info=ex)
-        #     raise
+    def serial_port(self) -> SerialPort:
+        # the port may change after detection, hence it is looked up each time
+        return make_serial_manager().get(self.port, self.baud, timeout=self.timeout,
+                                         write_timeout=self.write_timeout, open_delay=self.open_delay)
+
+    def backs_off_by_itself(self, ex: Exception) -> bool:
+        # the port backs off re-opening after a serial/OS error and refuses transactions meanwhile
+        return isinstance(ex, (SerialPortUnavailable, serial.SerialException, OSError))
+
+    def connection(self):
+        """
+        Exclusive use of the (already open) serial port, e.g.:
+
+            with self.connection() as self.ser:
+                ...
+        """
+        return self.serial_port().transaction()
 
     def fetcher(self) -> None:
         pass
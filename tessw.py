@@ -1,16 +1,18 @@
 from station import IPStation
 import httpx
-from bs4 import BeautifulSoup
+import re
 from enum import Enum
-from typing import List
+from typing import List, Optional, Dict
 import logging
 import subprocess
 import datetime
+import json
+import socket
+import threading
 import time
 
 from init_log import init_log
 from utils import TessWReading
-from sqlalchemy.orm import scoped_session
 from config.config import Config
 from db_access import DbManager
 
@@ -20,6 +22,8 @@ init_log(logger)
 
 class TessWDatum(str, Enum):
     Cover = "cover"
+    Magnitude = "magnitude"
+    Frequency = "frequency"
 
 #<!DOCTYPE html>
 #    <html>
@@ -32,136 +36,264 @@ class TessWDatum(str, Enum):
 #        </body>
 #    </html>
 
+# Matched directly against the page's bytes, from its <h4>, e.g.
+#  <h4><br><br> T. IR :   24.21 &ordm;C<br> T. Sens:   29.09 &ordm;C<br> Mag. :  16.23 mv/as2 f : 40.98 Hz<br></h4>
+Pattern = re.compile(
+    rb"T\. IR\s*:\s*(?P<t_sky>-?[0-9.]+).*?"
+    rb"T\. Sens\s*:\s*(?P<t_ambient>-?[0-9.]+).*?"
+    rb"Mag\.\s*:\s*(?P<magnitude>-?[0-9.]+).*?"
+    rb"f\s*:\s*(?P<frequency>[0-9.]+)",
+    re.I | re.S,
+)
+
+
+def parse_page(content: bytes) -> Optional[Dict[str, float]]:
+    """
+    The TESS-W's values (t_sky, t_ambient, magnitude, frequency) from its AP mode page, or None
+    """
+    m = Pattern.search(content, max(content.find(b'<h4>'), 0))
+    if m is None:
+        return None
+    return {key: float(value) for key, value in m.groupdict().items()}
+
+
+def parse_datagram(data: bytes, name: Optional[str] = None) -> Optional[Dict[str, float]]:
+    """
+    The TESS-W's values from one of its UDP/JSON datagrams, e.g.
+     {"udp":1234,"rev":2,"name":"stars1258","freq":40.98,"mag":16.23,"tamb":29.09,"tsky":-24.21,"wdBm":-60}
+
+    :param name: If given, datagrams from other photometers are ignored
+    :return: The values (as per *parse_page*) or None
+    """
+    try:
+        message = json.loads(data)
+        if name is not None and message.get('name') != name:
+            return None
+        return {
+            't_sky': float(message['tsky']),
+            't_ambient': float(message['tamb']),
+            'magnitude': float(message['mag']),
+            'frequency': float(message['freq']),
+        }
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def cloud_cover(t_sky: float, t_ambient: float) -> float:
+    return max(100 - (3 * (t_ambient - t_sky)), 0.0)
+
+
+class WifiLink:
+    """
+    The WiFi link to the TESS-W's access point.
+
+    * The link state is the interface's sysfs 'operstate', cached for *cache_seconds*, so checking
+       a healthy link costs no subprocesses.
+    * Reconnecting (bringing the interface up and joining the SSID) is only attempted after an actual
+       failure, at most once per *reconnect_interval* and in the background, so a failing fetch is not
+       delayed by it.
+    """
+
+    def __init__(self, interface: str, ssid: str, cache_seconds: float, reconnect_interval: float):
+        self.interface = interface
+        self.ssid = ssid
+        self.cache_seconds = cache_seconds
+        self.reconnect_interval = reconnect_interval
+        self.operstate_file = f"/sys/class/net/{interface}/operstate"
+
+        self.state: Optional[str] = None
+        self.state_checked = 0.0
+        self.last_reconnect = 0.0
+        self.reconnects = 0
+        self.reconnecting = threading.Lock()
+
+    def operstate(self) -> str:
+        now = time.monotonic()
+        if self.state is None or now - self.state_checked > self.cache_seconds:
+            try:
+                with open(self.operstate_file) as f:
+                    self.state = f.read().strip()
+            except OSError:
+                self.state = 'missing'
+            self.state_checked = now
+        return self.state
+
+    def is_up(self) -> bool:
+        return self.operstate() in ('up', 'unknown')     # some drivers do not report their state
+
+    def failed(self, reason: str):
+        """
+        A fetch failed, starts a (rate-limited) background reconnect
+        """
+        self.state = None   # re-read on the next check
+        now = time.monotonic()
+        if now - self.last_reconnect < self.reconnect_interval or self.reconnecting.locked():
+            return
+        self.last_reconnect = now
+        logger.warning(f"link '{self.interface}': {reason}, reconnecting to '{self.ssid}'")
+        threading.Thread(name=f'reconnect-{self.interface}', target=self.reconnect, daemon=True).start()
+
+    def reconnect(self):
+        with self.reconnecting:
+            self.reconnects += 1
+            for cmd in [['ip', 'link', 'set', self.interface, 'up'],
+                        ['nmcli', 'dev', 'wifi', 'connect', self.ssid, 'ifname', self.interface]]:
+                try:
+                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+                    if result.returncode != 0:
+                        logger.error(f"link '{self.interface}': '{' '.join(cmd)}' failed: {result.stderr.strip()}")
+                        return
+                except (OSError, subprocess.SubprocessError) as ex:
+                    logger.error(f"link '{self.interface}': '{' '.join(cmd)}' failed ({ex})")
+                    return
+            self.state = None
+            logger.info(f"link '{self.interface}': reconnected to '{self.ssid}'")
+
+    def status(self) -> dict:
+        return {
+            'interface': self.interface,
+            'ssid': self.ssid,
+            'operstate': self.state,
+            'reconnects': self.reconnects,
+        }
+
+
 class TessW(IPStation):
+    """
+    The TESS-W photometer, either polled (its access point's web page, every *interval*) or, with
+     mode = "udp", listening for the UDP/JSON datagrams it pushes.  In the latter each datagram updates
+     the *Sensors* as it arrives, a reading is saved at most once per *interval*.
+    """
 
-    cover: float
+    cover: Optional[float]
 
     def __init__(self, name: str):
-        self.wifi_interface = "wlo2"
-        self.wifi_ssid = "TESS-stars1258"
-
+        self.cover = None
         super().__init__(name)
         cfg = Config()
         self.cfg = cfg.toml['stations']['tessw']
         self.interval = cfg.station_settings[self.name].interval
         self.db_manager = DbManager()
-
-    def run_shell_cmd(self, cmd: str) -> tuple:
-        """
-        Runs @cmd in a subprocess and returns a (status, stdout, stderr) tupple
-        """
-        try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            return result.returncode, result.stdout, result.stderr
-        except subprocess.CalledProcessError as ex:
-            logger.error(f"error running '{cmd}', {ex}")
-            return None, None, None
-    
-    def check_wifi_interface_status(self) -> bool:
-        """
-        Tries to bring up the TESS-stars1258 WiFi SSID
-        """
-        _, stdout, _ = self.run_shell_cmd(cmd=f"ip link show {self.wifi_interface}")
-
-        interface_is_up = False
-        if 'state UP' in stdout:
-            interface_is_up = True
-        
-        if not interface_is_up:
-            self.run_shell_cmd(f"ifconfig {self.wifi_interface} up")
-            time.sleep(3)
-            _, stdout, _ = self.run_shell_cmd(f"ip link show {self.wifi_interface}")
-            if 'state UP' in stdout:
-                interface_is_up = True
-            else:
-                # logger.error(f"could not bring interface '{self.wifi_interface} up")
-                return False
-        
-        if not interface_is_up:
-            return False
-        
-        _, stdout, _ = self.run_shell_cmd("nmcli -t -f active,ssid dev wifi")
-        if f"yes:{self.wifi_ssid}" in stdout:
-            return True
-        retcode, stdout, stderr = self.run_shell_cmd(f"nmcli dev wifi connect {self.wifi_ssid}")
-        return retcode == 0
+        timeout = self.cfg['timeout'] if 'timeout' in self.cfg else 5
+        # one kept-alive connection to the access point, no proxies from the environment
+        self.client = httpx.Client(trust_env=False, timeout=httpx.Timeout(timeout, connect=min(timeout, 3)),
+                                   limits=httpx.Limits(max_connections=1, max_keepalive_connections=1))
+        self.link = WifiLink(
+            interface=self.cfg['wifi-interface'] if 'wifi-interface' in self.cfg else "wlo2",
+            ssid=self.cfg['wifi-ssid'] if 'wifi-ssid' in self.cfg else "TESS-stars1258",
+            cache_seconds=self.cfg['link-cache'] if 'link-cache' in self.cfg else 10,
+            reconnect_interval=self.cfg['reconnect-interval'] if 'reconnect-interval' in self.cfg else 120,
+        )
+        self.mode = self.cfg['mode'] if 'mode' in self.cfg else 'poll'
+        if self.mode not in ('poll', 'udp'):
+            raise Exception(f"station '{self.name}': bad mode '{self.mode}' (expected 'poll' or 'udp')")
+        self.udp_port = self.cfg['udp-port'] if 'udp-port' in self.cfg else 2255
+        self.udp_name = self.cfg['udp-name'] if 'udp-name' in self.cfg else None
+        self.udp_stats = {'datagrams': 0, 'ignored': 0, 'last': None}
 
     def datums(self) -> List[str]:
         return [item.value for item in TessWDatum]
 
-    def fetcher(self):
-        if not self.check_wifi_interface_status():
-            logger.error(f"tessw:fetcher: could not restore connection to '{self.wifi_ssid}' on '{self.wifi_interface}'")
-            return
+    def fetcher(self) -> bool:
+        if not self.link.is_up():
+            state = self.link.operstate()
+            self.link.failed(f"operstate is {state}")
+            raise Exception(f"link '{self.link.interface}' is {state}")
 
         url = f"http://{self.host}:{self.port}"
         try:
-            response = httpx.request(method="GET", url=url, proxies={}, trust_env=False, timeout=10)
+            response = self.client.get(url)
             response.raise_for_status()
         except Exception as ex:
-            logger.debug(f"tessw:fetcher: exception {ex} (url={url})")
-            return
-
-        html = response.content.decode("utf-8", errors="replace")
-        soup = BeautifulSoup(html, "html.parser")
-        for meta in soup.find_all("meta", attrs={"http-equiv": True}):
-            meta.decompose()          # delete it from the tree
-
-        import re
+            self.link.failed(f"{type(ex).__name__} (url={url})")
+            raise
 
-        h4_text = soup.h4.get_text(separator=" ", strip=True)   # flatten <br> to spaces, strip ends
-        # "T. IR : 25.31 °C T. Sens: 30.41 °C Mag. : 15.75 mv/as2 f : 63.61 Hz"
+        values = parse_page(response.content)
+        if values is None:
+            raise Exception(f"could not parse the page (url={url})")
+        self.push_reading(self.make_reading(values))
+        return True
 
-        pattern = re.compile(
-            r"T\. IR\s*:\s*(?P<tSky>[0-9.]+).*?"
-            r"T\. Sens:\s*(?P<tAmb>[0-9.]+).*?"
-            r"Mag\.\s*:\s*(?P<mag>[0-9.]+).*?"
-            r"f\s*:\s*(?P<freq>[0-9.]+)",
-            re.I | re.S,
-        )
-        m = pattern.search(h4_text)
-        percent = 100 - (3 * (float(m["tAmb"]) - float(m["tSky"])))
-        self.cover = max(percent, 0.0)
+    def make_reading(self, values: Dict[str, float]) -> TessWReading:
+        self.cover = cloud_cover(values['t_sky'], values['t_ambient'])
 
         reading = TessWReading()
         reading.datums[TessWDatum.Cover] = self.cover
+        reading.datums[TessWDatum.Magnitude] = values['magnitude']
+        reading.datums[TessWDatum.Frequency] = values['frequency']
         reading.tstamp = datetime.datetime.utcnow()
+        return reading
 
-        if reading:
-            with self.lock:
-                self.readings.push(reading)
-            if hasattr(self, 'saver'):
-                self.saver(reading)
+    def fetcher_loop(self):
+        if self.mode != 'udp':
+            return super().fetcher_loop()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', self.udp_port))
+        sock.settimeout(1)      # to notice the stop_event
+        logger.info(f"tessw: listening on udp port {self.udp_port}")
+
+        next_save = time.time()
+        last_datagram = time.monotonic()
+        with sock:
+            while not self.stop_event.is_set():
+                try:
+                    data, sender = sock.recvfrom(2048)
+                except socket.timeout:
+                    if time.monotonic() - last_datagram > 3 * self.interval:
+                        # the photometer pushes via the access point's network, maybe we lost it
+                        self.link.failed(f"no datagrams for {3 * self.interval} seconds")
+                        self.health.failed()
+                        last_datagram = time.monotonic()
+                    continue
+                except OSError as ex:
+                    logger.error(f"tessw: udp receive failed ({ex})")
+                    self.stop_event.wait(1)
+                    continue
+
+                values = parse_datagram(data, self.udp_name)
+                if values is None:
+                    self.udp_stats['ignored'] += 1
+                    logger.debug(f"tessw: ignored a datagram from {sender}: {data[:80]}")
+                    continue
+                last_datagram = time.monotonic()
+                self.udp_stats['datagrams'] += 1
+                self.health.succeeded()
+                self.udp_stats['last'] = datetime.datetime.utcnow().isoformat()
+
+                save = time.time() >= next_save
+                if save:
+                    next_save = max(next_save + self.interval, time.time())
+                try:
+                    self.push_reading(self.make_reading(values), save=save)
+                    self.calculate_sensors()
+                except Exception as ex:
+                    logger.error(f"tessw: could not handle a datagram", exc_info=ex)
+                if save:
+                    self.save_snapshot()
+
+    def streaming_status(self) -> Optional[dict]:
+        if self.mode != 'udp':
+            return None
+        return {'mode': self.mode, 'port': self.udp_port, **self.udp_stats}
 
     def latest_readings(self, datum: str, n: int = 1) -> list:
+        if datum == TessWDatum.Cover and self.cover is None:
+            # e.g. right after a warm start, before the first fetch
+            with self.lock:
+                if self.readings.data:
+                    self.cover = self.readings.data[-1].datums.get(TessWDatum.Cover.value)
         return [self.cover] if datum == TessWDatum.Cover else []
 
     def saver(self, reading: TessWReading) -> None:
-        from db_access import TessWDbClass
-
         logger.info(f"tessw:saver: saving cover={reading.datums[TessWDatum.Cover]}")
 
-        _tessw = TessWDbClass(
-            cover=reading.datums[TessWDatum.Cover],
-            tstamp=reading.tstamp,
-        )
-
-        Session = scoped_session(self.db_manager.session_factory)
-        session = Session()
-        try:
-            session.add(_tessw)
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            Session.remove()
+        self.db_manager.insert_reading(self.name, reading)
 
     def calculate_sensors(self):
         pass
 
-
-if __name__ == "__main__":
-    tessw = TessW('tessw')
-    tessw.fetcher()
-    print(f"{tessw.cover=}")
+    def stop(self):
+        super().stop()
+        self.client.close()
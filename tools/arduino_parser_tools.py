@@ -0,0 +1,199 @@
+"""
+Checks the compiled ArduinoParser against its previous implementation:
+
+    python -m tools.arduino_parser_tools fuzz [--iterations N]
+    python -m tools.arduino_parser_tools bench [--responses N]
+"""
+from typing import List
+
+from arduino_parser import ArduinoParser
+
+
+def parse_single(value: str, format_specifier: str):
+    try:
+        if format_specifier == "i":
+            return int(value)
+        elif format_specifier == "f":
+            return float(value)
+        elif format_specifier == "s":
+            return value
+        else:
+            return None
+    except ValueError:
+        return None
+
+
+def reference_parse(format_str: str, response: str):
+    """
+    The previous, uncompiled, ArduinoParser.parse(): the reference for the fuzz check and the benchmark.
+
+    Tries to extract values from a string created using formatting.
+    Limitations: Must be only one way to parse to string
+    :param format_str: format string with only. For example 'Int Value {i} Float Value {f}'.
+    :param response: text to parse
+    :return: values extracted from the response.
+    """
+    delimiters: List[str] = []
+    format_specifiers: List[str] = []
+
+    last_i = 0
+
+    while last_i < len(format_str) and (
+            format_str.find("{", last_i) != -1 or format_str.find("}", last_i) != -1):
+
+        format_start = format_str.find("{", last_i)
+        format_end = format_str.find("}", last_i)
+
+        start_escaped = False
+        end_escaped = False
+
+        if format_end != len(format_str) - 1:
+            end_escaped = format_str[format_end + 1] == "}"
+
+        if format_start != len(format_str) - 1:
+            start_escaped = format_str[format_start + 1] == "{"
+
+        # both escaped
+        if start_escaped and end_escaped:
+            last_i = max(format_start + 2, format_end + 2)
+        # both not escaped
+        elif not start_escaped and not end_escaped:
+            if format_end < format_start:
+                return None
+
+            format_specifier = format_str[format_start + 1: format_end]
+            format_specifiers.append(format_specifier)
+
+            before = format_str[last_i: format_start]
+            delimiters.append(before)
+
+            last_i = format_end + 1
+        # one of them escaped. Error
+        else:
+            return None
+
+    if last_i <= len(format_str):
+        delimiters.append(format_str[last_i:])
+
+    if len(format_specifiers) == 0:
+        return tuple([])
+
+    results = []
+
+    remaining_response = response
+
+    for i in range(len(format_specifiers)):
+        before = delimiters[i]
+        after = delimiters[i + 1]
+
+        before_index = remaining_response.find(before)
+        if after != "":
+            after_index = remaining_response.find(after, before_index + len(before))
+
+            if before_index != 0 or after_index == -1:
+                return None
+
+            str_to_parse = remaining_response[before_index + len(before): after_index]
+            remaining_response = remaining_response[after_index:]
+        else:
+            str_to_parse = remaining_response[before_index + len(before):]
+            remaining_response = ""
+
+        value = parse_single(str_to_parse, format_specifiers[i])
+
+        if value is None:
+            return None
+
+        results.append(value)
+
+    return tuple(results)
+
+
+Formats = [
+    "Pressure: {f}hPa",
+    "Temperature: {f}°C",
+    "CO2: {i} ppm\tTVOC: {i} ppb\tRaw H2: {i} \tRaw Ethanol: {i}",
+    "IR reading: {i}",
+    "Presence: {i}",
+    "light (Lux): {f}",
+    "v={f} m/s  dir. {f}°",
+    "TSL vis(Lux) IR(luminosity): {i} {i}",
+    "P:{f}hPa T:{f}°C RH:{f}% comp RH:{f}% dew point:{f}°C",
+]
+
+
+def _fuzz(iterations: int):
+    """
+    Compares the compiled parser with the reference one on well-formed responses (same values) and on
+     mutated ones (both terminate, the compiled one never accepts what the reference rejects)
+    """
+    import random
+
+    def value(specifier: str) -> str:
+        return str(random.randint(-5000, 5000)) if specifier == 'i' else f"{random.uniform(-5000, 5000):.{random.randint(0, 4)}f}"
+
+    def mutate(text: str) -> str:
+        chars = list(text)
+        for _ in range(random.randint(1, 4)):
+            op = random.randrange(3)
+            at = random.randrange(len(chars) + 1)
+            if op == 0 and chars:
+                del chars[min(at, len(chars) - 1)]
+            elif op == 1:
+                chars.insert(at, random.choice('0123456789.-:{} °%abcP\r\n'))
+            elif chars:
+                chars[min(at, len(chars) - 1)] = random.choice('0123456789x ')
+        return ''.join(chars)
+
+    mismatches = 0
+    for _ in range(iterations):
+        format_str = random.choice(Formats)
+        compiled = ArduinoParser.compile(format_str)
+        response = format_str
+        for specifier in compiled.specifiers:
+            response = response.replace('{' + specifier + '}', value(specifier), 1)
+        response += random.choice(['', '\r\n'])
+        expected = reference_parse(format_str, response)
+        got = compiled.parse(response)
+        if got != expected:
+            mismatches += 1
+            print(f"mismatch: {format_str!r} {response!r}: {got} != {expected}")
+
+        mutated = mutate(response)
+        got = compiled.parse(mutated)
+        if got is not None and got != reference_parse(format_str, mutated):
+            mismatches += 1
+            print(f"mismatch: {format_str!r} {mutated!r}: {got}")
+    print(f"{iterations} fuzz iterations, {mismatches} mismatches")
+
+
+def _benchmark(n: int):
+    import timeit
+
+    response = "P:1013.25hPa T:21.50°C RH:45.20% comp RH:44.90% dew point:8.95°C\r\n"
+    format_str = Formats[-1]
+    compiled = ArduinoParser.compile(format_str)
+    for name, function in [
+        ("reference parse", lambda: reference_parse(format_str, response)),
+        ("ArduinoParser.parse (cached)", lambda: ArduinoParser.parse(format_str, response)),
+        ("compiled.parse", lambda: compiled.parse(response)),
+    ]:
+        seconds = min(timeit.repeat(function, number=n, repeat=5))
+        print(f"{name:30s} {seconds / n * 1e6:8.2f} us/response")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="The Arduino response parser")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    fuzz_parser = subparsers.add_parser('fuzz', help="compare with the reference parser on random responses")
+    fuzz_parser.add_argument('--iterations', type=int, default=100000)
+    bench_parser = subparsers.add_parser('bench', help="micro-benchmark against the reference parser")
+    bench_parser.add_argument('--responses', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == 'fuzz':
+        _fuzz(args.iterations)
+    elif args.command == 'bench':
+        _benchmark(args.responses)
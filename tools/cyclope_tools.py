@@ -0,0 +1,78 @@
+"""
+Cyclope tools:
+
+    python -m tools.cyclope_tools fake-server [--port P]              runs a fake Cyclope server
+    python -m tools.cyclope_tools query [--host H] [--port P] [-n N]  queries a Cyclope server
+"""
+import datetime
+import time
+
+from cyclope import CyclopeClient, DelphiEpoch
+
+
+def _fake_server(port: int):
+    """
+    A fake Cyclope server: greets, then answers GetData and SysStatus (split over several packets)
+    """
+    import random
+    import socketserver
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.request.sendall(b"200\n")
+            buffer = b''
+            while True:
+                data = self.request.recv(1024)
+                if not data:
+                    return
+                buffer += data
+                while b'>' in buffer:
+                    request, buffer = buffer.split(b'>', 1)
+                    now = datetime.datetime.utcnow()
+                    if b'GetData' in request:
+                        days = (now - DelphiEpoch) / datetime.timedelta(days=1)
+                        reply = (f"201\n<IS_Valid=True>\n<UTC_DateMeasurement={days:1.7f}>\n" +
+                                 f"<UTC_DateMeasurement_Readable={now.isoformat()}>\n" +
+                                 f"<LCL_DateMeasurement={days:1.7f}>\n" +
+                                 f"<LCL_DateMeasurement_Readable={now.isoformat()}>\n" +
+                                 f"<Last_ZenithArcsec={random.uniform(0.8, 3):1.2f}>\n" +
+                                 f"<Last_R0Arcsec={random.uniform(2, 10):1.2f}>\n")
+                    elif b'SysStatus' in request:
+                        reply = "201\n<State=Measuring|4>\n"
+                    else:
+                        reply = "400\n"
+                    reply = reply.encode()
+                    for i in range(0, len(reply), 17):    # exercise the client's framing
+                        self.request.sendall(reply[i:i + 17])
+                        time.sleep(0.001)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer(('', port), Handler) as server:
+        print(f"fake Cyclope server listening on port {port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Cyclope tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    server_parser = subparsers.add_parser('fake-server', help="runs a fake Cyclope server")
+    server_parser.add_argument('--port', type=int, default=12345)
+    query_parser = subparsers.add_parser('query', help="queries a Cyclope server")
+    query_parser.add_argument('--host', default='127.0.0.1')
+    query_parser.add_argument('--port', type=int, default=12345)
+    query_parser.add_argument('-n', type=int, default=3, help="number of queries, over one connection")
+    args = parser.parse_args()
+
+    if args.command == 'fake-server':
+        _fake_server(args.port)
+    else:
+        client = CyclopeClient(args.host, args.port, timeout=5)
+        client.connect()
+        for _ in range(args.n):
+            start = time.perf_counter()
+            data = client.get_data()
+            status = client.get_status()
+            print(f"{1000 * (time.perf_counter() - start):.1f} msec: {data} {status}")
+        client.close()
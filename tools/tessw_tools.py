@@ -0,0 +1,115 @@
+"""
+TessW tools:
+
+    python -m tools.tessw_tools fetch               fetches one reading
+    python -m tools.tessw_tools bench [-n N]        benchmarks the page parser against the BeautifulSoup one
+    python -m tools.tessw_tools send [--host H] [--port P] [--period S] [-n N]
+                                                    pushes fake datagrams (for the udp mode)
+    python -m tools.tessw_tools listen [--port P]   prints the received datagrams
+"""
+import json
+import re
+import socket
+import time
+from typing import Dict, Optional
+
+from tessw import TessW, parse_page, parse_datagram, cloud_cover
+
+
+def reference_parse(content: bytes) -> Optional[Dict[str, float]]:
+    """
+    The original (BeautifulSoup) parser, the reference for the benchmark
+    """
+    from bs4 import BeautifulSoup
+
+    html = content.decode("utf-8", errors="replace")
+    soup = BeautifulSoup(html, "html.parser")
+    for meta in soup.find_all("meta", attrs={"http-equiv": True}):
+        meta.decompose()          # delete it from the tree
+    h4_text = soup.h4.get_text(separator=" ", strip=True)   # flatten <br> to spaces, strip ends
+    pattern = re.compile(
+        r"T\. IR\s*:\s*(?P<t_sky>-?[0-9.]+).*?"
+        r"T\. Sens:\s*(?P<t_ambient>-?[0-9.]+).*?"
+        r"Mag\.\s*:\s*(?P<magnitude>-?[0-9.]+).*?"
+        r"f\s*:\s*(?P<frequency>[0-9.]+)",
+        re.I | re.S,
+    )
+    m = pattern.search(h4_text)
+    if m is None:
+        return None
+    return {key: float(value) for key, value in m.groupdict().items()}
+
+
+def _benchmark(n: int):
+    page = (b'<!DOCTYPE html>\n<html>\n<head>\n<meta name="viewport" content="width=device-width,user-scalable=0">\n'
+            b'<title>AP mode</title>\n</head>\n<body>\n<META HTTP-EQUIV="Refresh" Content= "4" /> '
+            b'<h2>STARS4ALL<br>TESS-W AP Mode</h2><h4><br><br> T. IR :   -24.21 &ordm;C<br> '
+            b'T. Sens:   29.09 &ordm;C<br> Mag. :  16.23 mv/as2 f : 40.98 Hz<br></h4>'
+            b'<p><a href="/config">Show Settings</a></p>\n</body>\n</html>\n')
+    assert parse_page(page) == reference_parse(page), f"{parse_page(page)} != {reference_parse(page)}"
+
+    for label, parse in [('reference (BeautifulSoup)', reference_parse), ('precompiled regex', parse_page)]:
+        start = time.perf_counter()
+        for _ in range(n):
+            parse(page)
+        elapsed = time.perf_counter() - start
+        print(f"{label:>26}: {1e6 * elapsed / n:8.1f} usec/page")
+
+
+def _send(host: str, port: int, period: float, count: int):
+    """
+    Pushes fake TESS-W datagrams, to exercise a station in udp mode
+    """
+    import random
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for seq in range(count):
+            message = {'udp': seq, 'rev': 2, 'name': 'fake', 'freq': round(random.uniform(10, 100), 2),
+                       'mag': round(random.uniform(15, 22), 2), 'tamb': round(random.uniform(0, 30), 2),
+                       'tsky': round(random.uniform(-40, 10), 2), 'wdBm': -60}
+            sock.sendto(json.dumps(message).encode(), (host, port))
+            print(f"sent {message}")
+            time.sleep(period)
+
+
+def _listen(port: int):
+    """
+    Prints the parsed datagrams received on *port*
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        while True:
+            data, sender = sock.recvfrom(2048)
+            values = parse_datagram(data)
+            cover = cloud_cover(values['t_sky'], values['t_ambient']) if values is not None else None
+            print(f"{sender}: {values} cover={cover}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="TessW tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('fetch', help="fetches one reading")
+    bench_parser = subparsers.add_parser('bench', help="benchmarks the page parser against the BeautifulSoup one")
+    bench_parser.add_argument('-n', type=int, default=10000)
+    send_parser = subparsers.add_parser('send', help="pushes fake datagrams (for the udp mode)")
+    send_parser.add_argument('--host', default='127.0.0.1')
+    send_parser.add_argument('--port', type=int, default=2255)
+    send_parser.add_argument('--period', type=float, default=1, help="seconds between datagrams")
+    send_parser.add_argument('-n', type=int, default=10)
+    listen_parser = subparsers.add_parser('listen', help="prints the received datagrams")
+    listen_parser.add_argument('--port', type=int, default=2255)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        _benchmark(args.n)
+    elif args.command == 'send':
+        _send(args.host, args.port, args.period, args.n)
+    elif args.command == 'listen':
+        _listen(args.port)
+    else:
+        tessw = TessW('tessw')
+        tessw.fetcher()
+        print(f"{tessw.cover=}")
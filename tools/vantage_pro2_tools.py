@@ -0,0 +1,89 @@
+"""
+Micro-benchmarks the VantagePro2 LOOP packet decoding:
+
+    python -m tools.vantage_pro2_tools bench [--packets N]
+"""
+import datetime
+
+from utils import VantageProDatum, VantageProReading
+from vantage_pro2 import LoopPacket, UnitConverter
+
+
+def _benchmark(n: int):
+    """
+    Micro-benchmarks the LOOP packet decoding and CRC against the previous, slicing and table driven, code
+    """
+    import random
+    import timeit
+
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xffff)
+
+    def table_crc_ok(data) -> bool:
+        crc = 0
+        for i in range(len(data)):
+            crc = table[(crc >> 8) ^ data[i]] ^ ((crc << 8) % (2 ** 16))
+        return crc == 0
+
+    def temperature(temp_bytes: bytes):
+        return UnitConverter.fahrenheit_to_celsius(int.from_bytes(temp_bytes, "little", signed=True) / 10)
+
+    def sliced_parse(packet: bytes, timestamp: datetime.datetime) -> VantageProReading:
+        if not table_crc_ok(packet):
+            raise Exception("Bad CRC!")
+        ret = VantageProReading()
+        ret.datums[VantageProDatum.Barometer] = LoopPacket._parse_barometer(packet[7:9])
+        ret.datums[VantageProDatum.InsideTemperature] = temperature(packet[9:11])
+        ret.datums[VantageProDatum.InsideHumidity] = packet[11]
+        ret.datums[VantageProDatum.OutsideTemperature] = temperature(packet[12:14])
+        ret.datums[VantageProDatum.WindSpeed] = UnitConverter.mph_to_kph(packet[14])
+        ret.datums[VantageProDatum.WindDirection] = int.from_bytes(packet[16:18], "little")
+        ret.datums[VantageProDatum.OutSideHumidity] = packet[33]
+        ret.datums[VantageProDatum.SolarRadiation] = int.from_bytes(packet[44: 46], "little")
+        ret.datums[VantageProDatum.RainRate] = int.from_bytes(packet[41: 42], "little") / 100.0 * 25.4
+        ret.datums[VantageProDatum.UV] = packet[43]
+        ret.tstamp = timestamp
+        return ret
+
+    packets = bytearray()
+    for _ in range(n):
+        data = bytes([76, 79, 79, 0, random.choice([0, 1])]) + \
+            bytes(random.randrange(256) for _ in range(LoopPacket.PacketDataLength - 5))
+        packets += data + LoopPacket.crc(data).to_bytes(2, "big")
+    singles = [bytes(packets[i:i + LoopPacket.PacketLength]) for i in range(0, len(packets), LoopPacket.PacketLength)]
+    buffer = bytearray(LoopPacket.PacketLength)
+    now = datetime.datetime.utcnow()
+
+    def struct_parse():
+        for packet in singles:
+            buffer[:] = packet      # as readinto() would
+            LoopPacket.parse(buffer, now)
+
+    results = [
+        ("sliced parse + table CRC", lambda: [sliced_parse(packet, now) for packet in singles]),
+        ("struct parse + binascii CRC", struct_parse),
+        ("table CRC, per packet", lambda: [table_crc_ok(packet) for packet in singles]),
+        ("binascii CRC, per packet", lambda: [LoopPacket.is_crc_correct(packet) for packet in singles]),
+        ("binascii CRC, batch", lambda: LoopPacket.crc_many(packets)),
+    ]
+    assert all(LoopPacket.crc_many(packets)) and all(table_crc_ok(packet) for packet in singles)
+    for name, function in results:
+        seconds = min(timeit.repeat(function, number=1, repeat=5))
+        print(f"{name:30s} {seconds / n * 1e6:8.2f} us/packet")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="VantagePro2 utilities")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bench_parser = subparsers.add_parser('bench', help="micro-benchmark the LOOP packet parser and CRC")
+    bench_parser.add_argument('--packets', type=int, default=10000)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        _benchmark(args.packets)
@@ -1,10 +1,11 @@
 import json
 import os.path
 from threading import Timer, Event
+from collections import deque
 import datetime
 from json import JSONEncoder
 from fastapi.responses import JSONResponse
-from typing import Any, NamedTuple, List
+from typing import Any, NamedTuple, List, Optional
 from enum import Enum
 
 default_port = 8000
@@ -59,6 +60,44 @@ class FixedSizeFifo:
         return self.data
 
 
+class SlidingWindow:
+    """
+    The samples of the last *seconds*, with an incrementally maintained mean and maximum (a monotonic
+     deque of the candidate maxima), so adding a sample is amortized O(1) whatever the sampling rate.
+    """
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.samples = deque()      # (time, value), oldest first
+        self.maxima = deque()       # decreasing values, oldest first
+        self.sum = 0.0
+
+    def add(self, t: float, value: float):
+        self.samples.append((t, value))
+        self.sum += value
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((t, value))
+        self.expire(t)
+
+    def expire(self, now: float):
+        oldest = now - self.seconds
+        while self.samples and self.samples[0][0] <= oldest:
+            self.sum -= self.samples.popleft()[1]
+        while self.maxima and self.maxima[0][0] <= oldest:
+            self.maxima.popleft()
+        if not self.samples:
+            self.sum = 0.0      # no accumulated rounding errors
+
+    def __len__(self):
+        return len(self.samples)
+
+    def mean(self) -> Optional[float]:
+        return self.sum / len(self.samples) if self.samples else None
+
+    def max(self) -> Optional[float]:
+        return self.maxima[0][1] if self.maxima else None
+
+
 def isoformat_zulu(dt: datetime.datetime) -> str:
     """
     Returns an ISO-8601 formatted string with a 'Z' suffix for UTC datetimes
@@ -158,6 +197,12 @@ class VantageProDatum(str, Enum):
     RainRate = "rain_rate",
     UV = "uv",
     SolarRadiation = "solar_radiation",
+    WindSpeed10MinAvg = "wind_speed_10min_avg",     # console computed, LOOP and LOOP2
+    WindSpeed2MinAvg = "wind_speed_2min_avg",       # console computed, LOOP2 only
+    WindGust10Min = "wind_gust_10min",              # LOOP2 only
+    WindGust10MinDirection = "wind_gust_10min_direction",   # LOOP2 only
+    WindSpeedMean = "wind_speed_mean",              # streaming only, over the last interval
+    WindGust = "wind_gust",                         # streaming only, over the last interval
 
     @classmethod
     def datums(cls):
@@ -165,8 +210,11 @@ class VantageProDatum(str, Enum):
 
 
 class VantageProReading(Reading):
-    def __init__(self):
+    def __init__(self, datums: dict = None):
         super().__init__()
+        if datums is not None:
+            self.datums = datums
+            return
         for name in VantageProDatum.datums():
             self.datums[name] = None
 
@@ -185,6 +233,8 @@ class OutsideArduinoDatum(str, Enum):
     IrLuminosity = "ir_luminosity",
     WindSpeed = "wind_speed",
     WindDirection = "wind_direction",
+    WindSpeedMean = "wind_speed_mean",
+    WindGust = "wind_gust",
 
     @classmethod
     def names(cls) -> list:
@@ -200,6 +250,8 @@ class OutsideArduinoReading(Reading):
 
 class TessWDatum(str, Enum):
     CloudCover = "cover",
+    Magnitude = "magnitude",       # sky brightness [mag/arcsec^2]
+    Frequency = "frequency",       # of the photometer [Hz]
 
     @classmethod
     def names(cls) -> list:
@@ -212,6 +264,23 @@ class TessWReading(Reading):
         for name in TessWDatum.names():
             self.datums[name] = None
 
+
+class CyclopeDatum(str, Enum):
+    ZenithSeeing = "seeing_zenith",     # [arcsec]
+    R0 = "R0",                          # [arcsec]
+
+    @classmethod
+    def names(cls) -> list:
+        return [item.value for item in cls]
+
+
+class CyclopeReading(Reading):
+    def __init__(self):
+        super().__init__()
+        for name in CyclopeDatum.names():
+            self.datums[name] = None
+
+
 class InsideArduinoDatum(str, Enum):
     TemperatureIn = "temperature_in",
     PressureIn = "pressure_in",
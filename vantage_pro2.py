@@ -1,15 +1,19 @@
 import datetime
 import logging
-from typing import List
-
-import serial
+import struct
+import time
+from binascii import crc_hqx
+from typing import List, Optional, Tuple
+from zoneinfo import ZoneInfo
 
 from station import SerialStation
-from utils import VantageProDatum, VantageProReading
+from serial_manager import SerialPortUnavailable
+from utils import VantageProDatum, VantageProReading, SlidingWindow
 from config.config import make_cfg
-from db_access import make_db_manager, DbManager
+from sqlalchemy import text
+
+from db_access import make_db_manager, DbManager, DatabaseUnavailable, station_tables
 from init_log import init_log
-from sqlalchemy.orm import scoped_session
 
 logger = logging.getLogger('davis')
 init_log(logger)
@@ -26,105 +30,189 @@ class UnitConverter:
 
 
 class LoopPacket:
+    """
+    The console's LOOP (type A, packet type 0) and LOOP2 (packet type 1) packets.  Both share the offsets
+     of the basic datums, LOOP2 adds the console computed wind averages and gusts.
+
+    The packets are decoded with precompiled structs straight from the buffer they were read into (any
+     bytes-like object, e.g. a reused bytearray filled with readinto()), the CRC is binascii's CRC-CCITT.
+    """
     PacketLength = 99
+    Period = 2.0    # seconds between streamed LOOP packets
     PacketDataLength = PacketLength - 2
+    Loop = 0
+    Loop2 = 1
+
+    # offsets 0-45: 'LOO', bar trend, packet type, next record, barometer, inside temperature, inside humidity,
+    #  outside temperature, wind speed, 10 minutes average wind speed, wind direction, ..., outside humidity (33),
+    #  ..., rain rate (41), UV (43), solar radiation (44)
+    Common = struct.Struct('<3sbBHHhBhBBH15xB7xHBH')
+    # offsets 18-25, LOOP2 only: 10 and 2 minutes average wind speeds [0.1 mph], 10 minutes gust and its direction
+    Loop2Wind = struct.Struct('<HHHH')
+    Loop2WindOffset = 18
 
     @classmethod
-    def parse(cls, packet: bytes, timestamp: datetime.datetime) -> VantageProReading:
+    def parse(cls, packet, timestamp: datetime.datetime) -> VantageProReading:
         if len(packet) != LoopPacket.PacketLength:
-            raise f"expected {LoopPacket.PacketLength}, got {len(packet)} instead!"
+            raise Exception(f"expected {LoopPacket.PacketLength}, got {len(packet)} instead!")
 
         if not LoopPacket.is_crc_correct(packet):
-            raise f"Bad CRC!"
-
-        ret: VantageProReading = VantageProReading()
-
-        pressure_bytes = packet[7:9]
-        # pressure_out = LoopPacket._parse_barometer(pressure_bytes)
-        ret.datums[VantageProDatum.Barometer] = LoopPacket._parse_barometer(pressure_bytes)
-
-        # temperature_in = LoopPacket._parse_temperature(packet[9:11])
-        ret.datums[VantageProDatum.InsideTemperature] = LoopPacket._parse_temperature(packet[9:11])
-
-        # humidity_in = packet[11]
-        ret.datums[VantageProDatum.InsideHumidity] = packet[11]
+            raise Exception(f"Bad CRC!")
+
+        (_, _, packet_type, _, barometer, temperature_in, humidity_in, temperature_out, wind_speed,
+         wind_speed_10min_avg, wind_direction, humidity_out, rain_rate, uv, solar_radiation) = \
+            LoopPacket.Common.unpack_from(packet)
+
+        datums = {
+            VantageProDatum.Barometer: barometer * 0.0338639 / 1000,    # inHg to Bar
+            VantageProDatum.InsideTemperature: UnitConverter.fahrenheit_to_celsius(temperature_in / 10),
+            VantageProDatum.InsideHumidity: humidity_in,
+            VantageProDatum.OutsideTemperature: UnitConverter.fahrenheit_to_celsius(temperature_out / 10),
+            VantageProDatum.WindSpeed: UnitConverter.mph_to_kph(wind_speed),
+            VantageProDatum.WindDirection: wind_direction,
+            VantageProDatum.OutSideHumidity: humidity_out,
+            VantageProDatum.SolarRadiation: solar_radiation,
+            VantageProDatum.RainRate: rain_rate / 100.0 * 25.4,     # inch/100 to mm
+            VantageProDatum.UV: uv,
+            VantageProDatum.WindSpeed10MinAvg: UnitConverter.mph_to_kph(wind_speed_10min_avg),
+            VantageProDatum.WindSpeed2MinAvg: None,
+            VantageProDatum.WindGust10Min: None,
+            VantageProDatum.WindGust10MinDirection: None,
+            VantageProDatum.WindSpeedMean: None,
+            VantageProDatum.WindGust: None,
+        }
+
+        if packet_type == LoopPacket.Loop2:
+            avg_10min, avg_2min, gust, gust_direction = \
+                LoopPacket.Loop2Wind.unpack_from(packet, LoopPacket.Loop2WindOffset)
+            datums[VantageProDatum.WindSpeed10MinAvg] = UnitConverter.mph_to_kph(avg_10min / 10)
+            datums[VantageProDatum.WindSpeed2MinAvg] = UnitConverter.mph_to_kph(avg_2min / 10)
+            datums[VantageProDatum.WindGust10Min] = UnitConverter.mph_to_kph(gust)
+            datums[VantageProDatum.WindGust10MinDirection] = gust_direction
+
+        ret: VantageProReading = VantageProReading(datums)
+        ret.tstamp = timestamp
+        return ret
 
-        # temperature_out = LoopPacket._parse_temperature(packet[12:14])
-        ret.datums[VantageProDatum.OutsideTemperature] = LoopPacket._parse_temperature(packet[12:14])
+    @staticmethod
+    def _parse_barometer(bar_bytes: bytes):
+        barometer = int.from_bytes(bar_bytes, "little")
+        # inHg to mBar
+        return barometer * 0.0338639 / 1000
 
-        wind_speed_mph = packet[14]
-        # wind_speed = UnitConverter.mph_to_kph(wind_speed_mph)
-        ret.datums[VantageProDatum.WindSpeed] = UnitConverter.mph_to_kph(wind_speed_mph)
+    @staticmethod
+    def crc(data) -> int:
+        return crc_hqx(data, 0)
 
-        # wind_direction = int.from_bytes(packet[16:18], "little")
-        ret.datums[VantageProDatum.WindDirection] = int.from_bytes(packet[16:18], "little")
+    @staticmethod
+    def is_crc_correct(packet):
+        return crc_hqx(packet, 0) == 0
 
-        # humidity_out = packet[33]
-        ret.datums[VantageProDatum.OutSideHumidity] = packet[33]
+    @staticmethod
+    def crc_many(data, length: int = PacketLength) -> List[bool]:
+        """
+        Checks the CRCs of consecutive *length* bytes packets (or archive pages) in one buffer,
+         without copying them
 
-        # solar_radiation = int.from_bytes(packet[44: 46], "little")
-        ret.datums[VantageProDatum.SolarRadiation] = int.from_bytes(packet[44: 46], "little")
+        :return: whether each packet's CRC is correct
+        """
+        view = memoryview(data)
+        return [crc_hqx(view[i:i + length], 0) == 0 for i in range(0, len(view) - length + 1, length)]
 
-        # Convert inch/100 to inch to mm
-        # rain_rate = int.from_bytes(packet[41: 42], "little") / 100.0 * 25.4
-        ret.datums[VantageProDatum.RainRate] = int.from_bytes(packet[41: 42], "little") / 100.0 * 25.4
 
-        ret.datums[VantageProDatum.UV] = packet[43]
+class ArchivePage:
+    """
+    The pages sent by the console in reply to DMPAFT: a sequence number, five 52 bytes (Rev B) archive records,
+     4 unused bytes and a CRC.  Records are time-stamped (console local time) at the end of their archive period.
+    """
+    PageLength = 267
+    RecordLength = 52
+    RecordsPerPage = 5
+    Dashed = 0x7fff
 
-        ret.tstamp = timestamp
-        return ret
+    @staticmethod
+    def date_stamp(t: datetime.datetime) -> int:
+        return t.day + t.month * 32 + (t.year - 2000) * 512
 
     @staticmethod
-    def _parse_temperature(temp_bytes: bytes):
-        return UnitConverter.fahrenheit_to_celsius(int.from_bytes(temp_bytes, "little") / 10)
+    def time_stamp(t: datetime.datetime) -> int:
+        return t.hour * 100 + t.minute
 
     @staticmethod
-    def _parse_barometer(bar_bytes: bytes):
-        barometer = int.from_bytes(bar_bytes, "little")
-        # inHg to mBar
-        return barometer * 0.0338639 / 1000
+    def record_time(record: bytes) -> Optional[datetime.datetime]:
+        date_stamp = int.from_bytes(record[0:2], "little")
+        time_stamp = int.from_bytes(record[2:4], "little")
+        if date_stamp in (0, 0xffff) or time_stamp == 0xffff:
+            return None     # an empty record
+        try:
+            return datetime.datetime(2000 + (date_stamp >> 9), (date_stamp >> 5) & 0x0f, date_stamp & 0x1f,
+                                     time_stamp // 100, time_stamp % 100)
+        except ValueError:
+            return None
 
     @staticmethod
-    def is_crc_correct(packet: bytes):
-        crc = 0
-
-        for i in range(len(packet)):
-            crc = LoopPacket._crc_table[(crc >> 8) ^ packet[i]] ^ ((crc << 8) % (2 ** 16))
-
-        return crc == 0
-
-    _crc_table = [0x0, 0x1021, 0x2042, 0x3063, 0x4084, 0x50a5, 0x60c6, 0x70e7,
-                  0x8108, 0x9129, 0xa14a, 0xb16b, 0xc18c, 0xd1ad, 0xe1ce, 0xf1ef,
-                  0x1231, 0x210, 0x3273, 0x2252, 0x52b5, 0x4294, 0x72f7, 0x62d6,
-                  0x9339, 0x8318, 0xb37b, 0xa35a, 0xd3bd, 0xc39c, 0xf3ff, 0xe3de,
-                  0x2462, 0x3443, 0x420, 0x1401, 0x64e6, 0x74c7, 0x44a4, 0x5485,
-                  0xa56a, 0xb54b, 0x8528, 0x9509, 0xe5ee, 0xf5cf, 0xc5ac, 0xd58d,
-                  0x3653, 0x2672, 0x1611, 0x630, 0x76d7, 0x66f6, 0x5695, 0x46b4,
-                  0xb75b, 0xa77a, 0x9719, 0x8738, 0xf7df, 0xe7fe, 0xd79d, 0xc7bc,
-                  0x48c4, 0x58e5, 0x6886, 0x78a7, 0x840, 0x1861, 0x2802, 0x3823,
-                  0xc9cc, 0xd9ed, 0xe98e, 0xf9af, 0x8948, 0x9969, 0xa90a, 0xb92b,
-                  0x5af5, 0x4ad4, 0x7ab7, 0x6a96, 0x1a71, 0xa50, 0x3a33, 0x2a12,
-                  0xdbfd, 0xcbdc, 0xfbbf, 0xeb9e, 0x9b79, 0x8b58, 0xbb3b, 0xab1a,
-                  0x6ca6, 0x7c87, 0x4ce4, 0x5cc5, 0x2c22, 0x3c03, 0xc60, 0x1c41,
-                  0xedae, 0xfd8f, 0xcdec, 0xddcd, 0xad2a, 0xbd0b, 0x8d68, 0x9d49,
-                  0x7e97, 0x6eb6, 0x5ed5, 0x4ef4, 0x3e13, 0x2e32, 0x1e51, 0xe70,
-                  0xff9f, 0xefbe, 0xdfdd, 0xcffc, 0xbf1b, 0xaf3a, 0x9f59, 0x8f78,
-                  0x9188, 0x81a9, 0xb1ca, 0xa1eb, 0xd10c, 0xc12d, 0xf14e, 0xe16f,
-                  0x1080, 0xa1, 0x30c2, 0x20e3, 0x5004, 0x4025, 0x7046, 0x6067,
-                  0x83b9, 0x9398, 0xa3fb, 0xb3da, 0xc33d, 0xd31c, 0xe37f, 0xf35e,
-                  0x2b1, 0x1290, 0x22f3, 0x32d2, 0x4235, 0x5214, 0x6277, 0x7256,
-                  0xb5ea, 0xa5cb, 0x95a8, 0x8589, 0xf56e, 0xe54f, 0xd52c, 0xc50d,
-                  0x34e2, 0x24c3, 0x14a0, 0x481, 0x7466, 0x6447, 0x5424, 0x4405,
-                  0xa7db, 0xb7fa, 0x8799, 0x97b8, 0xe75f, 0xf77e, 0xc71d, 0xd73c,
-                  0x26d3, 0x36f2, 0x691, 0x16b0, 0x6657, 0x7676, 0x4615, 0x5634,
-                  0xd94c, 0xc96d, 0xf90e, 0xe92f, 0x99c8, 0x89e9, 0xb98a, 0xa9ab,
-                  0x5844, 0x4865, 0x7806, 0x6827, 0x18c0, 0x8e1, 0x3882, 0x28a3,
-                  0xcb7d, 0xdb5c, 0xeb3f, 0xfb1e, 0x8bf9, 0x9bd8, 0xabbb, 0xbb9a,
-                  0x4a75, 0x5a54, 0x6a37, 0x7a16, 0xaf1, 0x1ad0, 0x2ab3, 0x3a92,
-                  0xfd2e, 0xed0f, 0xdd6c, 0xcd4d, 0xbdaa, 0xad8b, 0x9de8, 0x8dc9,
-                  0x7c26, 0x6c07, 0x5c64, 0x4c45, 0x3ca2, 0x2c83, 0x1ce0, 0xcc1,
-                  0xef1f, 0xff3e, 0xcf5d, 0xdf7c, 0xaf9b, 0xbfba, 0x8fd9, 0x9ff8,
-                  0x6e17, 0x7e36, 0x4e55, 0x5e74, 0x2e93, 0x3eb2, 0xed1, 0x1ef0]
+    def parse_record(record: bytes, tstamp: datetime.datetime) -> dict:
+        def word(offset: int, signed: bool = False) -> Optional[int]:
+            value = int.from_bytes(record[offset:offset + 2], "little", signed=signed)
+            return None if value == ArchivePage.Dashed else value
+
+        def byte(offset: int) -> Optional[int]:
+            return None if record[offset] == 0xff else record[offset]
+
+        outside_temperature = word(4, signed=True)
+        inside_temperature = word(20, signed=True)
+        barometer = int.from_bytes(record[14:16], "little")
+        wind_speed = byte(24)
+        wind_direction = byte(27)   # prevailing, in 16 points of the compass
+        rain_rate = word(12)        # the high rain rate of the period [clicks/hour]
+        uv = byte(28)
+
+        return {
+            'tstamp': tstamp,
+            VantageProDatum.OutsideTemperature.value:
+                None if outside_temperature is None else UnitConverter.fahrenheit_to_celsius(outside_temperature / 10),
+            VantageProDatum.InsideTemperature.value:
+                None if inside_temperature is None else UnitConverter.fahrenheit_to_celsius(inside_temperature / 10),
+            VantageProDatum.Barometer.value:
+                None if barometer == 0 else LoopPacket._parse_barometer(record[14:16]),
+            VantageProDatum.SolarRadiation.value: word(16),
+            VantageProDatum.InsideHumidity.value: byte(22),
+            VantageProDatum.OutSideHumidity.value: byte(23),
+            VantageProDatum.WindSpeed.value: None if wind_speed is None else UnitConverter.mph_to_kph(wind_speed),
+            VantageProDatum.WindDirection.value: None if wind_direction is None else wind_direction * 22.5,
+            VantageProDatum.RainRate.value: None if rain_rate is None else rain_rate / 100.0 * 25.4,
+            VantageProDatum.UV.value: None if uv is None else uv / 10,
+        }
+
+
+def parse_archive_pages(pages: List[bytes], since: datetime.datetime, timezone: Optional[str],
+                        first_record: int = 0) -> List[dict]:
+    """
+    Parses downloaded archive pages into rows of datums (keyed by datum name), keeping only the
+     records newer than *since* (UTC)
+
+    :param timezone: The console's timezone (None for the local one)
+    :param first_record: The records before it, in the first page, are skipped
+    """
+    tz = ZoneInfo(timezone) if timezone else None
+    rows = []
+    latest = since
+    for page, crc_ok in zip(pages, LoopPacket.crc_many(b''.join(pages), ArchivePage.PageLength)):
+        if not crc_ok:
+            logger.warning(f"archive page {page[0]}: bad CRC, skipped")
+            continue
+        for i in range(first_record, ArchivePage.RecordsPerPage):
+            record = page[1 + i * ArchivePage.RecordLength:1 + (i + 1) * ArchivePage.RecordLength]
+            local = ArchivePage.record_time(record)
+            if local is None:
+                continue
+            tstamp = (local.replace(tzinfo=tz) if tz else local).astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            if tstamp <= latest:
+                continue    # already stored, or an old record past the end of the circular archive
+            rows.append(ArchivePage.parse_record(record, tstamp))
+            latest = tstamp
+        first_record = 0
+    return rows
 
 
 class VantagePro2(SerialStation):
@@ -140,34 +228,36 @@ class VantagePro2(SerialStation):
         self.interval = cfg.station_settings[self.name].interval
         self.db_manager = make_db_manager()
 
-    def detect(self, serial_ports: List[str]) -> List[str]:
-        ret = serial_ports
-        for serial_port in serial_ports:
-            with serial.Serial(port=serial_port, baudrate=self.cfg['baud'], timeout=2) as ser:
-                #
-                # The VantagePro replies with 'TEST\n' when sent 'TEST\n'
-                #
-                try:
-                    ser.write(b'\n')    # wake it up
-                    buf = ser.read(2)
-                    if buf != b'\n\r':
-                        continue
-                    ser.reset_input_buffer()
-                    n = ser.write(b'TEST\n')
-                    if n != 5:
-                        continue
-                    buf = ser.readline()
-                    buf = ser.readline()
-                    if buf == b'\rTEST\n':
-                        ser.close()
-                        ret.remove(serial_port)
-                        self.port = serial_port
-                        logger.info(f"Detected a VantagePro2 station on '{serial_port}' at {self.cfg['baud']} baud")
-                        return ret
-                except Exception as e:
-                    logger.exception(f"error: {e}", exc_info=e)
-                    ser.close()
-        return ret
+        # streaming: the console sends a LOOP packet every ~2 seconds, for 'loop-packets' packets
+        self.streaming: bool = self.cfg['streaming'] if 'streaming' in self.cfg else False
+        self.loop_packets: int = self.cfg['loop-packets'] if 'loop-packets' in self.cfg else 200
+        # LOOP2 packets (requested with 'LPS 2 n') carry the console computed wind averages and gusts
+        self.loop2: bool = self.cfg['loop2'] if 'loop2' in self.cfg else False
+        self.packet_buffer = bytearray(LoopPacket.PacketLength)     # reused, filled with readinto()
+        self.wind = SlidingWindow(self.interval)    # the streamed wind speeds
+        self.stream_stats = {'packets': 0, 'bad_packets': 0, 'arms': 0}
+
+        # backfill: after an outage, the records missing from the database are downloaded from the console's archive
+        self.backfill: bool = self.cfg['backfill'] if 'backfill' in self.cfg else True
+        self.backfill_pages: int = self.cfg['backfill-pages'] if 'backfill-pages' in self.cfg else 10
+        self.console_timezone: Optional[str] = self.cfg['console-timezone'] if 'console-timezone' in self.cfg else None
+        self.backfilled_recoveries: Optional[int] = None    # the breaker recoveries already backfilled after
+        # the backfill in progress: the last record stored so far and when the backfill started
+        self.backfill_range: Optional[Tuple[datetime.datetime, datetime.datetime]] = None
+        self.backfill_recoveries: Optional[int] = None
+
+    def probe(self, ser) -> bool:
+        #
+        # The VantagePro replies with 'TEST\n' when sent 'TEST\n'
+        #
+        ser.write(b'\n')    # wake it up
+        if ser.read(2) != b'\n\r':
+            return False
+        ser.reset_input_buffer()
+        if ser.write(b'TEST\n') != 5:
+            return False
+        ser.readline()
+        return ser.readline() == b'\rTEST\n'
 
     @classmethod
     def datums(cls) -> List[str]:
@@ -181,83 +271,207 @@ class VantagePro2(SerialStation):
         """
         return [item.value for item in VantageProDatum]
 
-    def fetcher(self):
+    def fetcher(self) -> bool:
         # print(f"{self.name}: fetcher is bypassed")
         # return
-        try:
-            self.ser = serial.Serial(port=self.port, baudrate=self.baud, timeout=self.timeout,
-                                     write_timeout=self.write_timeout)
-        except Exception as ex:
-            logger.error(f"Could not open '{self.port}'", exc_info=ex)
-            self.ser.close()
-            return
+        self.maybe_backfill()
+        with self.connection() as self.ser:
+            self.ser.reset_input_buffer()
+            self.__wakeup()
+            reading = self.__loop()
+        logger.debug("got LOOP packet")
+
+        if not reading:
+            return False
+        self.push_reading(reading)
+        return True
+
+    def fetcher_loop(self):
+        """
+        In streaming mode the console is kept in LOOP: every packet is observed (rollups, archive) and its
+         wind speed is added to the *wind* window.  Once per interval the latest packet, with the mean and
+         the maximum (gust) of the wind speeds streamed during the interval, is pushed to the *Sensors* and saved.
+        """
+        if not self.streaming:
+            return super().fetcher_loop()
+
+        next_push = time.time()
+        while not self.stop_event.is_set():
+            self.maybe_backfill()
+            try:
+                self.__arm_stream()
+            except Exception as ex:
+                self.health.failed(ex, back_off=not self.backs_off_by_itself(ex))
+                self.stop_event.wait(self.health.delay(LoopPacket.Period))
+                continue
+
+            for _ in range(self.loop_packets):
+                if self.stop_event.is_set():
+                    break
+                try:
+                    reading = self.__stream_packet()
+                except Exception as ex:
+                    # lost sync (bad CRC, short read): re-arm the stream
+                    self.stream_stats['bad_packets'] += 1
+                    logger.warning(f"streaming: {ex}, re-arming")
+                    break
+
+                self.stream_stats['packets'] += 1
+                now = time.monotonic()
+                self.wind.add(now, reading.datums[VantageProDatum.WindSpeed])
+                self.observe(reading)
+
+                if time.time() >= next_push:
+                    self.wind.expire(now)
+                    reading.datums[VantageProDatum.WindSpeedMean] = self.wind.mean()
+                    reading.datums[VantageProDatum.WindGust] = self.wind.max()
+                    next_push = max(next_push + self.interval, time.time())
+                    self.health.succeeded()
+                    try:
+                        self.push_reading(reading, observe=False)
+                        self.calculate_sensors()
+                    except Exception as ex:
+                        logger.error(f"Could not save and calculate sensors", exc_info=ex)
+                    self.save_snapshot()
 
         try:
+            with self.connection() as self.ser:
+                self.ser.write(b"\n")     # any character ends the LOOP
+        except Exception:
+            pass
+
+    def __arm_stream(self):
+        with self.connection() as self.ser:
+            self.ser.reset_input_buffer()
             self.__wakeup()
-        except Exception as ex:
-            logger.error("failed to wake up the station", exc_info=ex)
-            self.ser.close()
+            self.ser.reset_input_buffer()
+            if self.ser.timeout is None or self.ser.timeout < 2 * LoopPacket.Period:
+                self.ser.timeout = 2 * LoopPacket.Period
+            command = self.loop_command(self.loop_packets)
+            self.ser.write(command)
+            ack = self.ser.read(1)
+            if ack != b"\x06":
+                raise Exception(f"No ACK after sending {command} (got {ack})")
+        self.stream_stats['arms'] += 1
+
+    def __stream_packet(self) -> VantageProReading:
+        packet = self.packet_buffer
+        with self.connection() as self.ser:
+            n = self.ser.readinto(packet)
+        if n != LoopPacket.PacketLength:
+            raise Exception(f"got only {n} of {LoopPacket.PacketLength} LOOP bytes")
+        if packet[0:3] != b"LOO" or not LoopPacket.is_crc_correct(packet):
+            raise Exception("bad LOOP packet")
+        return LoopPacket.parse(packet, datetime.datetime.utcnow())
+
+    def maybe_backfill(self):
+        """
+        Backfills at startup and whenever the database recovers from an outage, a few archive pages per
+         call (i.e. per fetch), so the port is not kept from the LOOP fetches for long
+        """
+        if not self.backfill:
             return
-
+        recoveries = self.db_manager.breaker.recoveries
+        if recoveries == self.backfilled_recoveries:
+            return
+        if self.backfill_range is None:
+            self.backfill_recoveries = recoveries
         try:
-            reading = self.__loop()
-            logger.debug("got LOOP packet")
+            if self.backfill_archive():
+                self.backfilled_recoveries = self.backfill_recoveries
+        except DatabaseUnavailable as ex:
+            logger.info(f"backfill: postponed ({ex})")
+        except SerialPortUnavailable as ex:
+            logger.warning(f"backfill: postponed ({ex})")
         except Exception as ex:
-            logger.error("failed to get a LOOP packet", exc_info=ex)
-            self.ser.close()
-            return
+            logger.error("backfill: failed", exc_info=ex)
+            self.backfill_range = None
+            self.backfilled_recoveries = self.backfill_recoveries
 
-        if reading:
-            with self.lock:
-                self.readings.push(reading)
-            if hasattr(self, 'saver'):
-                self.saver(reading)
-
-    def saver(self, reading: VantageProReading) -> None:
-        from db_access import DavisDbClass
-
-        davis = DavisDbClass(
-            temp_in=reading.datums[VantageProDatum.InsideTemperature],
-            humidity_in=reading.datums[VantageProDatum.InsideHumidity],
-            pressure_out=reading.datums[VantageProDatum.Barometer],
-            temp_out=reading.datums[VantageProDatum.OutsideTemperature],
-            humidity_out=reading.datums[VantageProDatum.OutSideHumidity],
-            wind_speed=reading.datums[VantageProDatum.WindSpeed],
-            wind_direction=reading.datums[VantageProDatum.WindDirection],
-            rain=reading.datums[VantageProDatum.RainRate],
-            solar_radiation=reading.datums[VantageProDatum.SolarRadiation],
-            tstamp=reading.tstamp,
-        )
-
-        # db_manager.session.add(davis)
-        # db_manager.session.commit()
-        Session = scoped_session(self.db_manager.session_factory)
-        session = Session()
-        try:
-            session.add(davis)
-            session.commit()
-        except:
-            session.rollback()
-            raise
-        finally:
-            Session.remove()
-
-    def check_right_port(self) -> bool:
-        # wakeup if sleeping
-        if not self.__wakeup():
-            return False
+    def backfill_archive(self) -> bool:
+        """
+        Downloads (DMPAFT) the next *backfill_pages* pages of the console's archive records missing from the
+         database (after the last row stored before the backfill started) and bulk-inserts them
 
-        # check test
-        if not self.__test():
-            return False
+        :return: whether the backfill is complete
+        """
+        table = station_tables[self.name]
+        if self.backfill_range is None:
+            last = self.db_manager.run(lambda session: session.execute(
+                text(f"SELECT max(tstamp) FROM {self.db_manager.qualified(table.table)}")).scalar())
+            now = datetime.datetime.utcnow()
+            if last is None or now - last < datetime.timedelta(seconds=2 * self.interval):
+                return True
+            # the readings acquired from now on are stored by the fetches
+            self.backfill_range = (last, now)
+        since, until = self.backfill_range
+
+        pages, first_record, complete = self.__dump_after(since, self.backfill_pages)
+        parsed = parse_archive_pages(pages, since, self.console_timezone, first_record)
+        rows = [row for row in parsed if row['tstamp'] < until]
+        if not self.db_manager.insert_many(table.table, [
+                {'tstamp': row['tstamp'], **{column: row.get(datum) for datum, column in table.columns.items()}}
+                for row in rows]):
+            return False    # retried from the same record by the next fetch
+        logger.info(f"backfill: inserted {len(rows)} archive records (from {len(pages)} pages) after {since}")
+
+        if complete or not rows or len(rows) < len(parsed):
+            self.backfill_range = None
+            return True
+        self.backfill_range = (rows[-1]['tstamp'], until)
+        return False
 
-        # check additional information
-        # echo is not enough
-        if not self._probe():
-            return False
+    def __dump_after(self, since: datetime.datetime, max_pages: int) -> Tuple[List[bytes], int, bool]:
+        """
+        The DMPAFT dialog: up to *max_pages* archive pages containing the records after *since* (UTC), the
+         index of the first such record in the first page and whether these are all the pages (if not,
+         the dump is cancelled and the port released)
+        """
+        tz = ZoneInfo(self.console_timezone) if self.console_timezone else None
+        local = since.replace(tzinfo=datetime.timezone.utc).astimezone(tz)
+        stamp = (ArchivePage.date_stamp(local).to_bytes(2, "little") +
+                 ArchivePage.time_stamp(local).to_bytes(2, "little"))
+
+        pages = []
+        with self.connection() as self.ser:
+            self.ser.reset_input_buffer()
+            self.__wakeup()
+            self.ser.reset_input_buffer()
+            self.ser.write(b"DMPAFT\n")
+            if self.ser.read(1) != b"\x06":
+                raise Exception("No ACK after sending 'DMPAFT'")
+            self.ser.write(stamp + LoopPacket.crc(stamp).to_bytes(2, "big"))
+            if self.ser.read(1) != b"\x06":
+                raise Exception("No ACK after sending the DMPAFT time stamp")
+            header = self.ser.read(6)
+            if len(header) != 6 or not LoopPacket.is_crc_correct(header):
+                self.ser.write(b"\x1b")    # cancel
+                raise Exception(f"Bad DMPAFT header {header}")
+            npages = int.from_bytes(header[0:2], "little")
+            first_record = int.from_bytes(header[2:4], "little")
+            logger.info(f"backfill: downloading {min(npages, max_pages)} of {npages} archive pages")
+            self.ser.write(b"\x06")
+
+            for n in range(min(npages, max_pages)):
+                for attempt in range(3):
+                    page = self.ser.read(ArchivePage.PageLength)
+                    if len(page) == ArchivePage.PageLength and LoopPacket.is_crc_correct(page):
+                        break
+                    self.ser.write(b"\x21")    # NAK: send the page again
+                else:
+                    self.ser.write(b"\x1b")
+                    raise Exception(f"Could not get archive page {len(pages)} of {npages}")
+                pages.append(page)
+                # ESC: the rest of the pages are left for the next fetch
+                self.ser.write(b"\x1b" if n + 1 == max_pages < npages else b"\x06")
+
+        return pages, first_record, npages <= max_pages
+
+    def streaming_status(self) -> dict:
+        return {'enabled': self.streaming, 'loop_packets': self.loop_packets, **self.stream_stats}
 
-        # definitely a VantagePro
-        return True
+    def saver(self, reading: VantageProReading) -> None:
+        self.db_manager.insert_reading(self.name, reading)
 
     def __wakeup(self) -> bool:
         expected_response = bytes([10, 13])
@@ -278,46 +492,23 @@ class VantagePro2(SerialStation):
 
         return False
 
-    def __test(self):
-        # self.ser.reset_output_buffer()
-
-        expected_response = b"TEST\n\r"
-        self.ser.write(b"TEST\n")
-
-        self.ser.read(2)
-        response = self.ser.read(len(expected_response))
-
-        return response == expected_response
-
-    def _probe(self) -> bool:
-        expected_response = bytes([6, 16])
-        try:
-            self.ser.write(b"WRD" + bytes([0x12, 0x4D]) + b"\n")
-            response = self.ser.read(len(expected_response))
-        except Exception as ex:
-            logger.error(f"failed probing with WRD", exc_info=ex)
-            return False
-
-        return response == expected_response
+    def loop_command(self, n: int) -> bytes:
+        return f"LPS 2 {n}\n".encode() if self.loop2 else f"LOOP {n}\n".encode()
 
     def __loop(self):
+        command = self.loop_command(1)
         try:
-            self.ser.write(b"LOOP 1\n")
+            self.ser.write(command)
         except Exception as ex:
             logger.error(f"failed to send/receive a LOOP packet", exc_info=ex)
             return
 
         ack = self.ser.read(1)
         if len(ack) != 1:
-            raise Exception(f"No ACK after sending 'LOOP 1'")
-
-        loop_bytes = self.ser.read(99)
-        if len(loop_bytes) != 99:
-            raise Exception(f"Could not read 99 LOOP bytes (got only {len(loop_bytes)})")
-
-        return LoopPacket.parse(loop_bytes, datetime.datetime.utcnow())
+            raise Exception(f"No ACK after sending {command}")
 
+        n = self.ser.readinto(self.packet_buffer)
+        if n != LoopPacket.PacketLength:
+            raise Exception(f"Could not read {LoopPacket.PacketLength} LOOP bytes (got only {n})")
 
-# if __name__ == "__main__":
-#     v = VantagePro2('davis')
-#     v.start()
+        return LoopPacket.parse(self.packet_buffer, datetime.datetime.utcnow())
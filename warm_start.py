@@ -0,0 +1,154 @@
+import datetime
+import json
+import logging
+import os
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from config.config import make_cfg
+from init_log import init_log
+
+logger = logging.getLogger('warm-start')
+init_log(logger)
+
+
+class SnapshotReading:
+    """
+    A reading restored from a snapshot (or from the database), as used by the *Sensors*
+    """
+    datums: dict
+    tstamp: datetime.datetime
+
+    def __init__(self, tstamp: datetime.datetime, datums: dict):
+        self.tstamp = tstamp
+        self.datums = datums
+
+
+def snapshot_file(station: str) -> str:
+    return os.path.join(make_cfg().warm_start.directory, f"{station}.json")
+
+
+def save_snapshot(station):
+    """
+    Atomically writes a **Station**'s readings fifo and its *Sensors*' settling state
+    """
+    with station.lock:
+        readings = list(station.readings.data)
+
+    snapshot = {
+        'saved': datetime.datetime.utcnow().isoformat(),
+        'readings': [{
+            'tstamp': reading.tstamp.isoformat(),
+            'datums': {getattr(datum, 'value', datum): value for datum, value in reading.datums.items()
+                       if value is None or isinstance(value, (int, float, str))},
+        } for reading in readings],
+        'sensors': [{
+            'project': sensor.settings.project,
+            'name': sensor.name,
+            'started_settling': sensor.started_settling.isoformat() if sensor.started_settling else None,
+        } for sensor in station.sensors],
+    }
+
+    filename = snapshot_file(station.name)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(filename + '.tmp', filename)
+
+
+def load_snapshot(station) -> Optional[dict]:
+    """
+    The **Station**'s snapshot, with only the readings that are fresh enough, or None
+    """
+    filename = snapshot_file(station.name)
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as f:
+        snapshot = json.load(f)
+
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=make_cfg().warm_start.max_age)
+    if datetime.datetime.fromisoformat(snapshot['saved']) < oldest:
+        return None
+
+    snapshot['readings'] = [SnapshotReading(datetime.datetime.fromisoformat(r['tstamp']), r['datums'])
+                            for r in snapshot['readings']]
+    snapshot['readings'] = [r for r in snapshot['readings'] if r.tstamp >= oldest]
+    return snapshot
+
+
+def load_from_database(station) -> List[SnapshotReading]:
+    """
+    The **Station**'s latest stored rows, if fresh enough and if all the datums its *Sensors* need are stored
+    """
+    from db_access import make_db_manager, station_tables
+
+    if station.name not in station_tables:
+        return []
+    table = station_tables[station.name]
+    if any([sensor.settings.datum not in table.columns for sensor in station.sensors]):
+        return []
+
+    db_manager = make_db_manager()
+    columns = ", ".join([f'"{column}"' for column in table.columns.values()])
+    statement = text(f'SELECT tstamp, {columns} FROM "{db_manager.schema}"."{table.table}"' +
+                     " WHERE tstamp >= :oldest ORDER BY tstamp DESC LIMIT :n")
+    oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=make_cfg().warm_start.max_age)
+    rows = db_manager.run(lambda session: session.execute(statement, {'oldest': oldest,
+                                                                       'n': station.nreadings}).all())
+
+    readings = []
+    for row in reversed(rows):
+        datums = {datum: None for datum in make_cfg().station_settings[station.name].datums}
+        datums.update({datum: (float(value) if value is not None else None)
+                       for datum, value in zip(table.columns.keys(), row[1:])})
+        readings.append(SnapshotReading(row[0], datums))
+    return readings
+
+
+def rehydrate(station):
+    """
+    Refills a **Station**'s readings fifo (and its *Sensors*' settling state) from its snapshot or,
+     failing that, from the database, so that the *Sensors* can decide right after a restart.
+    """
+    try:
+        snapshot = load_snapshot(station)
+    except Exception as ex:
+        logger.error(f"station '{station.name}': could not load the snapshot", exc_info=ex)
+        snapshot = None
+
+    source = 'snapshot'
+    readings = snapshot['readings'] if snapshot is not None else []
+    if not readings:
+        source = 'database'
+        try:
+            readings = load_from_database(station)
+        except Exception as ex:
+            logger.info(f"station '{station.name}': could not load readings from the database ({ex})")
+            readings = []
+
+    if not readings:
+        return
+
+    with station.lock:
+        for reading in readings:
+            station.readings.push(reading)
+
+    if snapshot is not None:
+        for saved in snapshot['sensors']:
+            for sensor in station.sensors:
+                if sensor.name == saved['name'] and sensor.settings.project == saved['project'] \
+                        and saved['started_settling'] is not None:
+                    sensor.started_settling = datetime.datetime.fromisoformat(saved['started_settling'])
+
+    # the sensors' previous readings decide whether they were safe (i.e. whether they need to settle)
+    for sensor in station.sensors:
+        if hasattr(sensor.settings, 'datum') and sensor.settings.datum is not None:
+            try:
+                sensor.readings = station.latest_readings(sensor.settings.datum, sensor.settings.nreadings)
+            except Exception as ex:
+                logger.error(f"station '{station.name}': could not restore the readings of sensor " +
+                             f"'{sensor.name}'", exc_info=ex)
+
+    logger.info(f"station '{station.name}': restored {len(readings)} readings from the {source}")